@@ -0,0 +1,69 @@
+""" Microbenchmark of client frames decoding.
+Usage: python -m bench.frame_decoder
+"""
+import json
+import timeit
+
+from server.defs import Action
+from server.protocol import FrameDecoder
+
+
+def make_frame(action, message):
+    data = message.encode('utf-8')
+    return action.to_bytes(4, byteorder='little') + len(data).to_bytes(4, byteorder='little') + data
+
+
+def split(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+class ConcatDecoder(object):
+    """ Previous implementation: the buffer is rebuilt by concatenation and slicing on each chunk.
+    """
+    def __init__(self):
+        self.data = b''
+
+    def frames(self, data):
+        data = self.data + data
+        result = []
+        while True:
+            if len(data) < 8:
+                break
+            action = int.from_bytes(data[0:4], byteorder='little')
+            message_len = int.from_bytes(data[4:8], byteorder='little')
+            if len(data) < 8 + message_len:
+                break
+            data = data[8:]
+            result.append((action, data[0:message_len].decode('utf-8')))
+            data = data[message_len:]
+        self.data = data
+        return result
+
+
+def run(decoder_cls, chunks, repeat):
+    def feed():
+        decoder = decoder_cls()
+        count = 0
+        for chunk in chunks:
+            count += len(decoder.frames(chunk))
+        return count
+    return min(timeit.repeat(feed, number=1, repeat=repeat))
+
+
+def main():
+    big_message = json.dumps({'post': [], 'train': list(range(200000))})
+    small_message = json.dumps({'line_idx': 1, 'speed': 1, 'train_idx': 1})
+    scenarios = [
+        ("large frame in 1KB chunks", split(make_frame(Action.UPGRADE, big_message), 1024), 5),
+        ("small frames in 7B chunks", split(make_frame(Action.MOVE, small_message) * 2000, 7), 5),
+        ("10000 coalesced small frames", [make_frame(Action.MOVE, small_message) * 10000], 5),
+    ]
+    print("{:<32} {:>12} {:>12}".format("scenario", "concat, ms", "decoder, ms"))
+    for name, chunks, repeat in scenarios:
+        concat_time = run(ConcatDecoder, chunks, repeat)
+        decoder_time = run(FrameDecoder, chunks, repeat)
+        print("{:<32} {:>12.2f} {:>12.2f}".format(name, concat_time * 1000, decoder_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
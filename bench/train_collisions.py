@@ -0,0 +1,55 @@
+""" Microbenchmark of train collisions detection.
+Usage: python -m bench.train_collisions (map DB must be generated)
+"""
+import random
+import timeit
+
+from server.entity.game import Game
+from server.entity.player import Player
+from server.entity.train import Train
+from server.game_config import CONFIG
+
+
+def all_pairs(game):
+    """ Previous implementation: check of all pairs of trains.
+    """
+    trains = list(game.trains.values())
+    pairs = []
+    for i, train_1 in enumerate(trains):
+        point_1 = game.is_train_at_point(train_1)
+        for train_2 in trains[i + 1:]:
+            if game.is_collision(train_1, train_2, point_1, game.is_train_at_point(train_2)):
+                pairs.append((train_1, train_2))
+    return pairs
+
+
+def make_game(trains_count):
+    game = Game('Bench collisions {}'.format(trains_count), CONFIG.MAP_NAME, observed=True)
+    player = Player('Bench collisions player')
+    game.add_player(player)
+    lines = list(game.map.line.values())
+    rand = random.Random(trains_count)
+    while len(game.trains) < trains_count:
+        train = Train(idx=len(game.trains) + 1, player_id=player.idx)
+        game.map.add_train(train)
+        game.trains[train.idx] = train
+    for train in game.trains.values():
+        line = rand.choice(lines)
+        train.line_idx = line.idx
+        train.position = rand.randint(0, line.length)
+        train.speed = rand.choice((-1, 0, 1))
+    return game
+
+
+def main():
+    print("{:>8} {:>16} {:>16}".format("trains", "all pairs, ms", "buckets, ms"))
+    for trains_count in (32, 128, 512):
+        game = make_game(trains_count)
+        assert all_pairs(game) == game.get_collision_pairs()
+        all_pairs_time = min(timeit.repeat(lambda: all_pairs(game), number=1, repeat=5))
+        buckets_time = min(timeit.repeat(game.get_collision_pairs, number=1, repeat=5))
+        print("{:>8} {:>16.2f} {:>16.2f}".format(trains_count, all_pairs_time * 1000, buckets_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+""" Microbenchmark of trains update on game tick: Train objects vs the train table (NumPy columns).
+Collisions are disabled, randomly placed trains collide too often.
+Usage: python -m bench.train_table (map DB must be generated, NumPy must be installed)
+"""
+import random
+import timeit
+from unittest import mock
+
+from server.entity.game import CONFIG, Game
+from server.entity.player import Player
+from server.entity.train import Train
+
+
+def make_game(trains_count, train_table):
+    with mock.patch.object(CONFIG, 'TRAIN_TABLE_ENABLED', train_table):
+        game = Game('Bench train table {} {}'.format(trains_count, train_table), CONFIG.MAP_NAME, seed=1,
+                    headless=True)
+    player = Player('Bench train table player')
+    game.add_player(player)
+    lines = list(game.map.line.values())
+    rand = random.Random(trains_count)
+    while len(game.trains) < trains_count:
+        idx = len(game.trains) + 1
+        train = Train(idx=idx) if game.train_table is None else game.train_table.add_train(idx)
+        player.add_train(train)
+        line = rand.choice(lines)
+        train.line_idx, train.position = line.idx, rand.randint(0, line.length)
+        train.speed = rand.choice((-1, 0, 1))
+        train.cooldown = rand.randint(0, 5)
+        game.map.add_train(train)
+        game.trains[train.idx] = train
+    return game
+
+
+def trains_at_points(game):
+    if game.train_table is not None:
+        return game.train_table.trains_at_points()
+    lines = game.map.line
+    return [t for t in game.trains.values() if t.position == 0 or t.position == lines[t.line_idx].length]
+
+
+def main():
+    benchmarks = (
+        ('cooldowns', lambda game: game.update_cooldowns_on_tick()),
+        ('positions', lambda game: game.update_trains_positions_on_tick()),
+        ('at points', trains_at_points),
+        ('tick', lambda game: game.tick()),
+    )
+    print("{:>8} {:>10} {:>16} {:>16}".format("trains", "update", "objects, ms", "table, ms"))
+    with mock.patch.object(CONFIG, 'FUEL_ENABLED', True), mock.patch.object(CONFIG, 'COLLISIONS_ENABLED', False):
+        for trains_count in (1000, 10000, 100000):
+            for name, func in benchmarks:
+                times = []
+                for train_table in (False, True):
+                    game = make_game(trains_count, train_table)
+                    times.append(min(timeit.repeat(lambda: func(game), number=1, repeat=10)))
+                print("{:>8} {:>10} {:>16.2f} {:>16.2f}".format(
+                    trains_count, name, times[0] * 1000, times[1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,11 @@ from functools import partial
 
 from invoke import task
 
+from db.map_snapshot import write_snapshot
 from db.models import MapBase, Map, Line, Point, Post
 from db.session import MapSession, map_session_ctx
+from defs import MAP_SNAPSHOT_PATH
+from entity.map import Map as MapEntity, MapTemplate, load_map_data, map_db_stamp
 from entity.post import PostType
 from game_config import CONFIG
 
@@ -33,6 +36,7 @@ class DbMap(object):
         """
         MapBase.metadata.drop_all()
         MapBase.metadata.create_all()
+        MapEntity.invalidate_cache()
 
     @db_session
     def add_map(self, size_x, size_y, name='', session=None):
@@ -877,3 +881,27 @@ def generate_map(_, map_version=CONFIG.CURRENT_MAP_VERSION):
             map_generator(database, session)
             print("Map '{}' has been generated.".format(curr_map))
     sys.exit(0)
+
+
+def compile_snapshot(snapshot_path=MAP_SNAPSHOT_PATH):
+    """ Compiles all maps of map DB into snapshot file.
+    returns: names of compiled maps
+    """
+    db_stamp = map_db_stamp()
+    with map_session_ctx() as session:
+        map_names = [m.name for m in session.query(Map).order_by(Map.id).all()]
+    maps = []
+    for map_name in map_names:
+        data = load_map_data(map_name, use_snapshot=False)
+        data['point_lines'] = MapTemplate(data).point_lines
+        maps.append(data)
+    write_snapshot(snapshot_path, maps, db_stamp)
+    return map_names
+
+
+@task
+def compile_map(_, snapshot_path=MAP_SNAPSHOT_PATH):
+    """ Compiles 'map.db' into snapshot file, the server loads maps from the snapshot while 'map.db' is not changed.
+    """
+    map_names = compile_snapshot(snapshot_path)
+    print("Maps {} have been compiled into '{}'.".format(', '.join(map_names), snapshot_path))
@@ -0,0 +1,143 @@
+""" Compiled snapshot of map DB: binary file with arrays of all maps which is loaded without ORM.
+
+File layout (little-endian):
+    header: magic (4 bytes), format version (uint32), length of meta (uint32)
+    meta: JSON with stamp of the map DB, names and sizes of maps, names of posts and offsets of arrays
+    arrays: int64 arrays aligned to 8 bytes, NULL values are stored as SNAPSHOT_NULL
+Arrays of each map:
+    line: rows (idx, length, p0, p1) ordered by idx
+    point: rows (idx, post_id, x, y) ordered by idx
+    post: rows (idx, type, population, armor, product, replenishment, point_id) ordered by idx
+    adjacency: CSR graph of points and incident lines: 'adj_point' - indexes of points,
+               'adj_offset' - offsets of lines of each point in 'adj_line', 'adj_line' - indexes of lines
+"""
+import json
+import mmap
+import os
+import struct
+
+SNAPSHOT_MAGIC = b'WGMS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_NULL = -2 ** 63
+
+_HEADER = struct.Struct('<4sII')
+_ITEM_SIZE = 8
+
+LINE_COLUMNS = ('idx', 'length', 'p0', 'p1')
+POINT_COLUMNS = ('idx', 'post_id', 'x', 'y')
+POST_COLUMNS = ('idx', 'type', 'population', 'armor', 'product', 'replenishment', 'point_id')
+
+
+class SnapshotError(Exception):
+    """ Snapshot file is corrupted or has unsupported version.
+    """
+    pass
+
+
+def _pack(values):
+    return struct.pack('<{}q'.format(len(values)), *(SNAPSHOT_NULL if v is None else v for v in values))
+
+
+def write_snapshot(path, maps, db_stamp):
+    """ Writes snapshot file.
+    maps: list of dicts with keys: 'name', 'idx', 'size', 'line', 'point', 'post', 'post_name', 'point_lines',
+        rows of 'line', 'point' and 'post' are tuples of values of LINE_COLUMNS, POINT_COLUMNS and POST_COLUMNS
+    db_stamp: stamp of the map DB which is compiled
+    """
+    blobs = []
+    offset = 0
+    meta = {'db_stamp': db_stamp, 'maps': {}}
+    for game_map in maps:
+        adj_points = sorted(game_map['point_lines'])
+        adj_offsets = [0]
+        for point_idx in adj_points:
+            adj_offsets.append(adj_offsets[-1] + len(game_map['point_lines'][point_idx]))
+        arrays = {
+            'line': [v for row in game_map['line'] for v in row],
+            'point': [v for row in game_map['point'] for v in row],
+            'post': [v for row in game_map['post'] for v in row],
+            'adj_point': adj_points,
+            'adj_offset': adj_offsets,
+            'adj_line': [l for p in adj_points for l in game_map['point_lines'][p]],
+        }
+        map_meta = {
+            'idx': game_map['idx'],
+            'size': game_map['size'],
+            'post_name': game_map['post_name'],
+            'arrays': {},
+        }
+        for array_name, values in arrays.items():
+            map_meta['arrays'][array_name] = (offset, len(values))
+            blobs.append(_pack(values))
+            offset += len(values) * _ITEM_SIZE
+        meta['maps'][game_map['name']] = map_meta
+
+    meta_data = json.dumps(meta, sort_keys=True).encode('utf-8')
+    meta_data += b' ' * (-(_HEADER.size + len(meta_data)) % _ITEM_SIZE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(meta_data)))
+        snapshot_file.write(meta_data)
+        for blob in blobs:
+            snapshot_file.write(blob)
+    os.replace(tmp_path, path)  # Readers never see partially written file.
+
+
+def _array(data, offset, count):
+    return struct.unpack_from('<{}q'.format(count), data, offset)
+
+
+def _rows(data, offset, count, columns_count):
+    """ Unpacks rows of the array, NULL values are replaced by None.
+    """
+    rows = struct.iter_unpack('<{}q'.format(columns_count), data[offset:offset + count * _ITEM_SIZE])
+    return [row if SNAPSHOT_NULL not in row else tuple(None if v == SNAPSHOT_NULL else v for v in row)
+            for row in rows]
+
+
+def _stamp(value):
+    """ Converts stamp of the map DB restored from JSON to tuples.
+    """
+    return tuple(tuple(v) if isinstance(v, list) else v for v in value) if isinstance(value, list) else value
+
+
+def _read_map(data, arrays_start, name, map_meta):
+    """ Unpacks arrays of one map, arrays of other maps are not read.
+    """
+    arrays = {}
+    for array_name, (offset, count) in map_meta['arrays'].items():
+        if arrays_start + offset + count * _ITEM_SIZE > len(data):
+            raise ValueError("Array is out of the file, array: {}".format(array_name))
+        arrays[array_name] = (arrays_start + offset, count)
+    adj_point, adj_offset, adj_line = (_array(data, *arrays[a]) for a in ('adj_point', 'adj_offset', 'adj_line'))
+    return {
+        'name': name,
+        'idx': map_meta['idx'],
+        'size': tuple(map_meta['size']),
+        'line': _rows(data, *arrays['line'], len(LINE_COLUMNS)),
+        'point': _rows(data, *arrays['point'], len(POINT_COLUMNS)),
+        'post': _rows(data, *arrays['post'], len(POST_COLUMNS)),
+        'post_name': map_meta['post_name'],
+        'point_lines': {p: list(adj_line[adj_offset[i]:adj_offset[i + 1]]) for i, p in enumerate(adj_point)},
+    }
+
+
+def read_snapshot(path, name):
+    """ Reads the map from snapshot file by memory mapping, only arrays of the map are unpacked.
+    returns: tuple (stamp of the compiled map DB, dict of the map in format of 'write_snapshot' or None if the map
+        is not in the snapshot)
+    """
+    with open(path, 'rb') as snapshot_file:
+        if os.fstat(snapshot_file.fileno()).st_size < _HEADER.size:
+            raise SnapshotError("Snapshot file is truncated, path: '{}'".format(path))
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, meta_size = _HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise SnapshotError("Unsupported snapshot file, path: '{}', version: {}".format(path, version))
+            try:
+                meta = json.loads(data[_HEADER.size:_HEADER.size + meta_size].decode('utf-8'))
+                map_meta = meta['maps'].get(name)
+                game_map = None if map_meta is None else _read_map(data, _HEADER.size + meta_size, name, map_meta)
+            except (ValueError, KeyError, TypeError, struct.error) as err:
+                raise SnapshotError("Snapshot file is corrupted, path: '{}', error: {}".format(path, err))
+    return _stamp(meta['db_stamp']), game_map
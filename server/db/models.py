@@ -1,6 +1,6 @@
 """ DB models.
 """
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -91,15 +91,25 @@ class Game(ReplayBase):
     map_name = Column(String)
     actions = relationship('Action', backref='game', lazy='dynamic')
     num_players = Column(Integer)
+    length = Column(Integer, nullable=False, default=0, server_default='0')  # Number of TURN actions.
+    state = Column(Integer)  # GameState, NULL for games recorded before the state was stored.
 
     def __repr__(self):
-        return "<Game(id='{}', name='{}', date='{}', map_name='{}', num_players='{}')>".format(
-            self.id, self.name, self.date, self.map_name, self.num_players)
+        return (
+            "<Game(id='{}', name='{}', date='{}', map_name='{}', num_players='{}', "
+            "length='{}', state='{}')>".format(
+                self.id, self.name, self.date, self.map_name, self.num_players, self.length, self.state
+            )
+        )
 
 
 class Action(ReplayBase):
 
     __tablename__ = 'action'
+    __table_args__ = (
+        Index('ix_action_game_id_id', 'game_id', 'id'),  # Actions of the game.
+        Index('ix_action_game_id_code', 'game_id', 'code'),  # Length of the game: count of its TURN actions.
+    )
 
     id = Column(Integer, primary_key=True)
     game_id = Column(Integer, ForeignKey('game.id'))
@@ -1,15 +1,19 @@
 """ Replay DB helpers.
 """
+import queue
 import sys
+import time
 from datetime import datetime
+from threading import Event, Lock, Thread
 
 from invoke import task
-from sqlalchemy import func, and_
+from sqlalchemy import bindparam, inspect
 
 from db.models import ReplayBase, Game, Action
-from db.session import ReplaySession, replay_session_ctx
-from defs import Action as ActionCodes
+from db.session import ReplaySession, replay_engine, replay_session_ctx
+from defs import Action as ActionCodes, GameState
 from game_config import CONFIG
+from logger import log
 
 TIME_FORMAT = '%b %d %Y %I:%M:%S.%f'
 
@@ -25,11 +29,163 @@ def db_session(function):
     return wrapped
 
 
+def update_games(session, lengths=None, states=None):
+    """ Adds numbers of TURN actions to lengths of the games and sets states of the games.
+    lengths: dict, key: game id, value: number of new TURN actions of the game
+    states: dict, key: game id, value: new state of the game
+    """
+    if lengths:
+        session.execute(
+            Game.__table__.update().where(Game.id == bindparam('game_id')).values(
+                length=Game.length + bindparam('turns')),
+            [{'game_id': game_id, 'turns': turns} for game_id, turns in lengths.items()]
+        )
+    if states:
+        session.execute(
+            Game.__table__.update().where(Game.id == bindparam('game_id')).values(state=bindparam('new_state')),
+            [{'game_id': game_id, 'new_state': state} for game_id, state in states.items()]
+        )
+
+
+class FlushRequest(object):
+    """ Request to write all queued actions, 'done' is set when they are written or writing failed.
+    """
+    __slots__ = ('done', 'committed')
+
+    def __init__(self):
+        self.done = Event()
+        self.committed = False
+
+
+class ReplayWriter(object):
+    """ Writes actions to replay DB on background thread.
+    Actions are taken over the queue and inserted by batches in one transaction, the batch is written when it
+    reaches REPLAY_BATCH_SIZE actions or REPLAY_FLUSH_INTERVAL seconds after its first action.
+    Lengths and states of the games are updated in the same transaction.
+    If the transaction fails, the batch is kept and written again REPLAY_RETRY_INTERVAL seconds later by chunks of
+    REPLAY_BATCH_SIZE actions. While replay DB is unavailable at most REPLAY_RETRY_BATCHES batches are kept,
+    newer actions are lost.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self):
+        """ Starts writer thread, does nothing if it's already started.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='ReplayWriter', daemon=True)
+                self._thread.start()
+
+    def add_action(self, game_id, action, message, date):
+        """ Queues action to be written.
+        """
+        self.start()
+        self._queue.put({'game_id': game_id, 'code': action, 'message': message, 'date': date})
+
+    def set_game_state(self, game_id, state):
+        """ Queues change of the game state to be written after all previously queued actions.
+        """
+        self.start()
+        self._queue.put((game_id, state))
+
+    def flush(self, timeout=None):
+        """ Writes all queued actions, blocks until they are committed or the timeout (in seconds) is expired.
+        timeout: REPLAY_FLUSH_TIMEOUT if it's None
+        returns: True if all actions are committed, False if writing failed or the timeout is expired
+        """
+        self.start()
+        request = FlushRequest()
+        self._queue.put(request)
+        if not request.done.wait(CONFIG.REPLAY_FLUSH_TIMEOUT if timeout is None else timeout):
+            log(log.ERROR, "Replay actions are not written in time")
+            return False
+        return request.committed
+
+    def _run(self):
+        batch = []
+        states = {}
+        deadline = None
+        failed = False
+        lost = 0  # Number of actions lost since the last flush.
+        while True:
+            timeout = None if not batch and not states else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, (dict, tuple)):
+                if not batch and not states:
+                    deadline = time.monotonic() + CONFIG.REPLAY_FLUSH_INTERVAL
+                if isinstance(item, dict):
+                    if len(batch) < CONFIG.REPLAY_BATCH_SIZE * CONFIG.REPLAY_RETRY_BATCHES:
+                        batch.append(item)
+                    else:
+                        if not lost:
+                            log(log.ERROR, "Replay DB is unavailable, new replay actions are lost")
+                        lost += 1
+                else:
+                    game_id, state = item
+                    states[game_id] = state
+                if len(batch) < CONFIG.REPLAY_BATCH_SIZE or failed and time.monotonic() < deadline:
+                    continue
+            if batch or states:
+                failed = not self._write_chunks(batch, states)
+                if failed:
+                    deadline = time.monotonic() + CONFIG.REPLAY_RETRY_INTERVAL
+            if isinstance(item, FlushRequest):
+                item.committed = not failed and not lost
+                if lost:
+                    log(log.ERROR, "Replay actions are lost, actions: %s", lost)
+                    lost = 0
+                item.done.set()
+
+    def _write_chunks(self, batch, states):
+        """ Writes the batch by chunks of REPLAY_BATCH_SIZE actions, each in its own transaction, states of
+        the games are written with the last chunk. Written actions and states are removed from the batch and states.
+        returns: True if all chunks are committed
+        """
+        while batch or states:
+            chunk = batch[:CONFIG.REPLAY_BATCH_SIZE]
+            last = len(chunk) == len(batch)
+            if not self._write(chunk, states if last else {}):
+                return False
+            del batch[:len(chunk)]
+            if last:
+                states.clear()
+        return True
+
+    @staticmethod
+    def _write(batch, states):
+        """ Writes the batch in one transaction.
+        returns: True if it's committed
+        """
+        lengths = {}
+        for action in batch:
+            if action['code'] == ActionCodes.TURN:
+                lengths[action['game_id']] = lengths.get(action['game_id'], 0) + 1
+        try:
+            with replay_session_ctx() as session:
+                if batch:
+                    session.execute(Action.__table__.insert(), batch)
+                update_games(session, lengths=lengths, states=states)
+        except Exception:
+            log(log.EXCEPTION, "Failed to write replay actions, they will be written again, actions: %s", len(batch))
+            return False
+        return True
+
+
+REPLAY_WRITER = ReplayWriter()
+
+
 class DbReplay(object):
     """ Contains helpers for replay DB.
     """
-    def __init__(self):
+    def __init__(self, writer=None):
         self.current_game_id = None
+        self.writer = writer  # Actions are written by the writer on background thread if it's given.
 
     @staticmethod
     def reset_db():
@@ -38,54 +194,146 @@ class DbReplay(object):
         ReplayBase.metadata.drop_all()
         ReplayBase.metadata.create_all()
 
+    @staticmethod
+    def migrate_db():
+        """ Creates missing tables and indexes of DB schema, keeps existing data.
+        """
+        ReplayBase.metadata.create_all()
+        inspector = inspect(replay_engine)
+        with replay_engine.begin() as connection:
+            for table in ReplayBase.metadata.sorted_tables:
+                existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing_columns:
+                        connection.execute('ALTER TABLE {} ADD COLUMN {} {}{}'.format(
+                            table.name, column.name, column.type.compile(replay_engine.dialect),
+                            '' if column.server_default is None else ' DEFAULT {}'.format(column.server_default.arg)
+                        ))
+                        if table.name == Game.__tablename__ and column.name == 'length':
+                            connection.execute(
+                                'UPDATE game SET length = (SELECT COUNT(*) FROM action '
+                                'WHERE action.game_id = game.id AND action.code = {})'.format(int(ActionCodes.TURN))
+                            )
+        for table in ReplayBase.metadata.sorted_tables:
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(replay_engine)
+
+    @staticmethod
+    def games_query(session, map_name=None, name=None, date_from=None, date_to=None):
+        """ Returns query of the games filtered by map name, part of game name and date range.
+        """
+        query = session.query(Game)
+        if map_name is not None:
+            query = query.filter(Game.map_name == map_name)
+        if name is not None:
+            query = query.filter(Game.name.contains(name))
+        if date_from is not None:
+            query = query.filter(Game.date >= date_from)
+        if date_to is not None:
+            query = query.filter(Game.date <= date_to)
+        return query.order_by(Game.id)
+
+    @staticmethod
+    def actions_query(session, game_id):
+        """ Returns query of all actions of the game.
+        """
+        return session.query(Action).filter(Action.game_id == game_id).order_by(Action.id)
+
+    @db_session
+    def explain_queries(self, game_id=1, session=None):
+        """ Returns query plans of DB queries used by the server.
+        returns: dict, key: query name, value: list of query plan details
+        """
+        plans = {}
+        for name, query in (('games', self.games_query(session)),
+                            ('actions', self.actions_query(session, game_id))):
+            statement = query.statement.compile(dialect=replay_engine.dialect, compile_kwargs={'literal_binds': True})
+            plans[name] = [row[-1] for row in session.execute('EXPLAIN QUERY PLAN {}'.format(statement))]
+        return plans
+
     @db_session
     def add_game(self, name, map_name, date=None, num_players=1, session=None):
         """ Creates new Game in DB.
         """
         _date = datetime.now() if date is None else date
-        new_game = Game(name=name, date=_date, map_name=map_name, num_players=num_players)
+        new_game = Game(
+            name=name, date=_date, map_name=map_name, num_players=num_players, length=0, state=GameState.INIT)
         session.add(new_game)
         session.commit()  # Commit to get game's id.
         self.current_game_id = new_game.id
         return self.current_game_id
 
     # pylint: disable=R0913
-    @db_session
     def add_action(self, action, message, game_id=None, date=None, session=None):
         """ Creates new Action in DB.
         """
         _date = datetime.now() if date is None else date
         _game_id = self.current_game_id if game_id is None else game_id
-        new_action = Action(game_id=_game_id, code=action, message=message, date=_date)
-        session.add(new_action)
+        if self.writer is not None and session is None:
+            self.writer.add_action(_game_id, action, message, _date)
+        else:
+            self._add_action(action, message, _game_id, _date, session=session)
 
     @db_session
-    def get_all_games(self, session=None):
-        """ Retrieves all games with their length.
+    def _add_action(self, action, message, game_id, date, session=None):
+        session.add(Action(game_id=game_id, code=action, message=message, date=date))
+        if action == ActionCodes.TURN:
+            update_games(session, lengths={game_id: 1})
+
+    def set_game_state(self, state, game_id=None):
+        """ Sets state of the game, the state is written after all previously added actions.
         """
-        games = []
-        rows = session.query(Game, func.count(Action.id)).outerjoin(
-            Action, and_(Game.id == Action.game_id, Action.code == ActionCodes.TURN)).group_by(
-                Game.id).order_by(Game.id).all()
-        for row in rows:
-            game_data, game_length = row
-            game = {
-                'idx': game_data.id,
-                'name': game_data.name,
-                'date': game_data.date.strftime(TIME_FORMAT),
-                'map': game_data.map_name,
-                'length': game_length,
-                'num_players': game_data.num_players,
-            }
-            games.append(game)
-        return games
+        _game_id = self.current_game_id if game_id is None else game_id
+        if self.writer is not None:
+            self.writer.set_game_state(_game_id, state)
+        else:
+            with replay_session_ctx() as session:
+                update_games(session, states={_game_id: state})
+
+    def flush(self):
+        """ Writes actions queued by the writer.
+        returns: True if all actions are committed
+        """
+        if self.writer is None:
+            return True
+        return self.writer.flush()
+
+    @staticmethod
+    def game_to_dict(game):
+        return {
+            'idx': game.id,
+            'name': game.name,
+            'date': game.date.strftime(TIME_FORMAT),
+            'map': game.map_name,
+            'length': game.length,
+            'num_players': game.num_players,
+            'state': game.state,
+        }
+
+    # pylint: disable=R0913
+    @db_session
+    def get_all_games(self, offset=0, limit=None, map_name=None, name=None, date_from=None, date_to=None,
+                      session=None):
+        """ Retrieves games with their length ordered by id, filtered by map name, part of game name and dates.
+        """
+        query = self.games_query(session, map_name=map_name, name=name, date_from=date_from, date_to=date_to)
+        return [self.game_to_dict(g) for g in query.offset(offset).limit(limit).all()]
+
+    @db_session
+    def get_game(self, game_id, session=None):
+        """ Retrieves the game, returns None if the game is not found.
+        """
+        game = session.query(Game).get(game_id)
+        return None if game is None else self.game_to_dict(game)
 
     @db_session
     def get_all_actions(self, game_id, session=None):
         """ Retrieves all actions for the game.
         """
         actions = []
-        rows = session.query(Action).filter(Action.game_id == game_id).order_by(Action.id).all()
+        rows = self.actions_query(session, game_id).all()
         for row in rows:
             action = {
                 'code': row.code,
@@ -95,6 +343,27 @@ class DbReplay(object):
             actions.append(action)
         return actions
 
+    def iter_actions(self, game_id, after_id=0, codes=None, chunk_size=None):
+        """ Yields actions of the game ordered by id, actions are read by chunks of REPLAY_CHUNK_SIZE rows.
+        Each chunk is read in its own session starting after the last read action, so no DB transaction is kept
+        open between chunks and reading can be resumed from any action.
+        after_id: id of the action after which actions are read
+        codes: optional list of codes of actions to read
+        """
+        chunk_size = chunk_size or CONFIG.REPLAY_CHUNK_SIZE
+        while True:
+            with replay_session_ctx() as session:
+                query = session.query(Action.id, Action.code, Action.message).filter(
+                    Action.game_id == game_id, Action.id > after_id)
+                if codes is not None:
+                    query = query.filter(Action.code.in_(codes))
+                rows = query.order_by(Action.id).limit(chunk_size).all()
+            for row in rows:
+                yield {'idx': row.id, 'code': row.code, 'message': row.message}
+            if len(rows) < chunk_size:
+                return
+            after_id = rows[-1].id
+
 
 def generate_replay00(database: DbReplay, session: ReplaySession):
     """ Generates empty replay DB.
@@ -167,3 +436,15 @@ def generate_replay(_, replay_name=None):
             replay_generator(database, session)
             print("Replay '{}' has been generated.".format(current_replay))
     sys.exit(0)
+
+
+@task
+def explain_replay(_, game_id=1):
+    """ Migrates 'replay.db' and prints query plans of replay DB queries.
+    """
+    database = DbReplay()
+    database.migrate_db()
+    for name, plan in sorted(database.explain_queries(game_id).items()):
+        print("{}:".format(name))
+        for detail in plan:
+            print("    {}".format(detail))
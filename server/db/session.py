@@ -2,13 +2,29 @@
 """
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 
-from defs import MAP_DB_URI, REPLAY_DB_URI
+from defs import MAP_DB_URI, REPLAY_DB_URI, REPLAY_DB_PROFILE
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """ Applies PRAGMAs (sequence of (name, value)) to each new connection of SQLite engine.
+    """
+    if engine.url.get_backend_name() != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
 
 map_engine = create_engine(MAP_DB_URI)
 replay_engine = create_engine(REPLAY_DB_URI)
+set_sqlite_pragmas(replay_engine, REPLAY_DB_PROFILE)
 
 MapSession = sessionmaker(bind=map_engine)
 ReplaySession = sessionmaker(bind=replay_engine)
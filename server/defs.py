@@ -5,13 +5,35 @@ from os import getenv, path
 
 SERVER_PORT = int(getenv('WG_FORGE_SERVER_PORT', 2000))
 SERVER_ADDR = getenv('WG_FORGE_SERVER_ADDR', '0.0.0.0')
+SERVER_WORKERS = int(getenv('WG_FORGE_SERVER_WORKERS', 64))
+GAME_WORKERS = int(getenv('WG_FORGE_GAME_WORKERS', 8))
 MAP_DB_URI = getenv('MAP_DB_URI', 'sqlite:///' + path.join(path.dirname(path.realpath(__file__)), 'db/map.db'))
+MAP_SNAPSHOT_PATH = getenv('MAP_SNAPSHOT_PATH', path.join(path.dirname(path.realpath(__file__)), 'db/map.snapshot'))
 REPLAY_DB_URI = getenv('MAP_DB_URI', 'sqlite:///' + path.join(path.dirname(path.realpath(__file__)), 'db/replay.db'))
+# SQLite storage profile of replay DB, PRAGMAs applied to each connection:
+REPLAY_DB_PROFILE = (
+    ('journal_mode', getenv('WG_FORGE_REPLAY_JOURNAL_MODE', 'WAL')),
+    ('synchronous', getenv('WG_FORGE_REPLAY_SYNCHRONOUS', 'NORMAL')),
+    ('cache_size', int(getenv('WG_FORGE_REPLAY_CACHE_SIZE', -16000))),  # Negative value is size in KiB.
+)
 DB_URI = {
     'map': MAP_DB_URI,
     'replay': REPLAY_DB_URI,
 }
+METRICS_PORT = int(getenv('WG_FORGE_METRICS_PORT', 0))  # Port of HTTP endpoint of metrics, 0 - disabled.
 RECEIVE_CHUNK_SIZE = 1024
+# Max size of data of client action frame, connection which sends larger frame is closed:
+MAX_FRAME_SIZE = int(getenv('WG_FORGE_MAX_FRAME_SIZE', 1024 * 1024))
+# Max size of received data queued by connection, reading from the client is paused when it's exceeded:
+RECEIVE_BUFFER_LIMIT = int(getenv('WG_FORGE_RECEIVE_BUFFER_LIMIT', 256 * 1024))
+# Max number of frames pushed by server and not sent yet, connection of client which doesn't read them is closed:
+PUSH_QUEUE_SIZE = int(getenv('WG_FORGE_PUSH_QUEUE_SIZE', 64))
+LOG_LEVEL = getenv('WG_FORGE_LOG_LEVEL', 'INFO').upper()
+LOG_PAYLOAD_LIMIT = int(getenv('WG_FORGE_LOG_PAYLOAD_LIMIT', 512))  # Max logged length of command messages.
+LOG_FORMAT = getenv('WG_FORGE_LOG_FORMAT', 'text')  # 'text' or 'json' - JSON object per line.
+# Log records are written by background thread if size of the queue is not 0, the queue is bounded:
+LOG_QUEUE_SIZE = int(getenv('WG_FORGE_LOG_QUEUE_SIZE', 0))
+LOG_DROP_POLICY = getenv('WG_FORGE_LOG_DROP_POLICY', 'newest')  # Record dropped when the queue is full.
 
 
 class Action(IntEnum):
@@ -22,9 +44,14 @@ class Action(IntEnum):
     MOVE = 3
     UPGRADE = 4
     TURN = 5
+    SUBSCRIBE = 6
     MAP = 10
+    MAP_DELTA = 11
     OBSERVER = 100
     GAME = 101
+    GAMES = 103  # Observer's filtered and paginated list of games.
+    SPECTATE = 104  # Observer attaches to running game and receives its state after each tick.
+    METRICS = 105  # Latency and result statistics of actions executed by the server.
 
     # This actions are not available for client:
     EVENT = 102
@@ -38,5 +65,15 @@ class Result(IntEnum):
     RESOURCE_NOT_FOUND = 2
     ACCESS_DENIED = 5
     NOT_READY = 21
+    TICK_DONE = 100  # Server push: the game tick is done, is sent only to subscribed connections.
+    GAME_FINISHED = 101  # Server push: the game is finished, the last frame sent to subscribed connections.
     TIMEOUT = 258
     INTERNAL_SERVER_ERROR = 500
+
+
+class GameState(IntEnum):
+    """ Game states.
+    """
+    INIT = 1
+    RUN = 2
+    FINISHED = 3
@@ -0,0 +1,60 @@
+""" Encoders of response messages, the encoder is chosen by client on login.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:  # Optional dependency.
+    msgpack = None
+
+import errors
+
+
+def to_dict(obj):
+    return obj.__dict__
+
+
+class JsonEncoder(object):
+    """ Pretty-printed JSON, the default encoding.
+    """
+    name = 'json'
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data, default=to_dict, sort_keys=True, indent=4).encode('utf-8')
+
+
+class CompactJsonEncoder(object):
+    """ JSON without indentation and spaces.
+    """
+    name = 'compact'
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data, default=to_dict, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+class MsgpackEncoder(object):
+    """ MessagePack binary format, available if 'msgpack' package is installed.
+    """
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(data):
+        return msgpack.packb(data, default=to_dict)
+
+
+DEFAULT_ENCODER = JsonEncoder()
+
+ENCODERS = {e.name: e for e in (DEFAULT_ENCODER, CompactJsonEncoder())}
+if msgpack is not None:
+    ENCODERS[MsgpackEncoder.name] = MsgpackEncoder()
+
+
+def get_encoder(name):
+    """ Returns encoder by name.
+    raises: errors.BadCommand if the encoding is not supported
+    """
+    if name not in ENCODERS:
+        raise errors.BadCommand("Unknown encoding: {}, available encodings: {}".format(name, sorted(ENCODERS)))
+    return ENCODERS[name]
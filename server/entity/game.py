@@ -1,33 +1,31 @@
 """ Game entity.
 """
-import json
+import copy
 import math
 import random
-from enum import IntEnum
-from threading import Thread, Event, Lock, Condition
+import time
+from collections import defaultdict, deque
+from itertools import combinations, product
+from threading import Lock, Condition
 
 import errors
-from db.replay import DbReplay
-from defs import Action
+from db.replay import DbReplay, REPLAY_WRITER
+from defs import Action, GameState
+from encoders import DEFAULT_ENCODER
 from entity.event import EventType, Event as GameEvent
 from entity.map import Map
 from entity.player import Player
 from entity.point import Point
 from entity.post import PostType, Post
+from entity.snapshot import DynamicLayer
 from entity.train import Train
+from entity.train_table import TrainTable
 from game_config import CONFIG
 from logger import log
+from scheduler import SCHEDULER
 
 
-class GameState(IntEnum):
-    """ Game states.
-    """
-    INIT = 1
-    RUN = 2
-    FINISHED = 3
-
-
-class Game(Thread):
+class Game(object):
     """ game
         has:
           players - list of players on this game
@@ -42,11 +40,17 @@ class Game(Thread):
     # All registered games.
     GAMES = {}
 
-    def __init__(self, name, map_name=CONFIG.MAP_NAME, observed=False, num_players=1):
-        super(Game, self).__init__(name=name)
-        log(log.INFO, "Create game, name: '{}'".format(self.name))
+    def __init__(self, name, map_name=CONFIG.MAP_NAME, observed=False, num_players=1, seed=None, headless=False):
+        self.name = name
+        log(log.INFO, "Create game, name: '%s'", self.name)
         self.state = GameState.INIT
         self.observed = observed
+        # Headless game doesn't write replay and doesn't tick by itself, ticks are made by the owner of the game:
+        self.headless = headless
+        # Messages logged on each tick for each train, headless game logs them only at DEBUG level:
+        self.tick_log_level = log.DEBUG if headless else log.INFO
+        # Random numbers generator of the game, the game is deterministic if the seed is specified:
+        self.random = random.Random(seed)
         self.map = Map(map_name)
         self.num_players = num_players
         if self.num_players > len(self.map.towns):
@@ -54,20 +58,30 @@ class Game(Thread):
                 "Unable to create game with {} players, maximum players count is {}".format(
                     self.num_players, len(self.map.towns))
             )
-        self.replay = None if self.observed else DbReplay()
-        self.current_game_id = 0 if self.observed else self.replay.add_game(
+        self.replay = None if self.observed or self.headless else DbReplay(writer=REPLAY_WRITER)
+        self.current_game_id = 0 if self.replay is None else self.replay.add_game(
             name, map_name=self.map.name, num_players=num_players)
         self.current_tick = 0
         self.players = {}
-        self.name = name
         self.trains = {}
+        # Trains are views of rows of the table, if the table is enabled:
+        self.train_table = TrainTable(self.map) if CONFIG.TRAIN_TABLE_ENABLED else None
         self.next_train_moves = {}
-        self.event_cooldowns = CONFIG.EVENT_COOLDOWNS_ON_START
+        self.event_cooldowns = dict(CONFIG.EVENT_COOLDOWNS_ON_START)
+        # Version of the game state, is increased on each change of posts or trains:
+        self.state_version = 0
+        self.dynamic_layer = DynamicLayer(self.map)
+        # Changes of dynamic map layer per tick: (tick, indexes of changed posts, indexes of changed trains):
+        self.changes = deque(maxlen=CONFIG.MAP_DELTA_HISTORY)
+        self.changes_start_tick = 0  # The first tick for which changes are kept.
         self._lock = Lock()
-        self._stop_event = Event()
-        self._start_tick_event = Event()
+        self._next_tick_time = None
         self._done_tick_condition = Condition()
-        random.seed()
+        self._tick_callbacks = []
+        self._subscribers = []
+        self._spectators = []
+        # Full layer 1 delta encoded once per tick for all spectators: (tick, encoded delta):
+        self.published_layer = None
 
     @staticmethod
     def create(name, num_players=1):
@@ -81,10 +95,12 @@ class Game(Thread):
 
     @staticmethod
     def stop_all_games():
-        """ Stops all games. Uses on server shutdown.
+        """ Stops all games and waits until their replays are written. Uses on server shutdown.
         """
-        for game in Game.GAMES.values():
+        for game in list(Game.GAMES.values()):
             game.stop()
+        if not REPLAY_WRITER.flush():
+            log(log.ERROR, "Replays of the games are not completely written")
 
     def add_player(self, player: Player):
         """ Adds player to the game.
@@ -109,70 +125,185 @@ class Game(Thread):
                 # Add trains for the player:
                 for _ in range(CONFIG.TRAINS_COUNT):
                     # Create Train:
-                    train = Train(idx=len(self.trains) + 1)
+                    idx = len(self.trains) + 1
+                    train = Train(idx=idx) if self.train_table is None else self.train_table.add_train(idx)
                     # Add Train:
                     player.add_train(train)
                     self.map.add_train(train)
                     self.trains[train.idx] = train
                     # Put the Train into Town:
                     self.put_train_into_town(train, with_cooldown=False)
-                log(log.INFO, "Add new player to the game, player: {}".format(player))
+                self.state_version += 1
+                log(log.INFO, "Add new player to the game, player: %s", player)
 
-            # Start thread with game ticks:
-            if not self.observed and self.num_players == len(self.players):
-                Thread.start(self)
-                self.state = GameState.RUN
+            # Start game ticks:
+            if self.num_players == len(self.players):
+                if self.headless:
+                    self.state = GameState.RUN
+                elif not self.observed:
+                    self.start()
 
-    def turn(self, player: Player):
+    def turn(self, player: Player, callback=None, wait=True):
         """ Makes next turn.
+        Blocks until the next game tick is done, or, if callback is given,
+        returns immediately and the callback is called once the next game tick is done.
+        If 'wait' is False returns immediately.
         """
         if self.state != GameState.RUN:
             raise errors.NotReady("Game state is not 'RUN', state: {}".format(self.state))
+        if callback is not None or not wait:
+            with self._lock:
+                if callback is not None:
+                    self._tick_callbacks.append(callback)
+                self._set_turn_done(player)
+            return
         with self._done_tick_condition:
             with self._lock:
-                player.turn_done = True
-                all_ready_for_turn = all([p.turn_done for p in self.players.values()])
-                if all_ready_for_turn:
-                    self._start_tick_event.set()
+                self._set_turn_done(player)
             if not self._done_tick_condition.wait(CONFIG.TURN_TIMEOUT):
                 raise errors.Timeout("Game tick did not happen")
 
+    def subscribe(self, callback):
+        """ Subscribes to tick notifications, the callback is called with tick number after each game tick.
+        The callback is called from the game thread without the game lock held. When the game is stopped,
+        the callback is called the last time with 'finished=True' and the subscriber is removed.
+        """
+        with self._lock:
+            if callback not in self._subscribers:
+                self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """ Unsubscribes from tick notifications.
+        """
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def add_spectator(self, callback):
+        """ Adds spectator of the game, the callback is called with (tick, encoded layer) after each game tick.
+        The layer is full delta of layer 1 encoded once per tick for all spectators, the callback is called from
+        the game thread without the game lock held. When the game is stopped, the callback is called the last time
+        with 'finished=True' and the spectator is removed.
+        returns: the latest published layer: (tick, encoded layer)
+        """
+        with self._lock:
+            if callback not in self._spectators:
+                self._spectators.append(callback)
+            if self.published_layer is not None and self.published_layer[0] == self.current_tick:
+                return self.published_layer
+            tick, snapshot = self.current_tick, self.layer_snapshot()
+        return self.publish_layer(tick, snapshot)
+
+    def remove_spectator(self, callback):
+        """ Removes spectator of the game.
+        """
+        with self._lock:
+            if callback in self._spectators:
+                self._spectators.remove(callback)
+
+    def layer_snapshot(self):
+        """ Takes layer 1 of current tick for spectators. Must be called with the game lock held.
+        """
+        self.update_dynamic_layer()
+        return self.dynamic_layer.delta_snapshot(self.current_tick)
+
+    def publish_layer(self, tick, snapshot):
+        """ Encodes layer taken by layer_snapshot(), called without the game lock held.
+        returns: the latest published layer: (tick, encoded layer)
+        """
+        layer = (tick, self.dynamic_layer.encode_snapshot(snapshot))
+        with self._lock:
+            if self.published_layer is None or self.published_layer[0] < tick:
+                self.published_layer = layer
+            return self.published_layer
+
+    def _notify(self, subscribers, spectators, tick, published_layer, finished=False):
+        """ Calls subscribers and spectators after the game tick, removes ones which raise an exception.
+        """
+        kwargs = {'finished': True} if finished else {}
+        for subscriber in subscribers:
+            try:
+                subscriber(tick, **kwargs)
+            except Exception:
+                log(log.EXCEPTION, "Got unhandled exception on tick notification, subscriber removed")
+                self.unsubscribe(subscriber)
+        for spectator in spectators:
+            try:
+                spectator(*published_layer, **kwargs)
+            except Exception:
+                log(log.EXCEPTION, "Got unhandled exception on layer publishing, spectator removed")
+                self.remove_spectator(spectator)
+
+    def _set_turn_done(self, player: Player):
+        """ Marks player's turn as done, starts next tick if all players are ready.
+        """
+        player.turn_done = True
+        all_ready_for_turn = all([p.turn_done for p in self.players.values()])
+        if all_ready_for_turn:
+            self._schedule_tick(0)
+
+    def start(self):
+        """ Starts game ticks.
+        """
+        with self._lock:
+            self.state = GameState.RUN
+            self._schedule_tick(CONFIG.TICK_TIME)
+        if self.replay:
+            self.replay.set_game_state(GameState.RUN)
+
     def stop(self):
-        """ Stops ticks.
+        """ Stops ticks, notifies subscribers and spectators that the game is finished and removes them.
         """
-        log(log.INFO, "Game stopped, name: '{}'".format(self.name))
-        self.state = GameState.FINISHED
-        self._stop_event.set()
+        log(log.INFO, "Game stopped, name: '%s'", self.name)
+        with self._lock:
+            self.state = GameState.FINISHED
+            subscribers, self._subscribers = self._subscribers, []
+            spectators, self._spectators = self._spectators, []
+            tick = self.current_tick
+            snapshot = self.layer_snapshot() if spectators else None
         if self.name in Game.GAMES:
             del Game.GAMES[self.name]
+        if self.replay:
+            self.replay.set_game_state(GameState.FINISHED)  # Written by the replay writer with queued actions.
+        published_layer = None if snapshot is None else self.publish_layer(tick, snapshot)
+        self._notify(subscribers, spectators, tick, published_layer, finished=True)
 
-    def run(self):
-        """ Thread's activity. The loop with game ticks.
+    def _schedule_tick(self, delay):
+        """ Schedules next game tick after the delay (in seconds), replaces previously scheduled tick.
         """
-        # Create db connection object for this thread if replay.
-        replay = DbReplay() if self.replay else None
-        while not self._stop_event.is_set():
-            self._start_tick_event.wait(CONFIG.TICK_TIME)
-            with self._lock:
-                if self.state != GameState.RUN:
-                    break  # Finish game thread.
-                self.tick()
-                if self._start_tick_event.is_set():
-                    self._start_tick_event.clear()
-                for player in self.players.values():
-                    player.turn_done = False
-                with self._done_tick_condition:
-                    self._done_tick_condition.notify_all()
-                if replay:
-                    replay.add_action(
-                        Action.TURN, message=None, game_id=self.current_game_id
-                    )
+        self._next_tick_time = time.monotonic() + delay
+        SCHEDULER.schedule(self, self._next_tick_time)
+
+    def run_tick(self):
+        """ Makes game tick if it's due and schedules the next one. Called by the scheduler on a worker thread.
+        """
+        with self._lock:
+            if self.state != GameState.RUN or time.monotonic() < self._next_tick_time:
+                return  # The game is finished or the tick has been rescheduled.
+            self.tick()
+            for player in self.players.values():
+                player.turn_done = False
+            with self._done_tick_condition:
+                self._done_tick_condition.notify_all()
+            callbacks, self._tick_callbacks = self._tick_callbacks, []
+            for callback in callbacks:
+                callback()
+            if self.replay:
+                self.replay.add_action(
+                    Action.TURN, message=None, game_id=self.current_game_id
+                )
+            self._schedule_tick(CONFIG.TICK_TIME)
+            subscribers, tick = list(self._subscribers), self.current_tick
+            spectators = list(self._spectators)
+            snapshot = self.layer_snapshot() if spectators else None
+        published_layer = None if snapshot is None else self.publish_layer(tick, snapshot)
+        self._notify(subscribers, spectators, tick, published_layer)
 
     def tick(self):
         """ Makes game tick. Updates dynamic game entities.
         """
         self.current_tick += 1
-        log(log.INFO, "Game tick, tick number: {}, game id: {}".format(self.current_tick, self.current_game_id))
+        log(self.tick_log_level, "Game tick, tick number: %s, game id: %s", self.current_tick, self.current_game_id)
         self.update_cooldowns_on_tick()  # Update cooldowns in the beginning of the tick.
         self.update_posts_on_tick()
         self.update_trains_positions_on_tick()
@@ -182,19 +313,57 @@ class Game(Thread):
         self.refugees_arrival_on_tick()
         self.hijackers_assault_on_tick()
         self.parasites_assault_on_tick()
+        self.state_version += 1
+        if not self.headless:  # Headless game encodes the layer on request only.
+            self.update_dynamic_layer()
+
+    def save_state(self):
+        """ Returns copy of dynamic game state: posts, trains, scheduled moves, cooldowns and random generator state.
+        Static map data is shared between games and is not copied.
+        """
+        with self._lock:
+            return copy.deepcopy({
+                'tick': self.current_tick,
+                'posts': {idx: post.__dict__ for idx, post in self.map.post.items()},
+                'trains': {idx: train.__dict__ for idx, train in self.map.train.items()},
+                'next_train_moves': self.next_train_moves,
+                'event_cooldowns': self.event_cooldowns,
+                'random': self.random.getstate(),
+            })
+
+    def restore_state(self, state):
+        """ Restores dynamic game state saved by 'save_state', the state itself is kept unchanged.
+        Posts and trains are updated in place, so references to them from players and map stay valid.
+        """
+        state = copy.deepcopy(state)
+        with self._lock:
+            if state['trains'].keys() != self.map.train.keys():
+                raise errors.BadCommand("Saved state doesn't match trains of the game")
+            self.current_tick = state['tick']
+            for idx, post in self.map.post.items():
+                post.__dict__.update(state['posts'][idx])
+            for idx, train in self.map.train.items():
+                for key, value in state['trains'][idx].items():  # Train may be a view of the train table.
+                    setattr(train, key, value)
+            self.next_train_moves = state['next_train_moves']
+            self.event_cooldowns = state['event_cooldowns']
+            self.random.setstate(state['random'])
+            # Changes recorded before restoring aren't valid anymore, deltas are full until next ticks:
+            self.changes.clear()
+            self.changes_start_tick = self.current_tick + 1
+            self.state_version += 1
 
     def train_in_point(self, train: Train, point_id: int):
         """ Makes all needed actions when Train arrives to Point.
         Applies next Train move if it exist, processes Post if exist in the Point.
         """
-        msg = "Train is in point, train: {}, point: {}".format(train, self.map.point[point_id])
-
-        post_id = self.map.point[point_id].post_id
-        if post_id is not None:
-            msg += ", post: {!r}".format(self.map.post[post_id].type)
-            self.train_in_post(train, self.map.post[post_id])
-
-        log(log.INFO, msg)
+        point = self.map.point[point_id]
+        if point.post_id is not None:
+            post = self.map.post[point.post_id]
+            log(self.tick_log_level, "Train is in point, train: %s, point: %s, post: %r", train, point, post.type)
+            self.train_in_post(train, post)
+        else:
+            log(self.tick_log_level, "Train is in point, train: %s, point: %s", train, point)
 
         self.apply_next_train_move(train)
 
@@ -249,13 +418,11 @@ class Game(Thread):
                 if self.map.line[train.line_idx].length == train.position:
                     line_from = self.map.line[train.line_idx]
                     line_to = self.map.line[line_idx]
-                    if line_from.point[1] in line_to.point:
+                    position = self.map.line_position.get((line_idx, line_from.point[1]))
+                    if position is not None:
                         train.line_idx = line_idx
                         train.speed = speed
-                        if line_from.point[1] == line_to.point[0]:
-                            train.position = 0
-                        else:
-                            train.position = line_to.length
+                        train.position = position
                     else:
                         raise errors.BadCommand(
                             "The end of the train's line is not connected to the next line, "
@@ -265,13 +432,11 @@ class Game(Thread):
                 elif train.position == 0:
                     line_from = self.map.line[train.line_idx]
                     line_to = self.map.line[line_idx]
-                    if line_from.point[0] in line_to.point:
+                    position = self.map.line_position.get((line_idx, line_from.point[0]))
+                    if position is not None:
                         train.line_idx = line_idx
                         train.speed = speed
-                        if line_from.point[0] == line_to.point[0]:
-                            train.position = 0
-                        else:
-                            train.position = line_to.length
+                        train.position = position
                     else:
                         raise errors.BadCommand(
                             "The beginning of the train's line is not connected to the next line, "
@@ -309,6 +474,8 @@ class Game(Thread):
                         "train's speed: {}, new speed: {}".format(line_from, line_to, train.speed, speed)
                     )
 
+            self.state_version += 1  # Rejected move doesn't change the state.
+
     def train_in_post(self, train: Train, post: Post):
         """ Makes all needed actions when Train arrives to Post.
         Behavior depends on PostType, train can be loaded or unloaded.
@@ -359,13 +526,9 @@ class Game(Thread):
         # Get Train owner's home point:
         player_home_point = self.players[train.player_id].home
         # Use first Line connected to the home point as default train's line:
-        line = [l for l in self.map.line.values() if player_home_point.idx in l.point][0]
-        train.line_idx = line.idx
+        train.line_idx = self.map.point_lines[player_home_point.idx][0]
         # Set Train's position at the Town:
-        if player_home_point.idx == line.point[0]:
-            train.position = 0
-        else:
-            train.position = line.length
+        train.position = self.map.line_position[train.line_idx, player_home_point.idx]
         # Stop Train:
         train.speed = 0
         # Unload the Train:
@@ -385,10 +548,10 @@ class Game(Thread):
         if self.event_cooldowns.get(EventType.HIJACKERS_ASSAULT, 0) > 0:
             return
 
-        rand_percent = random.randint(1, 100)
+        rand_percent = self.random.randint(1, 100)
         if rand_percent <= CONFIG.HIJACKERS_ASSAULT_PROBABILITY:
-            hijackers_power = random.randint(*CONFIG.HIJACKERS_POWER_RANGE)
-            log(log.INFO, "Hijackers assault happened, hijackers power: {}".format(hijackers_power))
+            hijackers_power = self.random.randint(*CONFIG.HIJACKERS_POWER_RANGE)
+            log(log.INFO, "Hijackers assault happened, hijackers power: %s", hijackers_power)
             event = GameEvent(EventType.HIJACKERS_ASSAULT, self.current_tick, hijackers_power=hijackers_power)
             for player in self.players.values():
                 player.town.population = max(player.town.population - max(hijackers_power - player.town.armor, 0), 0)
@@ -406,10 +569,10 @@ class Game(Thread):
         if self.event_cooldowns.get(EventType.PARASITES_ASSAULT, 0) > 0:
             return
 
-        rand_percent = random.randint(1, 100)
+        rand_percent = self.random.randint(1, 100)
         if rand_percent <= CONFIG.PARASITES_ASSAULT_PROBABILITY:
-            parasites_power = random.randint(*CONFIG.PARASITES_POWER_RANGE)
-            log(log.INFO, "Parasites assault happened, parasites power: {}".format(parasites_power))
+            parasites_power = self.random.randint(*CONFIG.PARASITES_POWER_RANGE)
+            log(log.INFO, "Parasites assault happened, parasites power: %s", parasites_power)
             event = GameEvent(EventType.PARASITES_ASSAULT, self.current_tick, parasites_power=parasites_power)
             for player in self.players.values():
                 player.town.product = max(player.town.product - parasites_power, 0)
@@ -426,10 +589,10 @@ class Game(Thread):
         if self.event_cooldowns.get(EventType.REFUGEES_ARRIVAL, 0) > 0:
             return
 
-        rand_percent = random.randint(1, 100)
+        rand_percent = self.random.randint(1, 100)
         if rand_percent <= CONFIG.REFUGEES_ARRIVAL_PROBABILITY:
-            refugees_number = random.randint(*CONFIG.REFUGEES_NUMBER_RANGE)
-            log(log.INFO, "Refugees arrival happened, refugees number: {}".format(refugees_number))
+            refugees_number = self.random.randint(*CONFIG.REFUGEES_NUMBER_RANGE)
+            log(log.INFO, "Refugees arrival happened, refugees number: %s", refugees_number)
             event = GameEvent(EventType.REFUGEES_ARRIVAL, self.current_tick, refugees_number=refugees_number)
             for player in self.players.values():
                 player.town.population += max(
@@ -458,6 +621,12 @@ class Game(Thread):
     def update_trains_positions_on_tick(self):
         """ Update trains positions.
         """
+        if self.train_table is not None:
+            if CONFIG.FUEL_ENABLED:
+                for train in self.train_table.consume_fuel():
+                    self.put_train_into_town(train, with_unload=True, with_cooldown=True)
+            self.train_table.move()
+            return
         for train in self.trains.values():
             if CONFIG.FUEL_ENABLED and train.speed != 0:
                 train.fuel -= train.fuel_consumption
@@ -472,7 +641,8 @@ class Game(Thread):
     def process_trains_points_on_tick(self):
         """ Update trains positions, process points.
         """
-        for train in self.trains.values():
+        trains = self.trains.values() if self.train_table is None else self.train_table.trains_at_points()
+        for train in trains:
             line = self.map.line[train.line_idx]
             if train.position == line.length or train.position == 0:
                 self.train_in_point(train, line.point[self.get_sign(train.position)])
@@ -524,55 +694,81 @@ class Game(Thread):
     def make_collision(self, train_1: Train, train_2: Train):
         """ Makes collision between two trains.
         """
-        log(log.INFO, "Trains collision happened, trains: [{}, {}]".format(train_1, train_2))
+        log(log.INFO, "Trains collision happened, trains: [%s, %s]", train_1, train_2)
         self.put_train_into_town(train_1, with_unload=True, with_cooldown=True)
         self.put_train_into_town(train_2, with_unload=True, with_cooldown=True)
         train_1.event.append(GameEvent(EventType.TRAIN_COLLISION, self.current_tick, train=train_2.idx))
         train_2.event.append(GameEvent(EventType.TRAIN_COLLISION, self.current_tick, train=train_1.idx))
 
+    def is_collision(self, train_1: Train, train_2: Train, point_1, point_2):
+        """ Returns True if given Trains collide, 'point_1' and 'point_2' are results of 'is_train_at_point'.
+        """
+        # If train_1 and train_2 at the same Point:
+        if point_1 and point_2 and point_1.idx == point_2.idx:
+            post = None if point_1.post_id is None else self.map.post[point_1.post_id]
+            return post is None or post.type not in (PostType.TOWN, )
+        # If train_1 and train_2 on the same Line:
+        if train_1.line_idx == train_2.line_idx:
+            # If train_1 and train_2 have the same position:
+            if train_1.position == train_2.position:
+                return True
+            # Skip if train_1 or train_2 has been stopped and they have different positions:
+            if train_1.speed == 0 or train_2.speed == 0:
+                return False
+            # Calculating distance between train_1 and train_2 now and after next tick:
+            train_step_1 = self.get_sign(train_1.speed)
+            train_step_2 = self.get_sign(train_2.speed)
+            dist_before_tick = math.fabs(train_1.position - train_2.position)
+            dist_after_tick = math.fabs(train_1.position + train_step_1 - train_2.position + train_step_2)
+            # If after next tick train_1 and train_2 cross:
+            return dist_before_tick == dist_after_tick == 1 and train_step_1 + train_step_2 == 0
+        return False
+
+    def get_collision_pairs(self):
+        """ Returns list of pairs of colliding Trains in order of the Trains in the game.
+        Trains are bucketed by Point and by Line position, only Trains from the same Point, from the same
+        position in the middle of a Line and moving towards each other from adjacent positions can collide,
+        so the pairs are found in linear time plus the number of candidate pairs.
+        """
+        trains = list(self.trains.values())
+        points = [self.is_train_at_point(t) for t in trains]
+        at_point = defaultdict(list)  # Point index: train numbers.
+        on_line = defaultdict(lambda: defaultdict(list))  # Line index: position: train numbers.
+        for number, (train, point) in enumerate(zip(trains, points)):
+            if point:
+                at_point[point.idx].append(number)
+            on_line[train.line_idx][train.position].append(number)
+
+        candidates = set()
+        for point_idx, numbers in at_point.items():
+            post_id = self.map.point[point_idx].post_id
+            if post_id is None or self.map.post[post_id].type not in (PostType.TOWN, ):
+                candidates.update(combinations(numbers, 2))
+        for line_idx, positions in on_line.items():
+            line_length = self.map.line[line_idx].length
+            for position, numbers in positions.items():
+                if 0 < position < line_length:  # Trains at the ends of the Line are at Points.
+                    candidates.update(combinations(numbers, 2))
+                next_numbers = positions.get(position + 1)
+                if next_numbers:
+                    candidates.update(
+                        (number_1, number_2) if number_1 < number_2 else (number_2, number_1)
+                        for number_1, number_2 in product(numbers, next_numbers)
+                        if trains[number_1].speed * trains[number_2].speed < 0
+                    )
+
+        return [
+            (trains[number_1], trains[number_2]) for number_1, number_2 in sorted(candidates)
+            if self.is_collision(trains[number_1], trains[number_2], points[number_1], points[number_2])
+        ]
+
     def handle_trains_collisions_on_tick(self):
         """ Handles Trains collisions.
         """
         if not CONFIG.COLLISIONS_ENABLED:
             return
 
-        collision_pairs = []
-        trains = list(self.trains.values())
-        for i, train_1 in enumerate(trains):
-            # Get Line and Point of train_1:
-            line_1 = self.map.line[train_1.line_idx]
-            point_1 = self.is_train_at_point(train_1)
-            for train_2 in trains[i + 1:]:
-                # Get Line and Point of train_2:
-                line_2 = self.map.line[train_2.line_idx]
-                point_2 = self.is_train_at_point(train_2)
-                # If train_1 and train_2 at the same Point:
-                if point_1 and point_2 and point_1.idx == point_2.idx:
-                    post = None if point_1.post_id is None else self.map.post[point_1.post_id]
-                    if post is not None and post.type in (PostType.TOWN, ):
-                        continue
-                    else:
-                        collision_pairs.append((train_1, train_2))
-                        continue
-                # If train_1 and train_2 on the same Line:
-                if line_1.idx == line_2.idx:
-                    # If train_1 and train_2 have the same position:
-                    if train_1.position == train_2.position:
-                        collision_pairs.append((train_1, train_2))
-                        continue
-                    # Skip if train_1 or train_2 has been stopped and they have different positions:
-                    if train_1.speed == 0 or train_2.speed == 0:
-                        continue
-                    # Calculating distance between train_1 and train_2 now and after next tick:
-                    train_step_1 = self.get_sign(train_1.speed)
-                    train_step_2 = self.get_sign(train_2.speed)
-                    dist_before_tick = math.fabs(train_1.position - train_2.position)
-                    dist_after_tick = math.fabs(train_1.position + train_step_1 - train_2.position + train_step_2)
-                    # If after next tick train_1 and train_2 cross:
-                    if dist_before_tick == dist_after_tick == 1 and train_step_1 + train_step_2 == 0:
-                        collision_pairs.append((train_1, train_2))
-                        continue
-        for pair in collision_pairs:
+        for pair in self.get_collision_pairs():
             self.make_collision(*pair)
 
     def make_upgrade(self, player: Player, post_ids=(), train_ids=()):
@@ -623,38 +819,83 @@ class Game(Thread):
                     raise errors.BadCommand("The train is not in Town now, train: {}".format(train))
 
             # Upgrade entities:
+            self.state_version += 1
             for post in posts:
                 player.town.armor -= post.next_level_price
                 post.set_level(post.level + 1)
-                log(log.INFO, "Post has been upgraded, post: {}".format(post))
+                log(log.INFO, "Post has been upgraded, post: %s", post)
             for train in trains:
                 player.town.armor -= train.next_level_price
                 train.set_level(train.level + 1)
-                log(log.INFO, "Train has been upgraded, post: {}".format(train))
+                log(log.INFO, "Train has been upgraded, post: %s", train)
 
-    def get_map_layer(self, player, layer):
+    def get_map_layer(self, player, layer, encoder=DEFAULT_ENCODER):
         """ Returns specified game map layer.
         """
         if layer not in (0, 1, 10):
             raise errors.ResourceNotFound("Map layer not found, layer: {}".format(layer))
 
-        log(log.INFO, "Load game map layer, layer: {}".format(layer))
-        message = self.map.layer_to_json_str(layer)
-        if layer == 1:  # Add ratings. TODO: Improve this code.
-            data = json.loads(message)
-            rating = {}
-            for _player in self.players.values():
-                rating[_player.idx] = {
-                    'rating': _player.rating,
-                    'name': _player.name,
-                    'idx': _player.idx
-                }
-            data['rating'] = rating
-            message = json.dumps(data, sort_keys=True, indent=4)
+        log(log.INFO, "Load game map layer, layer: %s", layer)
+        if layer in Map.STATIC_LAYERS:
+            return self.map.layer_to_bytes(layer, encoder)
+        with self._lock:
+            self.update_dynamic_layer()
+            message = self.dynamic_layer.to_bytes(encoder)
             if not self.observed:
                 self.clean_user_events(player)
         return message
 
+    def get_map_delta(self, player, tick, encoder=DEFAULT_ENCODER):
+        """ Returns posts and trains of dynamic map layer which have been changed since specified tick.
+        The whole layer is returned if changes for the tick are not kept anymore.
+        """
+        if not isinstance(tick, int) or isinstance(tick, bool):
+            raise errors.BadCommand("Tick must be an integer, tick: {}".format(tick))
+
+        log(log.INFO, "Load game map delta, tick: %s", tick)
+        with self._lock:
+            self.update_dynamic_layer()
+            if self.changes_start_tick <= tick <= self.current_tick:
+                post_ids, train_ids = set(), set()
+                for changes_tick, posts, trains in self.changes:
+                    if changes_tick >= tick:
+                        post_ids.update(posts)
+                        train_ids.update(trains)
+                message = self.dynamic_layer.delta_to_bytes(self.current_tick, post_ids, train_ids, encoder)
+            else:
+                message = self.dynamic_layer.delta_to_bytes(self.current_tick, encoder=encoder)
+            if not self.observed:
+                self.clean_user_events(player)
+        return message
+
+    def update_dynamic_layer(self):
+        """ Updates snapshot of dynamic map layer if game state has been changed, records changes of current tick.
+        returns: tuple (indexes of changed posts, indexes of changed trains)
+        """
+        if self.dynamic_layer.version == self.state_version:
+            return [], []
+        changed_posts, changed_trains = self.dynamic_layer.update(self.state_version, self.get_rating())
+        if self.changes and self.changes[-1][0] == self.current_tick:
+            self.changes[-1][1].update(changed_posts)
+            self.changes[-1][2].update(changed_trains)
+        else:
+            if len(self.changes) == self.changes.maxlen:
+                self.changes_start_tick = self.changes[0][0] + 1
+            self.changes.append((self.current_tick, set(changed_posts), set(changed_trains)))
+        return changed_posts, changed_trains
+
+    def get_rating(self):
+        """ Returns ratings of all players.
+        """
+        rating = {}
+        for player in self.players.values():
+            rating[player.idx] = {
+                'rating': player.rating,
+                'name': player.name,
+                'idx': player.idx
+            }
+        return rating
+
     def clean_user_events(self, player):
         """ Cleans all existing events.
         """
@@ -674,9 +915,12 @@ class Game(Thread):
                 self.event_cooldowns[event] = max(self.event_cooldowns[event] - 1, 0)
 
         # Update cooldowns for trains:
+        if self.train_table is not None:
+            self.train_table.update_cooldowns()
+            return
         for train in self.trains.values():
             if train.cooldown != 0:
                 train.cooldown = max(train.cooldown - 1, 0)
 
     def __del__(self):
-        log(log.INFO, "Game deleted, name: '{}'".format(self.name))
+        log(log.INFO, "Game deleted, name: '%s'", self.name)
@@ -1,20 +1,138 @@
 """ Game map entity.
 """
 import json
+import os
 
 from sqlalchemy import func
 
 from db.models import Map as MapModel, Line as LineModel, Point as PointModel, Post as PostModel
-from db.session import map_session_ctx
+from db.map_snapshot import SnapshotError, read_snapshot
+from db.session import map_engine, map_session_ctx
+from defs import MAP_SNAPSHOT_PATH
+from encoders import DEFAULT_ENCODER
 from entity.line import Line
 from entity.point import Point
 from entity.post import Post, PostType
 from entity.train import Train
+from logger import log
+
+
+def build_point_lines(lines):
+    """ Returns indexes of lines incident to the point by point index, lines are ordered as given lines.
+    """
+    point_lines = {}
+    for line in lines:
+        for point_idx in line.point:
+            lines_of_point = point_lines.setdefault(point_idx, [])
+            if not lines_of_point or lines_of_point[-1] != line.idx:
+                lines_of_point.append(line.idx)
+    return point_lines
+
+
+def build_line_position(lines):
+    """ Returns position of the point on the line by (line index, point index).
+    """
+    line_position = {}
+    for line in lines:
+        line_position.setdefault((line.idx, line.point[0]), 0)
+        line_position.setdefault((line.idx, line.point[1]), line.length)
+    return line_position
+
+
+def _file_stamp(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def map_db_stamp():
+    """ Returns stamp of the map DB file which is changed when the DB is written, None if the DB is not a file.
+    """
+    database = map_engine.url.database
+    if map_engine.url.get_backend_name() != 'sqlite' or not database or database == ':memory:':
+        return None
+    return _file_stamp(database), _file_stamp(database + '-wal')
+
+
+def load_map_data(name, use_snapshot=True):
+    """ Loads the map from compiled snapshot of map DB if the snapshot is up to date, otherwise from map DB.
+    returns: dict of the map in format of 'map_snapshot.write_snapshot', 'point_lines' may be absent
+    """
+    if use_snapshot and os.path.exists(MAP_SNAPSHOT_PATH):
+        try:
+            db_stamp, map_data = read_snapshot(MAP_SNAPSHOT_PATH, name)
+        except (OSError, SnapshotError) as err:
+            log(log.WARNING, "Map snapshot is not loaded, path: '%s', error: %s", MAP_SNAPSHOT_PATH, err)
+        else:
+            current_db_stamp = map_db_stamp()
+            db_missing = current_db_stamp is not None and current_db_stamp[0] is None
+            if (db_missing or db_stamp == current_db_stamp) and map_data is not None:
+                return map_data
+
+    with map_session_ctx() as session:
+        _map = session.query(MapModel).filter(MapModel.name == name).first()
+        lines = _map.lines.order_by(LineModel.id).all()
+        points = session.query(PointModel, func.max(PostModel.id)).outerjoin(
+            PostModel, PointModel.id == PostModel.point_id).filter(PointModel.map_id == _map.id).group_by(
+            PointModel.id).order_by(PointModel.id).all()
+        posts = _map.posts.order_by(PostModel.id).all()
+        return {
+            'name': name,
+            'idx': _map.id,
+            'size': (_map.size_x, _map.size_y),
+            'line': [(l.id, l.len, l.p0, l.p1) for l in lines],
+            'point': [(p.id, post_id, p.x, p.y) for p, post_id in points],
+            'post': [(p.id, p.type, p.population, p.armor, p.product, p.replenishment, p.point_id) for p in posts],
+            'post_name': [p.name for p in posts],
+        }
+
+
+class MapTemplate(object):
+    """ Static part of the map loaded once and shared by all games on the map.
+    Lines, points, coordinates and indexes of the template must not be changed,
+    posts are kept as rows to create new Post objects for each game.
+    """
+    def __init__(self, data):
+        self.idx = data['idx']
+        self.size = data['size']
+        self.line = {idx: Line(idx, length, p0, p1) for idx, length, p0, p1 in data['line']}
+        self.point = {idx: Point(idx, post_id=post_id) for idx, post_id, _, _ in data['point']}
+        self.coordinate = {idx: {'idx': idx, 'x': x, 'y': y} for idx, _, x, y in data['point']}
+        self.posts = [(name, ) + row for name, row in zip(data['post_name'], data['post'])]
+
+        self.point_lines = data.get('point_lines') or build_point_lines(self.line.values())
+        self.line_position = build_line_position(self.line.values())
+        self.fingerprint = hash((
+            self.idx, self.size,
+            tuple((l.idx, l.length, l.point) for l in self.line.values()),
+            tuple((p.idx, p.post_id) for p in self.point.values()),
+            tuple((c['idx'], c['x'], c['y']) for c in self.coordinate.values()),
+        ))
+
+    def create_posts(self):
+        """ Returns new Post objects of the map.
+        """
+        return {
+            idx: Post(
+                idx, name, post_type, population, armor, product, replenishment=replenishment, point_id=point_id
+            ) for name, idx, post_type, population, armor, product, replenishment, point_id in self.posts
+        }
 
 
 class Map(object):
     """ Map of game space.
     """
+
+    # Layers which are not changed during the game:
+    STATIC_LAYERS = (0, 10)
+    # Encoded static layers shared by all games on the map,
+    # key: (map name, layer, encoding), value: (map fingerprint, bytes).
+    STATIC_LAYERS_CACHE = {}
+    # Templates of maps, key: map name, value: ((map DB stamp, map snapshot stamp), MapTemplate).
+    TEMPLATES = {}
+
     def __init__(self, name=None):
         self.name = name
         self.idx = None
@@ -27,43 +145,59 @@ class Map(object):
 
         # Attributes not included into json representation:
         self.okey = False
+        self.fingerprint = None
         self.markets = []
         self.storages = []
         self.towns = []
+        self.point_lines = {}  # Indexes of lines incident to the point, key: point index.
+        self.line_position = {}  # Position of the point on the line, key: (line index, point index).
 
         if self.name is not None:
             self.init_map()
 
     def init_map(self):
-        with map_session_ctx() as session:
-            _map = session.query(MapModel).filter(MapModel.name == self.name).first()
-            self.idx = _map.id
-            self.size = (_map.size_x, _map.size_y)
-
-            lines = _map.lines.order_by(LineModel.id).all()
-            self.line = {l.id: Line(l.id, l.len, l.p0, l.p1) for l in lines}
-
-            points = session.query(PointModel, func.max(PostModel.id)).outerjoin(
-                PostModel, PointModel.id == PostModel.point_id).filter(PointModel.map_id == _map.id).group_by(
-                PointModel.id).order_by(PointModel.id).all()
-            for point, post_id in points:
-                self.coordinate[point.id] = {'idx': point.id, 'x': point.x, 'y': point.y}
-                self.point[point.id] = Point(point.id, post_id=post_id)
-
-            posts = _map.posts.order_by(PostModel.id).all()
-            self.post = {
-                p.id: Post(
-                    p.id, p.name, p.type, p.population, p.armor, p.product,
-                    replenishment=p.replenishment, point_id=p.point_id
-                ) for p in posts
-            }
+        """ Initializes the map from its template, the template is loaded if map DB or its snapshot has been changed.
+        """
+        stamp = (map_db_stamp(), _file_stamp(MAP_SNAPSHOT_PATH))
+        cached = Map.TEMPLATES.get(self.name)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, MapTemplate(load_map_data(self.name)))
+            Map.TEMPLATES[self.name] = cached
+        template = cached[1]
 
-            self.markets = [m for m in self.post.values() if m.type == PostType.MARKET]
-            self.storages = [s for s in self.post.values() if s.type == PostType.STORAGE]
-            self.towns = [t for t in self.post.values() if t.type == PostType.TOWN]
+        self.idx = template.idx
+        self.size = template.size
+        self.line = template.line
+        self.point = template.point
+        self.coordinate = template.coordinate
+        self.post = template.create_posts()
+        self.point_lines = template.point_lines
+        self.line_position = template.line_position
+        self.fingerprint = template.fingerprint
 
+        self.markets = [m for m in self.post.values() if m.type == PostType.MARKET]
+        self.storages = [s for s in self.post.values() if s.type == PostType.STORAGE]
+        self.towns = [t for t in self.post.values() if t.type == PostType.TOWN]
         self.okey = True
 
+    def init_adjacency(self):
+        """ Builds indexes of lines by their points.
+        """
+        self.point_lines = build_point_lines(self.line.values())
+        self.line_position = build_line_position(self.line.values())
+
+    @staticmethod
+    def invalidate_cache(name=None):
+        """ Drops cached template and static layers of the map, or of all maps if name is not given.
+        """
+        if name is None:
+            Map.TEMPLATES.clear()
+            Map.STATIC_LAYERS_CACHE.clear()
+        else:
+            Map.TEMPLATES.pop(name, None)
+            for key in [k for k in Map.STATIC_LAYERS_CACHE if k[0] == name]:
+                Map.STATIC_LAYERS_CACHE.pop(key, None)
+
     def add_train(self, train):
         self.train[train.idx] = train
 
@@ -77,6 +211,7 @@ class Map(object):
             self.size = tuple(data['size'])
         if data.get('line'):
             self.line = {l['idx']: Line(l['idx'], l['length'], l['point'][0], l['point'][1]) for l in data['line']}
+            self.init_adjacency()
         if data.get('point'):
             self.point = {p['idx']: Point(p['idx'], post_id=p.get('post_id', None)) for p in data['point']}
         if data.get('post'):
@@ -101,6 +236,9 @@ class Map(object):
         self.okey = True
 
     def layer_to_json_str(self, layer):
+        return json.dumps(self.layer_to_dict(layer), default=lambda o: o.__dict__, sort_keys=True, indent=4)
+
+    def layer_to_dict(self, layer):
         data = {}
         choice_list = ()
         if layer == 0:
@@ -116,7 +254,19 @@ class Map(object):
                     data[key] = [i for i in attribute.values()]
                 else:
                     data[key] = attribute
-        return json.dumps(data, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        return data
+
+    def layer_to_bytes(self, layer, encoder=DEFAULT_ENCODER):
+        """ Returns encoded layer, static layers of maps loaded from DB are encoded once per map and encoding.
+        """
+        if layer not in self.STATIC_LAYERS or self.fingerprint is None:
+            return encoder.encode(self.layer_to_dict(layer))
+        key = (self.name, layer, encoder.name)
+        cached = Map.STATIC_LAYERS_CACHE.get(key)
+        if cached is None or cached[0] != self.fingerprint:  # Not cached yet or the map has been regenerated.
+            cached = (self.fingerprint, encoder.encode(self.layer_to_dict(layer)))
+            Map.STATIC_LAYERS_CACHE[key] = cached
+        return cached[1]
 
     def __repr__(self):
         return "<Map(idx={}, name={}, line_idx=[{}], point_idx=[{}], post_idx=[{}], train_idx=[{}])>".format(
@@ -1,11 +1,17 @@
 """ Observer Entity. Creates when to server connects Observer-Client for watch replay(s).
 """
 import json
+import pickle
+import uuid
+from datetime import datetime
 
-from db.replay import DbReplay
+import errors
+from db.replay import DbReplay, TIME_FORMAT
 from defs import Action, Result
 from entity.game import Game
 from entity.player import Player
+from entity.replay_log import REPLAY_CACHE
+from game_config import CONFIG
 from logger import log
 
 
@@ -15,10 +21,16 @@ class Observer(object):
 
     PLAYER_NAME = '-=Observer=-'
 
-    def __init__(self):
+    def __init__(self, push=None):
         self._db = DbReplay()
+        # Sends frame pushed by the server to observer's client without blocking: push(result, message, replace),
+        # frames which are not sent yet are dropped if 'replace' is True:
+        self._push = push
         self._game = None
-        self._actions = []
+        self._live_game = None  # Running game which is spectated.
+        self._live_layer = None
+        self._log = None  # Replay log of the game, may be shared with other observers.
+        self._actions = iter(())  # Stream of actions which are not played yet.
         self._map_name = None
         self._game_name = None
         self._current_turn = 0
@@ -26,21 +38,44 @@ class Observer(object):
         self._max_turn = 0
         self.num_players = 0
 
-    def games(self):
+    def games(self, data=None):
         """ Retrieves list of games.
+        data: optional filters: 'map' - map name, 'name' - part of game name, 'date_from', 'date_to' - dates in
+            TIME_FORMAT, and pagination: 'offset', 'limit'
         """
-        return self._db.get_all_games()
+        data = data or {}
+        filters = {'map_name': data.get('map'), 'name': data.get('name')}
+        for key in ('date_from', 'date_to'):
+            try:
+                filters[key] = None if data.get(key) is None else datetime.strptime(data[key], TIME_FORMAT)
+            except (TypeError, ValueError):
+                raise errors.BadCommand("Wrong date format, key: '{}', expected: '{}'".format(key, TIME_FORMAT))
+        for key in ('offset', 'limit'):
+            value = data.get(key)
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise errors.BadCommand("Wrong value, key: '{}', expected non-negative integer".format(key))
+            filters[key] = value
+        return self._db.get_all_games(**filters)
 
     def reset_game(self):
         """ Resets the game to initial state.
         """
         self._game = Game(self._game_name, self._map_name, num_players=self.num_players, observed=True)
-        for action in self._actions:
-            if action['code'] == Action.LOGIN:
-                data = json.loads(action['message'])
-                self._game.add_player(Player.create(data['name']))
+        for _, _, data in self._log.iter_actions(codes=[Action.LOGIN]):
+            # Players of observed game are not registered, their ids are the same for all observers of the game:
+            idx = str(uuid.uuid5(uuid.NAMESPACE_OID, '{}/{}'.format(self._log.game_id, data['name'])))
+            self._game.add_player(Player(data['name'], idx=idx))
+        self._actions = self._log.iter_actions()
         self._current_turn = 0
         self._current_action = 0
+        self._log.add_checkpoint(0, 0, self._game.save_state())
+
+    def restore_checkpoint(self, checkpoint):
+        """ Restores the game state saved in the checkpoint.
+        """
+        self._current_turn, self._current_action, state = checkpoint
+        self._game.restore_state(pickle.loads(state))
+        self._actions = self._log.iter_actions(after_id=self._current_action)
 
     def action(self, action, data):
         """ Interprets observer's actions.
@@ -51,12 +86,15 @@ class Observer(object):
         return Result.BAD_COMMAND, None
 
     def _on_get_map(self, data):
-        if self._game is None:
+        if self._live_game is not None and data.get('layer') == 1:
+            return Result.OKEY, self._live_layer  # Doesn't wait for the lock of running game.
+        game = self._game or self._live_game
+        if game is None:
             return Result.RESOURCE_NOT_FOUND, None
         if 'layer' in data:
             player = None
             layer = data['layer']
-            return Result.OKEY, self._game.get_map_layer(player, layer)
+            return Result.OKEY, game.get_map_layer(player, layer)
         return Result.BAD_COMMAND, None
 
     def game_turn(self, turns):
@@ -64,23 +102,24 @@ class Observer(object):
         """
         assert turns > 0
         sub_turn = 0
-        for action in self._actions[self._current_action:]:
-            self._current_action += 1
-            if action['code'] == Action.MOVE:
+        for self._current_action, code, data in self._actions:
+            if code == Action.MOVE:
                 player = None
-                data = json.loads(action['message'])
                 self._game.move_train(player, data['train_idx'], data['speed'], data['line_idx'])
-            elif action['code'] == Action.TURN:
+            elif code == Action.TURN:
                 self._game.tick()
                 sub_turn += 1
                 self._current_turn += 1
+                if (self._current_turn % CONFIG.OBSERVER_CHECKPOINT_INTERVAL == 0 and
+                        not self._log.has_checkpoint(self._current_turn)):
+                    self._log.add_checkpoint(self._current_turn, self._current_action, self._game.save_state())
             if sub_turn >= turns:
                 break
 
     def _on_turn(self, data):
         if self._game is None:
             return Result.BAD_COMMAND, None
-        if not self._actions:
+        if not self._log.has_actions:
             return Result.RESOURCE_NOT_FOUND, None
         if 'idx' not in data:
             return Result.BAD_COMMAND, None
@@ -94,13 +133,13 @@ class Observer(object):
         if turn == self._current_turn:
             return Result.OKEY, None
 
+        # Seek from the nearest checkpoint, if it's closer than current turn, and play only remaining turns:
+        checkpoint = self._log.get_checkpoint(turn)
+        if turn < self._current_turn or checkpoint[0] > self._current_turn:
+            self.restore_checkpoint(checkpoint)
         delta_turn = turn - self._current_turn
         if delta_turn > 0:
             self.game_turn(delta_turn)
-        elif delta_turn < 0:
-            self.reset_game()
-            if turn > 0:
-                self.game_turn(turn)
 
         self._current_turn = turn
 
@@ -109,29 +148,64 @@ class Observer(object):
     def _on_game(self, data):
         if 'idx' not in data:
             return Result.BAD_COMMAND, None
+        self.stop_spectating()
         self._game = None
         game_id = data['idx']
-        for game in self._db.get_all_games():
-            if game['idx'] == game_id:
-                game_name = game['name']
-                self._game_name = game_name
-                self.num_players = game['num_players']
-                self._map_name = game['map']
-                log(log.INFO, "Observer selected game: {}".format(game_name))
-                self._actions = self._db.get_all_actions(game_id)
-                self.reset_game()
-                self._max_turn = game['length']
-                break
-        if self._game is None:
+        game = self._db.get_game(game_id)
+        if game is None:
             return Result.RESOURCE_NOT_FOUND, None
+        self._game_name = game['name']
+        self.num_players = game['num_players']
+        self._map_name = game['map']
+        log(log.INFO, "Observer selected game: %s", game['name'])
+        self._log = REPLAY_CACHE.get(self._db, game)
+        self.reset_game()
+        self._max_turn = game['length']
         return Result.OKEY, None
 
+    def _on_spectate(self, data):
+        if 'game' not in data:
+            return Result.BAD_COMMAND, None
+        game = Game.GAMES.get(data['game'])
+        if game is None:
+            return Result.RESOURCE_NOT_FOUND, None
+        self.stop_spectating()
+        self._game = None
+        self._live_game = game
+        log(log.INFO, "Observer spectates game: %s", game.name)
+        _, self._live_layer = game.add_spectator(self.on_live_tick)
+        return Result.OKEY, self._live_layer
+
+    def on_live_tick(self, _, layer, finished=False):
+        """ Receives layer of spectated game published after the game tick, pushes it to the client.
+        Only the latest layer matters, so lagging client loses layers of previous ticks which are not sent yet.
+        The last layer of finished game is pushed as GAME_FINISHED frame, the observer stops spectating.
+        """
+        self._live_layer = layer
+        if finished:
+            self._live_game = None  # The game has removed its spectators.
+        if self._push is not None:
+            self._push(Result.GAME_FINISHED if finished else Result.TICK_DONE, layer, replace=True)
+
+    def stop_spectating(self):
+        """ Detaches from spectated game.
+        """
+        if self._live_game is not None:
+            self._live_game.remove_spectator(self.on_live_tick)
+            self._live_game = None
+            self._live_layer = None
+
     def _on_observer(self, _):
         return Result.OKEY, json.dumps(self.games())
 
+    def _on_games(self, data):
+        return Result.OKEY, json.dumps(self.games(data))
+
     COMMAND_MAP = {
         Action.MAP: _on_get_map,
         Action.TURN: _on_turn,
         Action.GAME: _on_game,
         Action.OBSERVER: _on_observer,
+        Action.GAMES: _on_games,
+        Action.SPECTATE: _on_spectate,
     }
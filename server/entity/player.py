@@ -20,8 +20,8 @@ class Player(object):
     # All registered players.
     PLAYERS = {}
 
-    def __init__(self, name, security_key=None):
-        self.idx = str(uuid.uuid4())
+    def __init__(self, name, security_key=None, idx=None):
+        self.idx = str(uuid.uuid4()) if idx is None else idx
         self.name = name
         self.security_key = security_key
         self.train = {}
@@ -91,6 +91,11 @@ class Player(object):
     def to_json_str(self):
         """ store object to JSON string
         """
+        return json.dumps(self.to_dict(), default=lambda o: o.__dict__, sort_keys=True, indent=4)
+
+    def to_dict(self):
+        """ Returns data to be sent to the player.
+        """
         data = {}
         protected = ('security_key', )
         for key in self.__dict__:
@@ -101,7 +106,7 @@ class Player(object):
                 data[key] = [i for i in attribute.values()]
             else:
                 data[key] = attribute
-        return json.dumps(data, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        return data
 
     def __repr__(self):
         return (
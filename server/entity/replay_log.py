@@ -0,0 +1,183 @@
+""" Replay logs of recorded games and process-wide cache of them shared by observers.
+"""
+import bisect
+import json
+import pickle
+from collections import OrderedDict
+from threading import Lock
+
+from game_config import CONFIG
+from logger import log
+
+# Estimated memory size (in bytes) of decoded action without its message:
+ACTION_OVERHEAD_SIZE = 200
+
+
+def decode_action(action):
+    """ Converts action read from replay DB to tuple (action id, action code, decoded message).
+    """
+    return action['idx'], action['code'], None if action['message'] is None else json.loads(action['message'])
+
+
+class ReplayLog(object):
+    """ Actions and checkpoints of recorded game.
+    Decoded actions are kept in memory if they are given, otherwise they are streamed from replay DB.
+    Checkpoints are pickled game states saved by observers: (turn, id of the last played action, state),
+    ordered by turn. The log is shared by observers read-only, except of adding checkpoints and appending
+    actions of running game.
+    """
+    def __init__(self, db, game_id, actions=None, size=0, length=0, cache=None):
+        self.game_id = game_id
+        self.length = length  # Length of the game when its actions were read.
+        self.size = size
+        self._db = db
+        self._actions = actions
+        self._ids = None if actions is None else [a[0] for a in actions]
+        self._checkpoints = []
+        self._lock = Lock()
+        self._cache = cache
+        if actions is None:
+            self.has_actions = next(db.iter_actions(game_id, chunk_size=1), None) is not None
+        else:
+            self.has_actions = bool(actions)
+
+    @property
+    def last_id(self):
+        """ Id of the last action kept in memory, 0 if there are no actions.
+        """
+        return self._ids[-1] if self._ids else 0
+
+    def extend(self, actions, size, length):
+        """ Appends decoded actions written after the actions of the log, used when running game grows.
+        """
+        ids = [a[0] for a in actions]
+        with self._lock:
+            self._actions.extend(actions)  # Actions are appended before ids, so readers see consistent prefix.
+            self._ids.extend(ids)
+            self.has_actions = bool(self._actions)
+            self.size += size
+            self.length = length
+
+    def iter_actions(self, after_id=0, codes=None):
+        """ Yields decoded actions following the action with id 'after_id', filtered by codes if given.
+        """
+        if self._actions is None:
+            for action in self._db.iter_actions(self.game_id, after_id=after_id, codes=codes):
+                yield decode_action(action)
+            return
+        for action in self._actions[bisect.bisect_right(self._ids, after_id):]:
+            if codes is None or action[1] in codes:
+                yield action
+
+    def get_checkpoint(self, turn):
+        """ Returns the latest checkpoint saved at or before the turn: (turn, action id, pickled state), or None.
+        """
+        with self._lock:
+            idx = bisect.bisect_right(self._checkpoints, (turn, float('inf'))) - 1
+            return self._checkpoints[idx] if idx >= 0 else None
+
+    def has_checkpoint(self, turn):
+        """ Checks if checkpoint of the turn is saved.
+        """
+        with self._lock:
+            idx = bisect.bisect_left(self._checkpoints, (turn, ))
+            return idx < len(self._checkpoints) and self._checkpoints[idx][0] == turn
+
+    def add_checkpoint(self, turn, action_id, state):
+        """ Saves checkpoint of the turn if it's not saved yet.
+        """
+        if self.has_checkpoint(turn):
+            return
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            idx = bisect.bisect_left(self._checkpoints, (turn, ))
+            if idx < len(self._checkpoints) and self._checkpoints[idx][0] == turn:
+                return
+            self._checkpoints.insert(idx, (turn, action_id, data))
+            self.size += len(data)
+        if self._cache is not None:
+            self._cache.shrink()
+
+
+class ReplayCache(object):
+    """ LRU cache of replay logs of games, keyed by game id and date.
+    Log of running game is extended by new actions when the game grows, so it's never loaded from DB twice.
+    Total size of cached logs is bounded by REPLAY_CACHE_SIZE bytes, logs larger than the bound are not cached
+    and are streamed from DB by each observer, reading stops as soon as the bound is exceeded.
+    """
+    def __init__(self):
+        self._logs = OrderedDict()
+        self._lock = Lock()
+        self._loading_locks = {}  # Key of the game: lock held while the log is loaded from DB.
+
+    def get(self, db, game):
+        """ Returns replay log of the game.
+        game: dict of the game from replay DB
+        """
+        game_id = game['idx']
+        key = (game_id, game['date'])  # Game id may be reused by recreated DB.
+        with self._lock:
+            loading_lock = self._loading_locks.setdefault(key, Lock())
+        with loading_lock:  # Concurrent observers of the same game wait for single load.
+            with self._lock:
+                replay_log = self._logs.get(key)
+                if replay_log is not None:
+                    self._logs.move_to_end(key)
+            if replay_log is not None and replay_log.length >= game['length']:
+                return replay_log
+            if replay_log is None:
+                actions, size = self._read_actions(db, game_id, 0, CONFIG.REPLAY_CACHE_SIZE)
+            else:  # Running game has grown, only new actions are read.
+                actions, size = self._read_actions(
+                    db, game_id, replay_log.last_id, CONFIG.REPLAY_CACHE_SIZE - replay_log.size)
+            with self._lock:
+                self._loading_locks.pop(key, None)
+                if actions is None:
+                    self._logs.pop(key, None)
+                elif replay_log is None:
+                    replay_log = ReplayLog(db, game_id, actions=actions, size=size, length=game['length'], cache=self)
+                    self._logs[key] = replay_log
+                else:
+                    replay_log.extend(actions, size, game['length'])
+        if actions is None:
+            log(log.INFO, "Replay log is too large to be cached, game id: %s", game_id)
+            return ReplayLog(db, game_id)
+        log(log.INFO, "Replay log loaded, game id: %s, size: %s", game_id, replay_log.size)
+        self.shrink()
+        return replay_log
+
+    @staticmethod
+    def _read_actions(db, game_id, after_id, max_size):
+        """ Reads and decodes actions of the game following the action with id 'after_id'.
+        returns: tuple (list of decoded actions, their estimated size), (None, None) if the size exceeds max_size
+        """
+        actions, size = [], 0
+        for action in db.iter_actions(game_id, after_id=after_id):
+            size += ACTION_OVERHEAD_SIZE + len(action['message'] or '')
+            if size > max_size:
+                return None, None
+            actions.append(decode_action(action))
+        return actions, size
+
+    def shrink(self):
+        """ Removes least recently used logs until total size of the logs fits REPLAY_CACHE_SIZE.
+        Removed logs stay valid for observers which use them.
+        """
+        with self._lock:
+            size = sum(l.size for l in self._logs.values())
+            while self._logs and size > CONFIG.REPLAY_CACHE_SIZE:
+                _, replay_log = self._logs.popitem(last=False)
+                size -= replay_log.size
+
+    def clear(self):
+        """ Removes all cached logs.
+        """
+        with self._lock:
+            self._logs.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._logs)
+
+
+REPLAY_CACHE = ReplayCache()
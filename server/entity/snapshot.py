@@ -0,0 +1,145 @@
+""" Snapshot of the dynamic map layer.
+"""
+import json
+
+from encoders import DEFAULT_ENCODER, JsonEncoder
+
+
+def encode(data, level=0):
+    """ Encodes data as JSON string with the same formatting as whole layer has,
+    'level' is nesting level of the data inside the layer.
+    """
+    text = json.dumps(data, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+    return text.replace('\n', '\n' + ' ' * 4 * level)
+
+
+class DynamicLayer(object):
+    """ Encoded layer 1 (posts, trains and rating) of the game map, shared by all players of the game.
+
+    Each post and train is encoded separately and re-encoded only if its state has been changed since the
+    previous update, the layer is composed from encoded parts. Events are not stored in the snapshot,
+    posts and trains which have events are encoded on request.
+    Other encodings than default JSON encode the layer from stored states, the result is cached per encoding.
+    """
+    def __init__(self, game_map):
+        self.map = game_map
+        self.version = None
+        self._posts = {}  # Post index: (state, encoded post, data to encode).
+        self._trains = {}  # Train index: (state, encoded train, data to encode).
+        self._rating_data = {}
+        self._rating = encode({}, level=1)
+        self._data = {}  # Encoding name: encoded layer.
+
+    @staticmethod
+    def _update_items(cache, items):
+        """ Re-encodes changed items.
+        returns: list of indexes of changed items
+        """
+        changed = []
+        for idx, item in items.items():
+            state = dict(item.__dict__)
+            state.pop('event', None)
+            cached = cache.get(idx)
+            if cached is None or cached[0] != state:
+                data = dict(state, event=[])
+                cache[idx] = (state, '        ' + encode(data, level=2), data)
+                changed.append(idx)
+        if len(cache) != len(items):
+            for idx in [i for i in cache if i not in items]:
+                del cache[idx]
+        return changed
+
+    def update(self, version, rating):
+        """ Updates the snapshot to given version of the game state.
+        returns: tuple (indexes of changed posts, indexes of changed trains)
+        """
+        if version == self.version:
+            return [], []
+        changed_posts = self._update_items(self._posts, self.map.post)
+        changed_trains = self._update_items(self._trains, self.map.train)
+        self._rating_data = rating
+        self._rating = encode(rating, level=1)
+        self._data = {}
+        self.version = version
+        return changed_posts, changed_trains
+
+    @staticmethod
+    def _snapshot_items(cache, items, indexes=None):
+        """ returns: list of tuples (encoded item or None if the item has events, data to encode)
+        """
+        return [
+            (None, dict(item.__dict__, event=list(item.event))) if item.event else cache[idx][1:]
+            for idx, item in items.items() if item.event or indexes is None or idx in indexes
+        ]
+
+    def snapshot(self, post_ids=None, train_ids=None, fields=None):
+        """ Takes the layer which is encoded later by encode_snapshot(), so it can be encoded without the game lock.
+        If indexes are specified only given posts and trains and ones which have events are included.
+        Encoded parts are shared with the layer, posts and trains which have events are copied.
+        'fields' are additional fields of the encoded dictionary.
+        """
+        return {
+            'idx': self.map.idx,
+            'post': self._snapshot_items(self._posts, self.map.post, post_ids),
+            'rating': (self._rating, self._rating_data),
+            'train': self._snapshot_items(self._trains, self.map.train, train_ids),
+            'fields': dict(fields or {}),
+        }
+
+    @staticmethod
+    def _compose_items(items):
+        parts = [text if text is not None else '        ' + encode(data, level=2) for text, data in items]
+        if not parts:
+            return '[]'
+        return '[\n' + ',\n'.join(parts) + '\n    ]'
+
+    @classmethod
+    def encode_snapshot(cls, snapshot, encoder=DEFAULT_ENCODER):
+        """ Encodes the layer taken by snapshot().
+        """
+        if encoder.name == JsonEncoder.name:
+            parts = {
+                'idx': json.dumps(snapshot['idx']),
+                'post': cls._compose_items(snapshot['post']),
+                'rating': snapshot['rating'][0],
+                'train': cls._compose_items(snapshot['train']),
+            }
+            for key, value in snapshot['fields'].items():
+                parts[key] = encode(value, level=1)
+            text = '{\n' + ',\n'.join('    "{}": {}'.format(k, parts[k]) for k in sorted(parts)) + '\n}'
+            return text.encode('utf-8')
+        data = {
+            'idx': snapshot['idx'],
+            'post': [item[1] for item in snapshot['post']],
+            'rating': snapshot['rating'][1],
+            'train': [item[1] for item in snapshot['train']],
+        }
+        data.update(snapshot['fields'])
+        return encoder.encode(data)
+
+    def _encode(self, encoder, post_ids=None, train_ids=None, fields=None):
+        return self.encode_snapshot(self.snapshot(post_ids, train_ids, fields), encoder)
+
+    def delta_snapshot(self, tick, post_ids=None, train_ids=None):
+        """ Takes delta of the layer which is encoded later by encode_snapshot(): only given posts and trains and
+        ones which have events. If indexes are not specified the delta contains all posts and trains.
+        """
+        full = post_ids is None and train_ids is None
+        return self.snapshot(post_ids, train_ids, fields={'full': full, 'tick': tick})
+
+    def delta_to_bytes(self, tick, post_ids=None, train_ids=None, encoder=DEFAULT_ENCODER):
+        """ Returns encoded delta of the layer: only given posts and trains and ones which have events.
+        If indexes are not specified the delta contains all posts and trains.
+        """
+        return self.encode_snapshot(self.delta_snapshot(tick, post_ids, train_ids), encoder)
+
+    def to_bytes(self, encoder=DEFAULT_ENCODER):
+        """ Returns encoded layer with current events of posts and trains.
+        """
+        has_events = any(p.event for p in self.map.post.values()) or any(t.event for t in self.map.train.values())
+        if has_events:
+            return self._encode(encoder)
+        data = self._data.get(encoder.name)
+        if data is None:
+            data = self._data[encoder.name] = self._encode(encoder)
+        return data
@@ -0,0 +1,129 @@
+""" Table of trains: state of all trains of the game in NumPy columns, updated on game tick by array operations.
+"""
+try:
+    import numpy
+except ImportError:  # Optional dependency.
+    numpy = None
+
+from entity.train import Train
+
+# Attributes of the train stored in columns of the table:
+COLUMNS = ('line_idx', 'position', 'speed', 'fuel', 'fuel_consumption', 'cooldown', 'goods', 'level')
+# Columns which may be None, None is stored as -1:
+NULLABLE_COLUMNS = ('line_idx', 'position')
+# Attributes of the train in order of Train's attributes:
+ATTRIBUTES = tuple(Train(0).__dict__)
+
+
+class TrainTable(object):
+    """ State of trains of the game in NumPy columns, a row per train.
+    Trains of the game are views of the rows (TrainView), so the state is stored only in the columns and
+    movement, fuel consumption, cooldowns and detection of trains at the ends of lines are done for all trains
+    by array operations.
+    """
+    def __init__(self, game_map, capacity=64):
+        if numpy is None:
+            raise ImportError("NumPy is required by the train table, install it or disable TRAIN_TABLE_ENABLED")
+        self.size = 0
+        self.trains = []  # Views of the rows.
+        self.columns = {name: numpy.zeros(capacity, dtype=numpy.int64) for name in COLUMNS}
+        self.line_length = numpy.zeros(max(game_map.line, default=0) + 1, dtype=numpy.int64)
+        for idx, line in game_map.line.items():
+            self.line_length[idx] = line.length
+
+    def add_train(self, idx):
+        """ Adds row of new train.
+        returns: TrainView of the row
+        """
+        if self.size == len(self.columns['position']):
+            for name, column in self.columns.items():
+                self.columns[name] = numpy.concatenate((column, numpy.zeros_like(column)))
+        train = TrainView(self, self.size, idx)
+        self.trains.append(train)
+        self.size += 1
+        return train
+
+    def column(self, name):
+        """ Returns values of the column for all trains.
+        """
+        return self.columns[name][:self.size]
+
+    def update_cooldowns(self):
+        """ Decreases cooldowns of all trains.
+        """
+        cooldown = self.column('cooldown')
+        cooldown[cooldown > 0] -= 1
+
+    def consume_fuel(self):
+        """ Decreases fuel of moving trains.
+        returns: list of moving trains which are out of fuel
+        """
+        fuel = self.column('fuel')
+        moving = self.column('speed') != 0
+        fuel -= self.column('fuel_consumption') * moving
+        return [self.trains[row] for row in numpy.flatnonzero(moving & (fuel < 0)).tolist()]
+
+    def move(self):
+        """ Moves trains along their lines by one unit of distance, trains at the ends of lines stay there.
+        """
+        position, speed = self.column('position'), self.column('speed')
+        position += (speed > 0) & (position < self.line_length[self.column('line_idx')])
+        position -= (speed < 0) & (position > 0)
+
+    def trains_at_points(self):
+        """ Returns list of trains which are at the ends of their lines.
+        """
+        position = self.column('position')
+        at_point = (position == 0) | (position == self.line_length[self.column('line_idx')])
+        return [self.trains[row] for row in numpy.flatnonzero(at_point).tolist()]
+
+
+def _column_property(name):
+    nullable = name in NULLABLE_COLUMNS
+
+    def getter(self):
+        value = int(self._table.columns[name][self._row])
+        return None if nullable and value == -1 else value
+
+    def setter(self, value):
+        self._table.columns[name][self._row] = -1 if value is None else value
+
+    return property(getter, setter)
+
+
+class TrainView(object):
+    """ Train stored in the row of the train table, has the same attributes and methods as Train.
+    '__dict__' returns values of all attributes, so the view is serialized as Train.
+    """
+    __slots__ = ('_table', '_row') + tuple(a for a in ATTRIBUTES if a not in COLUMNS)
+
+    def __init__(self, table, row, idx):
+        self._table = table
+        self._row = row
+        self.idx = idx
+        self.line_idx = None
+        self.position = None
+        self.speed = 0
+        self.player_id = None
+        self.set_level(1)
+        self.fuel = self.fuel_capacity
+        self.goods = 0
+        self.post_type = None
+        self.event = []
+        self.cooldown = 0
+
+    @property
+    def __dict__(self):
+        return {name: getattr(self, name) for name in ATTRIBUTES}
+
+    line_idx = _column_property('line_idx')
+    position = _column_property('position')
+    speed = _column_property('speed')
+    fuel = _column_property('fuel')
+    fuel_consumption = _column_property('fuel_consumption')
+    cooldown = _column_property('cooldown')
+    goods = _column_property('goods')
+    level = _column_property('level')
+
+    set_level = Train.set_level
+    __repr__ = Train.__repr__
@@ -12,6 +12,12 @@ class BadCommand(WgForgeServerError):
     pass
 
 
+class FrameTooLarge(BadCommand):
+    """ Frame can't be received, the connection must be closed.
+    """
+    pass
+
+
 class NotReady(WgForgeServerError):
     pass
 
@@ -17,8 +17,18 @@ class BaseConfig(object):
     CURRENT_MAP_VERSION = 'map04'
     TRAINS_COUNT = 8
     FUEL_ENABLED = False
+    TRAIN_TABLE_ENABLED = False  # Trains state is kept in NumPy columns and updated by array operations.
     TRAIN_ALWAYS_DEVASTATED = True
     COLLISIONS_ENABLED = True
+    MAP_DELTA_HISTORY = 50  # Number of ticks for which changes of dynamic map layer are kept.
+    REPLAY_BATCH_SIZE = 500  # Max number of replay actions written to DB in one transaction.
+    REPLAY_FLUSH_INTERVAL = 0.5  # Max time (in seconds) for which replay actions are kept in memory.
+    REPLAY_RETRY_INTERVAL = 1  # Time (in seconds) after which replay actions are written again if writing failed.
+    REPLAY_RETRY_BATCHES = 20  # Max number of batches of replay actions kept while replay DB is unavailable.
+    REPLAY_FLUSH_TIMEOUT = 10  # Max time (in seconds) for which server shutdown waits until replays are written.
+    REPLAY_CHUNK_SIZE = 1000  # Number of replay actions read from DB in one query.
+    OBSERVER_CHECKPOINT_INTERVAL = 50  # Number of ticks between game states saved by observer for seeking.
+    REPLAY_CACHE_SIZE = 64 * 1024 * 1024  # Max memory size (in bytes) of replays cached for observers.
 
     HIJACKERS_ASSAULT_PROBABILITY = 20
     HIJACKERS_POWER_RANGE = (1, 3)
@@ -1,7 +1,112 @@
+import atexit
+import copy
+import json
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from defs import LOG_LEVEL, LOG_PAYLOAD_LIMIT, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_DROP_POLICY
+
+TEXT_FORMAT = '%(asctime)-15s [%(levelname)-8s] %(message)s'
+DROP_POLICIES = ('newest', 'oldest')
+
+
+class Payload(object):
+    """ Message payload which is formatted only if the log record is emitted.
+    Text longer than the limit is truncated, binary data is replaced by its size.
+    """
+    __slots__ = ('data', 'limit')
+
+    def __init__(self, data, limit):
+        self.data = data
+        self.limit = limit
+
+    def __str__(self):
+        if isinstance(self.data, (bytes, bytearray)):
+            return '<{} bytes>'.format(len(self.data))
+        text = str(self.data)
+        if self.limit is not None and len(text) > self.limit:
+            return '{}... <{} chars>'.format(text[:self.limit], len(text))
+        return text
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ Formats log record as JSON object in one line.
+    """
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ Puts log records into bounded queue, never blocks the logging thread.
+    If the queue is full the newest record is dropped, or the oldest queued one if 'drop_policy' is 'oldest'.
+    """
+    def __init__(self, records_queue, drop_policy='newest'):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy: '{}', available: {}".format(drop_policy, ', '.join(DROP_POLICIES)))
+        super(DroppingQueueHandler, self).__init__(records_queue)
+        self.drop_policy = drop_policy
+        self.dropped = 0  # Approximate number of dropped records, isn't guarded by lock.
+
+    def handle(self, record):
+        """ Emits the record if it passes filters without taking the handler's lock: the queue is thread safe,
+        so logging threads don't wait for each other.
+        """
+        result = self.filter(record)
+        if isinstance(result, logging.LogRecord):  # Filters may replace the record since Python 3.12.
+            record = result
+        if result:
+            self.emit(record)
+        return result
+
+    def prepare(self, record):
+        """ Formats message and traceback of the record on the logging thread, because arguments of the message
+        may be changed later. Time and the whole line are formatted by the listener.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if self.drop_policy == 'oldest':
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(record)
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped += 1
+
+
+class FlushingQueueListener(QueueListener):
+    """ Queue listener which waits for free space in the queue to stop after all queued records are written.
+    """
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
 
 
 class Logger(object):
+    """ Wrapper of 'tcpserver' logger.
+    Message arguments are formatted %-style only if the level is enabled: log(log.INFO, "Tick: %s", tick).
+    """
 
     EXCEPTION = 100
     CRITICAL = 50
@@ -11,10 +116,15 @@ class Logger(object):
     DEBUG = 10
     NOTSET = 0
 
-    def __init__(self):
-        logging.basicConfig(format='%(asctime)-15s [%(levelname)-8s] %(message)s')
+    def __init__(self, level=LOG_LEVEL, payload_limit=LOG_PAYLOAD_LIMIT):
+        logging.basicConfig(format=TEXT_FORMAT)
         self._log = logging.getLogger('tcpserver')
-        self._log.setLevel(self.DEBUG)
+        self._log.setLevel(level)
+        self._handler = None
+        self._listener = None
+        self.payload_limit = payload_limit
+        self.set_output(LOG_FORMAT, LOG_QUEUE_SIZE, LOG_DROP_POLICY)
+        atexit.register(self.stop)
         self._methods_map = {
             self.INFO: self._log.info,
             self.WARNING: self._log.warning,
@@ -23,7 +133,63 @@ class Logger(object):
             self.EXCEPTION: self._log.exception,
         }
 
+    def set_level(self, lvl):
+        """ Sets level of the logger, 'lvl' is level number or name, e.g. 'DEBUG'.
+        """
+        self._log.setLevel(lvl.upper() if isinstance(lvl, str) else lvl)
+
+    def set_output(self, log_format='text', queue_size=0, drop_policy='newest', stream=None):
+        """ Configures output of the logger.
+        log_format: 'text' or 'json' - JSON object per line
+        queue_size: if not 0 records are passed to background thread over the queue of this size and written by
+            the thread, so logging threads never wait for I/O, records are dropped if the queue is full
+        drop_policy: 'newest' - drop the record being logged, 'oldest' - drop the oldest queued record
+        stream: output stream, stderr by default
+        """
+        self.stop()
+        if self._handler is not None:
+            self._log.removeHandler(self._handler)
+            self._handler = None
+        self._log.propagate = True
+        if log_format == 'text' and queue_size == 0 and stream is None:
+            return  # Records are written by handler of root logger.
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(JsonLinesFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+        if queue_size:
+            self._listener = FlushingQueueListener(queue.Queue(queue_size), handler)
+            self._listener.start()
+            handler = DroppingQueueHandler(self._listener.queue, drop_policy)
+        self._handler = handler
+        self._log.addHandler(handler)
+        self._log.propagate = False
+
+    @property
+    def dropped(self):
+        """ Number of records dropped because the queue is full.
+        """
+        return self._handler.dropped if isinstance(self._handler, DroppingQueueHandler) else 0
+
+    def stop(self):
+        """ Writes queued records and stops background thread of the logger, records logged later are lost
+        until output is configured again.
+        """
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def is_enabled(self, lvl):
+        """ Checks if messages of the level are logged, allows to skip preparing of log message arguments.
+        """
+        return self._log.isEnabledFor(lvl)
+
+    def payload(self, data):
+        """ Returns message argument which is formatted lazily and truncated to 'payload_limit' characters.
+        """
+        return Payload(data, self.payload_limit)
+
     def __call__(self, lvl, msg, *args, **kwargs):
+        if not self._log.isEnabledFor(lvl):
+            return
         if lvl in self._methods_map:
             self._methods_map[lvl](msg, *args, **kwargs)
         else:
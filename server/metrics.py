@@ -0,0 +1,175 @@
+""" Latency and throughput metrics of client actions.
+"""
+import bisect
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, current_thread, local
+
+from defs import Result
+from logger import log
+
+# Upper bounds (in seconds) of latency histogram buckets, the last bucket is unbounded:
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+
+
+class ActionStats(object):
+    """ Statistics of one action: count of calls by result code, total time and latency histogram.
+    """
+    __slots__ = ('results', 'total_time', 'buckets')
+
+    def __init__(self):
+        self.results = {}
+        self.total_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, other):
+        for result, count in list(other.results.items()):  # The owner thread may add new result meanwhile.
+            self.results[result] = self.results.get(result, 0) + count
+        self.total_time += other.total_time
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+
+
+class Shard(object):
+    """ Statistics of actions recorded by one thread, only the owner thread changes it.
+    """
+    __slots__ = ('thread', 'stats')
+
+    def __init__(self):
+        self.thread = current_thread()
+        self.stats = {}  # Action: ActionStats.
+
+
+class Metrics(object):
+    """ Collects statistics of client actions.
+    Each thread records into its own shard without locking, shards are summed up on reading.
+    Shards of finished threads are merged into one, so the number of shards doesn't grow with connections.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self._local = local()
+        self._shards = []
+        self._retired = {}  # Merged statistics of finished threads.
+        self._lock = Lock()
+
+    def record(self, action, result, duration):
+        """ Records the action executed with given result for given time (in seconds).
+        """
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = Shard()
+            with self._lock:
+                self._shards.append(shard)
+        stats = shard.stats.get(action)
+        if stats is None:
+            stats = shard.stats[action] = ActionStats()
+        stats.results[result] = stats.results.get(result, 0) + 1
+        stats.total_time += duration
+        stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def collect(self):
+        """ Returns statistics summed up over all threads: dict, key: action, value: ActionStats.
+        """
+        total = {}
+        with self._lock:
+            for shard in [s for s in self._shards if not s.thread.is_alive()]:
+                self._shards.remove(shard)
+                self._merge(self._retired, shard.stats)
+            self._merge(total, self._retired)
+            for shard in self._shards:
+                self._merge(total, shard.stats)
+        return total
+
+    @staticmethod
+    def _merge(total, stats):
+        for action, action_stats in list(stats.items()):
+            total.setdefault(action, ActionStats()).add(action_stats)
+
+    def reset(self):
+        """ Removes all recorded statistics.
+        """
+        with self._lock:
+            for shard in self._shards:
+                shard.stats = {}
+            self._retired = {}
+            self.start_time = time.time()
+
+    def to_dict(self):
+        """ Returns statistics as dictionary: uptime (in seconds) and statistics of actions by action name,
+        latency buckets are cumulative: list of [upper bound of latency or None for unbounded, count].
+        """
+        actions = {}
+        for action, stats in sorted(self.collect().items()):
+            buckets, count = [], 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + (None, ), stats.buckets):
+                count += bucket_count
+                buckets.append([bound, count])
+            actions[action.name] = {
+                'count': count,
+                'errors': {Result(r).name: n for r, n in stats.results.items() if r != Result.OKEY},
+                'total_time': stats.total_time,
+                'latency': buckets,
+            }
+        return {'uptime': time.time() - self.start_time, 'actions': actions}
+
+    def to_prometheus(self):
+        """ Returns statistics in Prometheus text exposition format.
+        """
+        lines = [
+            '# HELP wg_forge_action_latency_seconds Execution time of client actions.',
+            '# TYPE wg_forge_action_latency_seconds histogram',
+        ]
+        collected = sorted(self.collect().items())
+        for action, stats in collected:
+            count = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf', ), stats.buckets):
+                count += bucket_count
+                lines.append('wg_forge_action_latency_seconds_bucket{{action="{}",le="{}"}} {}'.format(
+                    action.name, bound, count))
+            lines.append('wg_forge_action_latency_seconds_sum{{action="{}"}} {}'.format(action.name, stats.total_time))
+            lines.append('wg_forge_action_latency_seconds_count{{action="{}"}} {}'.format(action.name, count))
+        lines.extend([
+            '# HELP wg_forge_action_results_total Number of client actions by result code.',
+            '# TYPE wg_forge_action_results_total counter',
+        ])
+        for action, stats in collected:
+            for result, count in sorted(stats.results.items()):
+                lines.append('wg_forge_action_results_total{{action="{}",result="{}"}} {}'.format(
+                    action.name, Result(result).name, count))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """ Serves metrics in Prometheus text format on GET /metrics.
+    """
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # Requests are not logged.
+
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics(address, port):
+    """ Starts HTTP server of metrics on background thread.
+    returns: the server
+    """
+    server = MetricsHTTPServer((address, port), MetricsRequestHandler)
+    Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    log(log.INFO, "Serving metrics on http://%s:%s/metrics", *server.server_address[:2])
+    return server
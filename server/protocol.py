@@ -0,0 +1,118 @@
+""" Client-server protocol helpers.
+"""
+import struct
+
+import errors
+from defs import Action, MAX_FRAME_SIZE
+
+# Frame header: {action code (4 bytes)}{data length (4 bytes)}, little-endian.
+HEADER = struct.Struct('<I')
+HEADER_SIZE = HEADER.size
+# Response header: {result code (4 bytes)}{data length (4 bytes)}, little-endian.
+RESPONSE_HEADER = struct.Struct('<II')
+# Max number of buffers for one 'sendmsg' call:
+SENDMSG_MAX_BUFFERS = 512
+
+ACTIONS = {a.value: a for a in Action}
+
+# Actions without data section:
+NO_DATA_ACTIONS = frozenset([Action.LOGOUT.value, Action.OBSERVER.value])
+
+
+class FrameDecoder(object):
+    """ Incremental decoder of client action frames: {action}{data length}{data}.
+    Received data is appended to one reusable buffer and parsed in place, the buffer is compacted once
+    per 'feed', so parsing of fragmented or pipelined frames is linear to the amount of received data.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def feed(self, data):
+        """ Appends received data to the buffer.
+        """
+        if self._pos == len(self._buffer):
+            self._buffer.clear()
+            self._pos = 0
+        elif self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        self._buffer += data
+
+    def pending(self):
+        """ Returns True if the buffer has unparsed data.
+        """
+        return len(self._buffer) > self._pos
+
+    def next_frame(self):
+        """ Parses next frame from the buffer.
+        returns: tuple (Action, message) or None if the buffer doesn't contain complete frame
+        raises: errors.BadCommand if the frame is invalid, the frame is skipped
+        raises: errors.FrameTooLarge if data length of the frame exceeds MAX_FRAME_SIZE, buffered data is dropped
+        """
+        buffer, pos = self._buffer, self._pos
+        available = len(buffer) - pos
+        if available < HEADER_SIZE:
+            return None
+        action = HEADER.unpack_from(buffer, pos)[0]
+        if action in NO_DATA_ACTIONS:
+            self._pos = pos + HEADER_SIZE
+            return ACTIONS[action], '{}'
+        if available < 2 * HEADER_SIZE:
+            return None
+        message_len = HEADER.unpack_from(buffer, pos + HEADER_SIZE)[0]
+        if message_len > MAX_FRAME_SIZE:  # The data isn't waited for, the client can't continue.
+            buffer.clear()
+            self._pos = 0
+            raise errors.FrameTooLarge("The command is too large, data length: {}, max: {}".format(
+                message_len, MAX_FRAME_SIZE))
+        start = pos + 2 * HEADER_SIZE
+        end = start + message_len
+        if len(buffer) < end:
+            return None
+        self._pos = end
+        if action not in ACTIONS:
+            raise errors.BadCommand("No such command, action code: {}".format(action))
+        with memoryview(buffer) as view:
+            try:
+                message = str(view[start:end], 'utf-8')
+            except UnicodeDecodeError as err:
+                raise errors.BadCommand("The command payload is not valid UTF-8 string: {}".format(err))
+        return ACTIONS[action], message
+
+    def frames(self, data=b''):
+        """ Appends data and returns all complete frames from the buffer.
+        """
+        self.feed(data)
+        result = []
+        frame = self.next_frame()
+        while frame is not None:
+            result.append(frame)
+            frame = self.next_frame()
+        return result
+
+
+def encode_response(result, message=''):
+    """ Encodes response message.
+    returns: list of buffers: header and data
+    """
+    data = message.encode('utf-8') if isinstance(message, str) else message
+    return [RESPONSE_HEADER.pack(result, len(data)), data]
+
+
+def send_buffers(sock, buffers):
+    """ Sends list of buffers to the socket with as few system calls as possible.
+    """
+    if not hasattr(sock, 'sendmsg'):  # Not available on Windows.
+        sock.sendall(b''.join(buffers))
+        return
+    buffers = [memoryview(b) for b in buffers if b]
+    while buffers:
+        sent = sock.sendmsg(buffers[:SENDMSG_MAX_BUFFERS])
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
@@ -0,0 +1,63 @@
+""" Scheduler of game ticks.
+"""
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition
+
+from defs import GAME_WORKERS
+from logger import log
+
+
+class GameScheduler(object):
+    """ Runs ticks of all games on the shared pool of workers.
+    Games are kept in the heap ordered by the deadline of their next tick, one scheduler thread waits for the
+    nearest deadline and submits 'run_tick' of the game to the pool. Entries are never removed from the heap,
+    the game itself checks on 'run_tick' that the tick is still due, so rescheduling is just a push.
+    """
+    def __init__(self, workers=GAME_WORKERS):
+        self.workers = workers
+        self._heap = []  # Entries: (deadline, sequence number, game).
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._executor = None
+        self._thread = None
+
+    def start(self):
+        """ Starts scheduler thread, does nothing if it's already started.
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._thread = Thread(target=self._run, name='GameScheduler', daemon=True)
+            self._thread.start()
+        log(log.INFO, "Game scheduler started, workers: %s", self.workers)
+
+    def schedule(self, game, deadline):
+        """ Schedules game tick at the deadline (time.monotonic() based).
+        """
+        self.start()
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._counter), game))
+            if self._heap[0][2] is game:  # The nearest deadline has been changed.
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, game = heapq.heappop(self._heap)
+            self._executor.submit(self._run_tick, game)
+
+    @staticmethod
+    def _run_tick(game):
+        try:
+            game.run_tick()
+        except Exception:
+            log(log.EXCEPTION, "Got unhandled exception on game tick, game: '%s'", game.name)
+
+
+SCHEDULER = GameScheduler()
@@ -1,16 +1,29 @@
 """ Game server.
 """
+import asyncio
 import json
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import ThreadingTCPServer, BaseRequestHandler
+from threading import Condition, Lock, Thread
 
 from invoke import task
 
 import errors
-from defs import SERVER_ADDR, SERVER_PORT, RECEIVE_CHUNK_SIZE, Action, Result
+from db.replay import DbReplay
+from defs import SERVER_ADDR, SERVER_PORT, SERVER_WORKERS, METRICS_PORT, Action, Result
+from defs import RECEIVE_CHUNK_SIZE, RECEIVE_BUFFER_LIMIT, PUSH_QUEUE_SIZE
+from encoders import DEFAULT_ENCODER, get_encoder
 from entity.game import Game
 from entity.observer import Observer
 from entity.player import Player
+from game_config import CONFIG
 from logger import log
+from metrics import METRICS, serve_metrics
+from protocol import FrameDecoder, encode_response, send_buffers
 
 
 def login_required(func):
@@ -22,33 +35,76 @@ def login_required(func):
     return wrapped
 
 
-class GameServerRequestHandler(BaseRequestHandler):
+class GameServerConnection(object):
+    """ Transport independent part of a client connection: parses client commands and executes them.
+    Subclasses provide 'send' method which writes buffers to the client.
+    Responses are queued and sent by 'flush', so responses to pipelined commands are sent with one write.
+    Frames pushed by the server from game threads are queued separately and sent by the connection's writer,
+    so game threads never wait for the client's socket.
+    """
     def __init__(self, *args, **kwargs):
         self.action = None
-        self.message_len = None
         self.message = None
-        self.data = None
+        self.decoder = FrameDecoder()
         self.player = None
         self.game = None
         self.replay = None
         self.observer = None
+        self.encoder = DEFAULT_ENCODER
+        self.subscribed = False
+        self.push_delta = False
+        self._push_tick = None
+        self.metrics_deferred = False  # Set by the command which records its metrics itself when it's done.
         self.closed = None
-        super(GameServerRequestHandler, self).__init__(*args, **kwargs)
+        self._responses = []
+        self._responses_lock = Lock()
+        self._send_lock = Lock()
+        self._pushes = deque()  # Pushed frames which are not sent yet, each frame is list of buffers.
+        self._push_condition = Condition()
+        super(GameServerConnection, self).__init__(*args, **kwargs)
+
+    def send(self, buffers: list):
+        """ Writes list of buffers to the client.
+        """
+        raise NotImplementedError
+
+    def schedule_pushes(self):
+        """ Makes the connection's writer send queued pushed frames. Is called from game threads, must not block.
+        """
+        raise NotImplementedError
+
+    def abort(self):
+        """ Closes the connection immediately. May be called from any thread.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """ Sends all queued responses. The responses lock isn't held while sending.
+        """
+        with self._send_lock:
+            with self._responses_lock:
+                buffers, self._responses = self._responses, []
+            if buffers:
+                self.send(buffers)
+
+    def pop_pushes(self):
+        """ Takes all queued pushed frames.
+        returns: list of buffers
+        """
+        with self._push_condition:
+            buffers = [b for frame in self._pushes for b in frame]
+            self._pushes.clear()
+        return buffers
 
     def setup(self):
-        log(log.INFO, "New connection from {}".format(self.client_address))
+        log(log.INFO, "New connection from %s", self.client_address)
         self.closed = False
 
-    def handle(self):
-        while not self.closed:
-            data = self.request.recv(RECEIVE_CHUNK_SIZE)
-            if data:
-                self.data_received(data)
-            else:
-                self.closed = True
-
     def finish(self):
-        log(log.WARNING, "Connection from {0} lost".format(self.client_address))
+        log(log.WARNING, "Connection from %s lost", self.client_address)
+        self.unsubscribe()
+        if self.observer is not None:
+            self.observer.stop_spectating()
         if self.player is not None:
             self.player.in_game = False
         if self.game is not None:
@@ -56,88 +112,91 @@ class GameServerRequestHandler(BaseRequestHandler):
                 self.game.stop()
 
     def data_received(self, data):
-        if self.data:
-            data = self.data + data
-            self.data = None
-        if self.process_data(data):
-            log(log.INFO, 'Player: {}, action: {!r}, message:\n{}'.format(
-                self.player.idx if self.player is not None else self.client_address,
-                Action(self.action), self.message))
-            try:
-                data = json.loads(self.message)
-                if not isinstance(data, dict):
-                    raise errors.BadCommand("The command payload is not a dictionary")
-                if self.observer:
-                    self.write_response(*self.observer.action(self.action, data))
-                else:
-                    if self.action not in self.COMMAND_MAP:
-                        raise errors.BadCommand("No such command")
-                    method = self.COMMAND_MAP[self.action]
-                    method(self, data)
-                    if self.replay and self.action in (Action.MOVE, Action.LOGIN, Action.UPGRADE, ):
-                        self.replay.add_action(self.action, self.message)
-
-            # Handle errors:
-            except (json.decoder.JSONDecodeError, errors.BadCommand) as err:
-                self.error_response(Result.BAD_COMMAND, err)
-            except errors.AccessDenied as err:
-                self.error_response(Result.ACCESS_DENIED, err)
-            except errors.NotReady as err:
-                self.error_response(Result.NOT_READY, err)
-            except errors.Timeout as err:
-                self.error_response(Result.TIMEOUT, err)
-            except errors.ResourceNotFound as err:
-                self.error_response(Result.RESOURCE_NOT_FOUND, err)
-            except Exception:
-                log(log.EXCEPTION, "Got unhandled exception on client command execution")
-                self.error_response(Result.INTERNAL_SERVER_ERROR)
-            finally:
-                self.action = None
-
-    def process_data(self, data):
-        """ Parses input command.
+        self.decoder.feed(data)
+        while not self.closed and self.read_frame():
+            self.process_command()
+        self.flush()
+
+    def read_frame(self):
+        """ Reads next command from input buffer.
         returns: True if command parsing completed
         """
-        # Read action [4 bytes]:
-        if not self.action:
-            if len(data) < 4:
-                self.data = data
-                return False
-            self.action = Action(int.from_bytes(data[0:4], byteorder='little'))
-            self.message_len = 0
-            data = data[4:]
-            if self.action in (Action.LOGOUT, Action.OBSERVER):  # Commands without data.
-                self.data = b''
-                self.message = '{}'
-                return True
-        # Read size of message:
-        if not self.message_len:
-            if len(data) < 4:
-                self.data = data
+        while True:
+            try:
+                frame = self.decoder.next_frame()
+                break
+            except errors.FrameTooLarge as err:  # The connection is closed after the error response.
+                self.error_response(Result.BAD_COMMAND, err)
+                self.closed = True
                 return False
-            self.message_len = int.from_bytes(data[0:4], byteorder='little')
-            data = data[4:]
-        # Read message:
-        if len(data) < self.message_len:
-            self.data = data
+            except errors.BadCommand as err:  # Invalid frame is skipped.
+                self.error_response(Result.BAD_COMMAND, err)
+        if frame is None:
             return False
-        self.message = data[0:self.message_len].decode('utf-8')
-        self.data = data[self.message_len:]
+        self.action, self.message = frame
         return True
 
+    def process_command(self):
+        """ Executes parsed command.
+        """
+        log(log.INFO, 'Player: %s, action: %r, message:\n%s',
+            self.player.idx if self.player is not None else self.client_address,
+            self.action, log.payload(self.message))
+        start = time.perf_counter()
+        result = Result.OKEY
+        self.metrics_deferred = False
+        try:
+            data = json.loads(self.message)
+            if not isinstance(data, dict):
+                raise errors.BadCommand("The command payload is not a dictionary")
+            if self.observer and self.action != Action.METRICS:
+                result, message = self.observer.action(self.action, data)
+                self.write_response(result, message)
+            else:
+                if self.action not in self.COMMAND_MAP:
+                    raise errors.BadCommand("No such command")
+                method = self.COMMAND_MAP[self.action]
+                method(self, data)
+                if self.replay and self.action in (Action.MOVE, Action.LOGIN, Action.UPGRADE, ):
+                    self.replay.add_action(self.action, self.message)
+
+        # Handle errors:
+        except (json.decoder.JSONDecodeError, errors.BadCommand) as err:
+            result = Result.BAD_COMMAND
+            self.error_response(result, err)
+        except errors.AccessDenied as err:
+            result = Result.ACCESS_DENIED
+            self.error_response(result, err)
+        except errors.NotReady as err:
+            result = Result.NOT_READY
+            self.error_response(result, err)
+        except errors.Timeout as err:
+            result = Result.TIMEOUT
+            self.error_response(result, err)
+        except errors.ResourceNotFound as err:
+            result = Result.RESOURCE_NOT_FOUND
+            self.error_response(result, err)
+        except Exception:
+            log(log.EXCEPTION, "Got unhandled exception on client command execution")
+            result = Result.INTERNAL_SERVER_ERROR
+            self.error_response(result)
+        finally:
+            if not self.metrics_deferred:
+                METRICS.record(self.action, result, time.perf_counter() - start)
+            self.action = None
+
     def write_response(self, result, message=None):
         resp_message = '' if message is None else message
-        log(log.DEBUG, 'Player: {}, result: {!r}, message:\n{}'.format(
+        log(log.DEBUG, 'Player: %s, result: %r, message:\n%s',
             self.player.idx if self.player is not None else self.client_address,
-            result, resp_message))
-        self.request.sendall(result.to_bytes(4, byteorder='little'))
-        self.request.sendall(len(resp_message).to_bytes(4, byteorder='little'))
-        self.request.sendall(resp_message.encode('utf-8'))
+            result, log.payload(resp_message))
+        with self._responses_lock:
+            self._responses.extend(encode_response(result, resp_message))
 
     def error_response(self, result, error=None):
         if error is not None:
             error_msg = str(error)
-            response_msg = json.dumps({'error': error_msg})
+            response_msg = self.encoder.encode({'error': error_msg})
             log(log.ERROR, error_msg)
         else:
             response_msg = ''
@@ -153,6 +212,7 @@ class GameServerRequestHandler(BaseRequestHandler):
 
     def on_login(self, data: dict):
         self.check_keys(data, ['name'])
+        encoder = get_encoder(data.get('encoding', DEFAULT_ENCODER.name))
         game_name = 'Game of {}'.format(data['name'])
         num_players = 1
         if 'game' in data and self.check_keys(data, ['num_players']):
@@ -175,14 +235,16 @@ class GameServerRequestHandler(BaseRequestHandler):
         self.game = game
         self.player = player
         self.replay = game.replay
+        self.encoder = encoder
 
-        log(log.INFO, "Login player: {}".format(player))
-        message = self.player.to_json_str()
+        log(log.INFO, "Login player: %s, encoding: %s", player, encoder.name)
+        message = self.encoder.encode(self.player.to_dict())
         self.write_response(Result.OKEY, message)
 
     @login_required
     def on_logout(self, _):
-        log(log.INFO, "Logout player: {}".format(self.player.name))
+        log(log.INFO, "Logout player: %s", self.player.name)
+        self.unsubscribe()
         self.player.in_game = False
         if not any([p.in_game for p in self.game.players.values()]):
             self.game.stop()
@@ -192,7 +254,13 @@ class GameServerRequestHandler(BaseRequestHandler):
     @login_required
     def on_get_map(self, data: dict):
         self.check_keys(data, ['layer'])
-        message = self.game.get_map_layer(self.player, data['layer'])
+        message = self.game.get_map_layer(self.player, data['layer'], self.encoder)
+        self.write_response(Result.OKEY, message)
+
+    @login_required
+    def on_get_map_delta(self, data: dict):
+        self.check_keys(data, ['tick'])
+        message = self.game.get_map_delta(self.player, data['tick'], self.encoder)
         self.write_response(Result.OKEY, message)
 
     @login_required
@@ -203,9 +271,67 @@ class GameServerRequestHandler(BaseRequestHandler):
 
     @login_required
     def on_turn(self, _):
-        self.game.turn(self.player)
+        if self.subscribed:  # The tick will be notified by TICK_DONE push frame.
+            self.game.turn(self.player, wait=False)
+        else:
+            self.flush()  # Send responses to previous commands before waiting for the game tick.
+            self.game.turn(self.player)
+        self.write_response(Result.OKEY)
+
+    @login_required
+    def on_subscribe(self, data: dict):
+        self.push_delta = bool(data.get('delta', False))
+        self._push_tick = self.game.current_tick
+        if not self.subscribed:
+            self.subscribed = True
+            self.game.subscribe(self.on_tick_done)
         self.write_response(Result.OKEY)
 
+    def unsubscribe(self):
+        if self.subscribed:
+            self.subscribed = False
+            self.game.unsubscribe(self.on_tick_done)
+
+    def on_tick_done(self, tick, finished=False):
+        """ Pushes TICK_DONE frame to the client, called by the game after each tick.
+        The frame contains map delta since the previous notification if the delta is requested.
+        GAME_FINISHED frame with the same data is pushed when the game is finished.
+        """
+        if self.closed:
+            return
+        if self.push_delta:
+            message = self.game.get_map_delta(self.player, self._push_tick, self.encoder)
+        else:
+            message = self.encoder.encode({'tick': tick})
+        self._push_tick = tick
+        # Tick notification without delta may replace the previous one, the client needs only the latest tick:
+        self.push_response(Result.GAME_FINISHED if finished else Result.TICK_DONE, message,
+                           replace=not self.push_delta)
+
+    def push_response(self, result, message, replace=False):
+        """ Queues the frame pushed by the server and returns without waiting for the client's socket.
+        If 'replace' is True the frame replaces queued frames, when only the latest one matters.
+        If PUSH_QUEUE_SIZE frames are queued the client doesn't read them, and the connection is closed.
+        """
+        if self.closed:
+            return
+        log(log.DEBUG, 'Player: %s, push: %r, message:\n%s',
+            self.player.idx if self.player is not None else self.client_address,
+            result, log.payload(message))
+        with self._push_condition:
+            if replace:
+                self._pushes.clear()
+            overflow = len(self._pushes) >= PUSH_QUEUE_SIZE
+            if not overflow:
+                self._pushes.append(encode_response(result, message))
+                self._push_condition.notify()
+        if overflow:
+            log(log.WARNING, "Connection from %s is closed, the client doesn't read pushed frames",
+                self.client_address)
+            self.abort()
+        else:
+            self.schedule_pushes()
+
     @login_required
     def on_upgrade(self, data: dict):
         self.check_keys(data, ['train', 'post'], agg_func=any)
@@ -214,30 +340,266 @@ class GameServerRequestHandler(BaseRequestHandler):
         )
         self.write_response(Result.OKEY)
 
+    def on_metrics(self, data: dict):
+        if data.get('format') == 'prometheus':
+            message = METRICS.to_prometheus()
+        else:
+            message = self.encoder.encode(METRICS.to_dict())
+        self.write_response(Result.OKEY, message)
+
     def on_observer(self, _):
         if self.game or self.observer:
             raise errors.BadCommand("Impossible connect as observer")
         else:
-            self.observer = Observer()
+            self.observer = Observer(push=self.push_response)
             self.write_response(Result.OKEY, json.dumps(self.observer.games()))
 
     COMMAND_MAP = {
         Action.LOGIN: on_login,
         Action.LOGOUT: on_logout,
         Action.MAP: on_get_map,
+        Action.MAP_DELTA: on_get_map_delta,
         Action.MOVE: on_move,
         Action.UPGRADE: on_upgrade,
         Action.TURN: on_turn,
+        Action.SUBSCRIBE: on_subscribe,
         Action.OBSERVER: on_observer,
+        Action.METRICS: on_metrics,
     }
 
 
-@task
-def run_server(_, address=SERVER_ADDR, port=SERVER_PORT):
-    """ Launches 'WG Forge' TCP server.
+class GameServerRequestHandler(GameServerConnection, BaseRequestHandler):
+    """ Client connection served by its own thread.
+    Pushed frames are sent by the second thread of the connection, which is started on the first push.
+    """
+    def setup(self):
+        self._writer = None
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super(GameServerRequestHandler, self).setup()
+
+    def finish(self):
+        self.closed = True
+        super(GameServerRequestHandler, self).finish()
+        with self._push_condition:
+            self._push_condition.notify_all()  # Stops the writer.
+
+    def handle(self):
+        while not self.closed:
+            data = self.request.recv(RECEIVE_CHUNK_SIZE)
+            if data:
+                self.data_received(data)
+            else:
+                self.closed = True
+
+    def send(self, buffers: list):
+        send_buffers(self.request, buffers)
+
+    def schedule_pushes(self):
+        with self._push_condition:
+            if self._writer is None and not self.closed:
+                self._writer = Thread(target=self._write_pushes, name='PushWriter', daemon=True)
+                self._writer.start()
+
+    def _write_pushes(self):
+        """ Sends pushed frames until the connection is closed.
+        """
+        while True:
+            with self._push_condition:
+                while not self._pushes and not self.closed:
+                    self._push_condition.wait()
+                if self.closed:
+                    return
+                buffers = self.pop_pushes()
+            try:
+                with self._send_lock:
+                    self.send(buffers)
+            except OSError:
+                self.abort()
+                return
+
+    def abort(self):
+        self.closed = True
+        with self._push_condition:
+            self._push_condition.notify_all()
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)  # Wakes up the threads blocked on the socket.
+        except OSError:
+            pass
+
+
+class AsyncGameServerProtocol(GameServerConnection, asyncio.Protocol):
+    """ Client connection served by the event loop.
+    Socket I/O is done on the loop, commands of the connection are executed one by one on the worker pool,
+    so a blocking command never stalls the loop. TURN doesn't hold a worker while it waits for the game tick.
+    Reading from the socket is paused while received data isn't processed yet or responses aren't sent yet,
+    so a client which sends commands without reading responses can't exhaust memory of the server.
+    """
+    def __init__(self, loop, executor):
+        self.loop = loop
+        self.executor = executor
+        self.transport = None
+        self.client_address = None
+        self._chunks = deque()
+        self._buffered = 0  # Size of received data which is not processed yet.
+        self._lock = Lock()
+        self._reading_paused = False
+        self._writing_paused = False
+        self._processing = False
+        self._turn_id = 0
+        self._turn_pending = False
+        self._turn_timer = None
+        self._turn_start = None
+        super(AsyncGameServerProtocol, self).__init__()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.setup()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.loop.run_in_executor(self.executor, self.finish)
+
+    def data_received(self, data):
+        """ Queues received data, the data is processed on the worker pool.
+        """
+        with self._lock:
+            self._chunks.append(data)
+            self._buffered += len(data)
+        self._process_next()
+
+    def pause_writing(self):
+        self._writing_paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._update_reading()
+        self._write_pushes()
+
+    def _update_reading(self):
+        """ Pauses reading from the socket if too much received data is queued or the transport's write buffer is
+        full, resumes reading once they are drained. Called on the loop.
+        """
+        with self._lock:
+            paused = self._buffered >= RECEIVE_BUFFER_LIMIT or self._writing_paused
+        if paused != self._reading_paused and not self.transport.is_closing():
+            self._reading_paused = paused
+            if paused:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
+    def _process_next(self):
+        """ Starts processing of queued data if the connection is idle.
+        """
+        self._update_reading()
+        with self._lock:
+            if self._processing or self._turn_pending or not (self._chunks or self.decoder.pending()):
+                return
+            self._processing = True
+        self.loop.run_in_executor(self.executor, self._process_chunks)
+
+    def _process_chunks(self):
+        try:
+            while not self.closed and not self._turn_pending:
+                if self.read_frame():
+                    self.process_command()
+                    continue
+                with self._lock:
+                    if not self._chunks:
+                        break
+                    data = self._chunks.popleft()
+                    self._buffered -= len(data)
+                self.decoder.feed(data)
+        except Exception:
+            log(log.EXCEPTION, "Got unhandled exception on client data processing")
+            self.closed = True
+        finally:
+            self.flush()
+            with self._lock:
+                self._processing = False
+                closed = self.closed
+        if closed:
+            self.loop.call_soon_threadsafe(self.transport.close)
+        else:
+            self.loop.call_soon_threadsafe(self._process_next)
+
+    def send(self, buffers: list):
+        self.loop.call_soon_threadsafe(self.transport.writelines, buffers)
+
+    def schedule_pushes(self):
+        self.loop.call_soon_threadsafe(self._write_pushes)
+
+    def _write_pushes(self):
+        """ Writes pushed frames to the transport unless its write buffer is full. Called on the loop.
+        """
+        if self._writing_paused or self.transport.is_closing():
+            return
+        buffers = self.pop_pushes()
+        if buffers:
+            self.transport.writelines(buffers)
+
+    def abort(self):
+        self.closed = True
+        self.loop.call_soon_threadsafe(self.transport.abort)
+
+    @login_required
+    def on_turn(self, data):
+        if self.subscribed:  # Doesn't wait for the game tick.
+            return GameServerConnection.on_turn(self, data)
+        with self._lock:
+            self._turn_id += 1
+            self._turn_pending = True
+            self._turn_start = time.perf_counter()
+            turn_id = self._turn_id
+        self.metrics_deferred = True  # Metrics of the TURN are recorded when the response is sent.
+        try:
+            self.game.turn(self.player, callback=lambda: self._finish_turn(turn_id))
+        except errors.WgForgeServerError:
+            with self._lock:
+                self._turn_pending = False
+            self.metrics_deferred = False
+            raise
+        self.loop.call_soon_threadsafe(self._start_turn_timer, turn_id)
+
+    def _start_turn_timer(self, turn_id):
+        with self._lock:
+            if self._turn_pending and self._turn_id == turn_id:
+                self._turn_timer = self.loop.call_later(
+                    CONFIG.TURN_TIMEOUT, self._finish_turn, turn_id, errors.Timeout("Game tick did not happen"))
+
+    def _finish_turn(self, turn_id, error=None):
+        """ Sends response to TURN action. Called on game tick or on timeout.
+        """
+        with self._lock:
+            if not self._turn_pending or self._turn_id != turn_id:
+                return
+            self._turn_pending = False
+            timer, self._turn_timer = self._turn_timer, None
+        if timer is not None:
+            self.loop.call_soon_threadsafe(timer.cancel)
+        result = Result.OKEY if error is None else Result.TIMEOUT
+        METRICS.record(Action.TURN, result, time.perf_counter() - self._turn_start)
+        if error is None:
+            self.write_response(Result.OKEY)
+        else:
+            self.error_response(Result.TIMEOUT, error)
+        self.flush()
+        self.loop.call_soon_threadsafe(self._process_next)
+
+    COMMAND_MAP = dict(GameServerConnection.COMMAND_MAP)
+    COMMAND_MAP[Action.TURN] = on_turn
+
+
+def serve_threading(address, port):
+    """ Serves clients, one thread per connection.
     """
     server = ThreadingTCPServer((address, port), GameServerRequestHandler)
-    log(log.INFO, "Serving on {}".format(server.socket.getsockname()))
+    log(log.INFO, "Serving on %s", server.socket.getsockname())
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -248,3 +610,50 @@ def run_server(_, address=SERVER_ADDR, port=SERVER_PORT):
         finally:
             server.shutdown()
             server.server_close()
+
+
+def serve_asyncio(address, port, workers):
+    """ Serves clients on single event loop, commands are executed on the pool of workers.
+    """
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    server = loop.run_until_complete(
+        loop.create_server(lambda: AsyncGameServerProtocol(loop, executor), address, port)
+    )
+    log(log.INFO, "Serving on %s, workers: %s", server.sockets[0].getsockname(), workers)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        log(log.WARNING, "Server stopped by keyboard interrupt...")
+    finally:
+        try:
+            Game.stop_all_games()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            executor.shutdown(wait=False)
+            loop.close()
+
+
+SERVER_MODES = ('threading', 'asyncio')
+
+
+@task
+def run_server(_, address=SERVER_ADDR, port=SERVER_PORT, mode='threading', workers=SERVER_WORKERS, log_level=None,
+               metrics_port=METRICS_PORT):
+    """ Launches 'WG Forge' TCP server.
+    Modes: 'threading' - thread per connection, 'asyncio' - event loop with pool of workers.
+    Metrics in Prometheus format are served on http://127.0.0.1:{metrics_port}/metrics if the port is not 0.
+    """
+    if log_level is not None:
+        log.set_level(log_level)
+    if mode not in SERVER_MODES:
+        log(log.ERROR, "Unknown server mode: '%s', available: %s", mode, ', '.join(SERVER_MODES))
+        sys.exit(1)
+    if metrics_port:
+        serve_metrics('127.0.0.1', int(metrics_port))
+    DbReplay.migrate_db()
+    if mode == 'asyncio':
+        serve_asyncio(address, port, workers)
+    else:
+        serve_threading(address, port)
@@ -0,0 +1,91 @@
+""" Headless simulation: bots play complete games in-process, without sockets and tick delays.
+"""
+import importlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from invoke import task
+
+import errors
+from entity.game import Game
+from entity.player import Player
+from game_config import CONFIG
+from logger import log
+
+DEFAULT_TICKS = 1000
+
+
+def play_game(bots, ticks=DEFAULT_TICKS, seed=None, map_name=CONFIG.MAP_NAME, name=None):
+    """ Plays one game as fast as possible, the game is deterministic if the seed is specified.
+    Messages of each tick and train are logged only at DEBUG level.
+    Each bot is a callable 'bot(game, player)' which is called before each tick, it reads the game entities and
+    makes actions by 'game.move_train' and 'game.make_upgrade' on behalf of the player.
+    Errors of bot's actions are counted, events of player's posts and trains are cleaned after the bot's call.
+    returns: dict with results of the game
+    """
+    name = 'Simulation {}'.format(seed) if name is None else name
+    game = Game(name, map_name, num_players=len(bots), seed=seed, headless=True)
+    players = []
+    for number, bot in enumerate(bots, start=1):
+        player = Player('{} {}'.format(getattr(bot, '__name__', type(bot).__name__), number))
+        game.add_player(player)
+        players.append(player)
+
+    errors_count = {p.name: 0 for p in players}
+    for _ in range(ticks):
+        for bot, player in zip(bots, players):
+            try:
+                bot(game, player)
+            except errors.WgForgeServerError as err:
+                errors_count[player.name] += 1
+                log(log.DEBUG, "Bot's action failed, player: %s, error: %s", player.name, err)
+            game.clean_user_events(player)
+        game.tick()
+    game.stop()
+
+    return {
+        'name': name,
+        'seed': seed,
+        'ticks': game.current_tick,
+        'rating': {p.name: p.rating for p in players},
+        'errors': errors_count,
+    }
+
+
+def _play_game(bots, ticks, seed, map_name, log_level):
+    """ Entry point of worker process.
+    """
+    log.set_level(log_level)
+    return play_game(bots, ticks=ticks, seed=seed, map_name=map_name)
+
+
+def play_games(bots, games, ticks=DEFAULT_TICKS, seed=0, map_name=CONFIG.MAP_NAME, processes=None,
+               log_level=log.WARNING):
+    """ Plays independent games on the pool of processes, game number N uses seed 'seed + N'.
+    Bots must be picklable: module level functions or instances of module level classes.
+    returns: list of results of the games ordered by seed
+    """
+    seeds = list(range(seed, seed + games))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(
+            _play_game, [bots] * games, [ticks] * games, seeds, [map_name] * games, [log_level] * games))
+
+
+def load_bot(path):
+    """ Returns bot by its path: 'module:callable'.
+    """
+    module_name, _, attr = path.partition(':')
+    try:
+        return getattr(importlib.import_module(module_name), attr)
+    except (ImportError, AttributeError, ValueError):
+        raise errors.ResourceNotFound("Bot not found, path: '{}'".format(path))
+
+
+@task
+def simulate(_, bots, games=1, ticks=DEFAULT_TICKS, seed=0, map_name=CONFIG.MAP_NAME, processes=0):
+    """ Plays games by bots without server, 'bots' is comma separated list of bot paths: 'module:callable'.
+    """
+    bots = [load_bot(path) for path in bots.split(',')]
+    results = play_games(bots, games, ticks=ticks, seed=seed, map_name=map_name, processes=processes or None)
+    for result in results:
+        print(json.dumps(result, sort_keys=True))
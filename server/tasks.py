@@ -1,6 +1,7 @@
 """ WG Forge server tasks.
 """
 from db.shell import dbshell  # noqa F401
-from db.map import generate_map  # noqa F401
-from db.replay import generate_replay  # noqa F401
+from db.map import generate_map, compile_map  # noqa F401
+from db.replay import generate_replay, explain_replay  # noqa F401
 from server import run_server  # noqa F401
+from simulation import simulate  # noqa F401
@@ -111,6 +111,27 @@ class TestClient(unittest.TestCase):
         self.assertEqual(len(map02.post), 6)
         self.assertEqual(len(map02.train), CONFIG.TRAINS_COUNT)
 
+    def test_2_get_map_delta(self):
+        """ Test map delta contains the whole layer 1 for unknown tick and only changes for the current tick.
+        """
+        result, message = self.do_action(Action.MAP_DELTA, {'tick': -1})
+        self.assertEqual(Result.OKEY, result)
+        delta = json.loads(message)
+        self.assertTrue(delta['full'])
+        self.assertEqual(len(delta['post']), 6)
+        self.assertEqual(len(delta['train']), CONFIG.TRAINS_COUNT)
+        self.assertIn('rating', delta)
+
+        tick = delta['tick']
+        result, message = self.do_action(Action.MAP_DELTA, {'tick': tick})
+        self.assertEqual(Result.OKEY, result)
+        delta = json.loads(message)
+        self.assertFalse(delta['full'])
+        self.assertEqual(delta['tick'], tick)
+
+        result, _ = self.do_action(Action.MAP_DELTA, {'tick': 'last'})
+        self.assertEqual(Result.BAD_COMMAND, result)
+
     def test_2_get_map_layer_10(self):
         """ Test layer_to_json_str and from_json_str for layer 10.
         """
@@ -261,6 +282,48 @@ class TestClient(unittest.TestCase):
         post = self.get_post(1)
         self.assertEqual(int(post['product']), start_product-4)
 
+    def test_7_compact_encoding(self):
+        """ Test responses are encoded with encoding requested on login.
+        """
+        connection = ServerConnection()
+        try:
+            result, message = connection.send_action(
+                Action.LOGIN, {'name': self.PLAYER_NAME + ' compact', 'encoding': 'compact'})
+            self.assertEqual(Result.OKEY, result)
+            self.assertNotIn('\n', message)
+            self.assertIn('idx', json.loads(message))
+            result, message = connection.send_action(Action.MAP, {'layer': 1})
+            self.assertEqual(Result.OKEY, result)
+            self.assertNotIn('\n', message)
+            self.assertEqual(len(json.loads(message)['train']), CONFIG.TRAINS_COUNT)
+            result, _ = connection.send_action(Action.LOGOUT)
+            self.assertEqual(Result.OKEY, result)
+        finally:
+            connection.close()
+
+    def test_7_subscribe(self):
+        """ Test TICK_DONE frames are pushed to subscribed connection, TURN doesn't wait for the tick.
+        """
+        connection = ServerConnection()
+        try:
+            result, _ = connection.send_action(Action.LOGIN, {'name': self.PLAYER_NAME + ' subscriber'})
+            self.assertEqual(Result.OKEY, result)
+            result, _ = connection.send_action(Action.SUBSCRIBE, {'delta': True})
+            self.assertEqual(Result.OKEY, result)
+            for tick in (1, 2):
+                connection.send_action(Action.TURN, {}, wait_for_response=False)
+                # The push frame can outrun the TURN response:
+                frames = dict([connection.read_response(), connection.read_response()])
+                self.assertEqual(sorted(frames), [Result.OKEY, Result.TICK_DONE])
+                delta = json.loads(frames[Result.TICK_DONE])
+                self.assertEqual(delta['tick'], tick)
+                self.assertFalse(delta['full'])
+                self.assertIn('rating', delta)
+            result, _ = connection.send_action(Action.LOGOUT)
+            self.assertEqual(Result.OKEY, result)
+        finally:
+            connection.close()
+
     def test_8_wrong_actions(self):
         """ Test error codes on wrong action messages.
         """
@@ -268,3 +331,24 @@ class TestClient(unittest.TestCase):
         self.assertEqual(Result.BAD_COMMAND, result)
         result, _ = self.do_action_raw(Action.LOGIN, '1234567890')
         self.assertEqual(Result.BAD_COMMAND, result)
+        result, _ = self.do_action(Action.LOGIN, {'name': self.PLAYER_NAME, 'encoding': 'xml'})
+        self.assertEqual(Result.BAD_COMMAND, result)
+
+    def test_8_metrics(self):
+        """ Test statistics of executed actions.
+        """
+        result, _ = self.do_action(Action.LOGIN, {})
+        self.assertEqual(Result.BAD_COMMAND, result)
+        result, message = self.do_action(Action.METRICS, {})
+        self.assertEqual(Result.OKEY, result)
+        metrics = json.loads(message)
+        self.assertGreater(metrics['uptime'], 0)
+        login = metrics['actions']['LOGIN']
+        self.assertGreater(login['count'], 0)
+        self.assertGreater(login['errors']['BAD_COMMAND'], 0)
+        self.assertEqual(login['latency'][-1], [None, login['count']])
+
+        result, message = self.do_action(Action.METRICS, {'format': 'prometheus'})
+        self.assertEqual(Result.OKEY, result)
+        self.assertIn('wg_forge_action_latency_seconds_count{action="LOGIN"}', message)
+        self.assertIn('wg_forge_action_results_total{action="LOGIN",result="OKEY"}', message)
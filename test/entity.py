@@ -1,10 +1,21 @@
 """ Test server entities.
 """
 import json
+import os
+import random
+import tempfile
 import unittest
+from unittest import mock
 
-from server.db.map import generate_map02, DbMap
+from server.db import map_snapshot
+from server.db.map import generate_map02, compile_snapshot, DbMap
 from server.db.session import map_session_ctx
+from server.defs import GameState
+from server.encoders import ENCODERS, CompactJsonEncoder
+from server.entity.event import Event, EventType
+from server.entity import game as game_module
+from server.entity.game import Game
+from server.entity import map as map_module
 from server.entity.map import Map
 from server.entity.player import Player
 from server.entity.point import Point
@@ -33,6 +44,16 @@ class TestEntity(unittest.TestCase):
     def tearDown(self):
         pass
 
+    @staticmethod
+    def create_game(name, seed=None):
+        """ Creates observed game on the test map with one player.
+        returns: tuple (game, player)
+        """
+        game = Game(name, CONFIG.MAP_NAME, observed=True, seed=seed)
+        player = Player(name + ' player')
+        game.add_player(player)
+        return game, player
+
     def test_map_init(self):
         """ Test create map entity.
         """
@@ -121,6 +142,302 @@ class TestEntity(unittest.TestCase):
         self.assertEqual(len(new_map.post), 0)
         self.assertEqual(len(new_map.train), 0)
 
+    def test_map_static_layers_cache(self):
+        """ Test static layers are encoded once and shared by all maps with the same name.
+        """
+        map_1 = Map(CONFIG.MAP_NAME)
+        map_2 = Map(CONFIG.MAP_NAME)
+        for layer in Map.STATIC_LAYERS:
+            layer_data = map_1.layer_to_bytes(layer)
+            self.assertEqual(layer_data, map_1.layer_to_json_str(layer).encode('utf-8'))
+            self.assertIs(layer_data, map_2.layer_to_bytes(layer))
+        self.assertEqual(map_1.layer_to_bytes(1), map_1.layer_to_json_str(1).encode('utf-8'))
+
+        # The map has been changed:
+        map_2.fingerprint += 1
+        self.assertIsNot(map_2.layer_to_bytes(0), map_1.layer_to_bytes(0))
+
+        Map.invalidate_cache(CONFIG.MAP_NAME)
+        self.assertEqual(len([k for k in Map.STATIC_LAYERS_CACHE if k[0] == CONFIG.MAP_NAME]), 0)
+
+    def test_map_template(self):
+        """ Test maps share static part of the map loaded from DB once and have own posts.
+        """
+        map_1 = Map(CONFIG.MAP_NAME)
+        map_2 = Map(CONFIG.MAP_NAME)
+        self.assertIs(map_1.line, map_2.line)
+        self.assertIs(map_1.point, map_2.point)
+        self.assertIs(map_1.coordinate, map_2.coordinate)
+        self.assertEqual(map_1.post.keys(), map_2.post.keys())
+        for idx, post in map_1.post.items():
+            self.assertIsNot(post, map_2.post[idx])
+            self.assertEqual(post.__dict__, map_2.post[idx].__dict__)
+        self.assertEqual(len(map_1.towns), len(map_2.towns))
+        self.assertTrue(all(t in map_1.post.values() for t in map_1.towns))
+
+        map_1.post[map_1.towns[0].idx].population += 1
+        self.assertNotEqual(map_1.towns[0].population, map_2.towns[0].population)
+
+        # The map DB has been changed:
+        Map.TEMPLATES[CONFIG.MAP_NAME] = (None, Map.TEMPLATES[CONFIG.MAP_NAME][1])
+        self.assertIsNot(Map(CONFIG.MAP_NAME).line, map_1.line)
+
+        Map.invalidate_cache(CONFIG.MAP_NAME)
+        self.assertNotIn(CONFIG.MAP_NAME, Map.TEMPLATES)
+        self.assertEqual(Map(CONFIG.MAP_NAME).fingerprint, map_1.fingerprint)
+
+    def test_map_snapshot(self):
+        """ Test maps are loaded from compiled snapshot of map DB without DB queries while map DB is not changed.
+        """
+        db_map = Map(CONFIG.MAP_NAME)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, 'map.snapshot')
+            self.assertIn(CONFIG.MAP_NAME, compile_snapshot(snapshot_path))
+
+            with mock.patch.object(map_module, 'MAP_SNAPSHOT_PATH', snapshot_path), \
+                    mock.patch.object(map_module, 'map_session_ctx', side_effect=AssertionError("DB is used")):
+                snapshot_map = Map(CONFIG.MAP_NAME)
+            with mock.patch.object(map_snapshot, '_read_map', wraps=map_snapshot._read_map) as read_map:
+                _, map_data = map_snapshot.read_snapshot(snapshot_path, CONFIG.MAP_NAME)
+                self.assertEqual(map_data['name'], CONFIG.MAP_NAME)
+                self.assertIsNone(map_snapshot.read_snapshot(snapshot_path, 'Unknown map')[1])
+            self.assertEqual([c[0][2] for c in read_map.call_args_list], [CONFIG.MAP_NAME])  # Other maps aren't read.
+            for layer in (0, 1, 10):
+                self.assertEqual(snapshot_map.layer_to_json_str(layer), db_map.layer_to_json_str(layer))
+            self.assertEqual(snapshot_map.fingerprint, db_map.fingerprint)
+            self.assertEqual(snapshot_map.point_lines, db_map.point_lines)
+            self.assertEqual(snapshot_map.line_position, db_map.line_position)
+
+            # The map DB has been changed after compilation:
+            with mock.patch.object(map_module, 'MAP_SNAPSHOT_PATH', snapshot_path), \
+                    mock.patch.object(map_module, 'map_db_stamp', return_value=((0, 0), None)):
+                self.assertNotIn('point_lines', map_module.load_map_data(CONFIG.MAP_NAME))
+
+            # The snapshot is corrupted:
+            with open(snapshot_path, 'r+b') as snapshot_file:
+                snapshot_file.truncate(100)
+            with mock.patch.object(map_module, 'MAP_SNAPSHOT_PATH', snapshot_path):
+                self.assertNotIn('point_lines', map_module.load_map_data(CONFIG.MAP_NAME))
+        Map.invalidate_cache()
+
+    def test_map_adjacency(self):
+        """ Test indexes of lines by their points.
+        """
+        game_map = Map(CONFIG.MAP_NAME)
+        for point_idx in game_map.point:
+            self.assertEqual(
+                game_map.point_lines[point_idx], [l.idx for l in game_map.line.values() if point_idx in l.point])
+        for line in game_map.line.values():
+            self.assertEqual(game_map.line_position[line.idx, line.point[0]], 0)
+            self.assertEqual(game_map.line_position[line.idx, line.point[1]], line.length)
+        self.assertEqual(len(game_map.line_position), 2 * len(game_map.line))
+
+        new_map = Map()
+        new_map.from_json_str(game_map.layer_to_json_str(0))
+        self.assertEqual(new_map.point_lines, game_map.point_lines)
+        self.assertEqual(new_map.line_position, game_map.line_position)
+
+    def test_game_dynamic_layer(self):
+        """ Test layer 1 snapshot is updated on game state changes and is equal to full layer serialization.
+        """
+        def full_layer(game):
+            data = json.loads(game.map.layer_to_json_str(1))
+            data['rating'] = game.get_rating()
+            return data
+
+        game, player = self.create_game('Test dynamic layer')
+        train = list(player.train.values())[0]
+
+        layer_data = game.get_map_layer(player, 1)
+        self.assertEqual(json.loads(layer_data.decode('utf-8')), full_layer(game))
+        self.assertIs(game.get_map_layer(player, 1), layer_data)
+
+        game.move_train(player, train.idx, 1, train.line_idx)
+        game.tick()
+        self.assertEqual(game.changes[-1][2], {train.idx})
+        self.assertEqual(game.update_dynamic_layer(), ([], []))
+        layer_data = game.get_map_layer(player, 1)
+        self.assertEqual(json.loads(layer_data.decode('utf-8')), full_layer(game))
+
+        player.town.event.append(Event(EventType.PARASITES_ASSAULT, game.current_tick, parasites_power=1))
+        data = json.loads(game.get_map_layer(player, 1).decode('utf-8'))
+        town = [p for p in data['post'] if p['idx'] == player.town.idx][0]
+        self.assertEqual(town['event'], [{'parasites_power': 1, 'tick': game.current_tick, 'type': 3}])
+        self.assertEqual(data, full_layer(game))
+        game.clean_user_events(player)
+        self.assertIs(game.get_map_layer(player, 1), layer_data)
+
+    def test_game_rejected_move(self):
+        """ Test rejected move doesn't invalidate snapshot of dynamic layer.
+        """
+        game, player = self.create_game('Test rejected move')
+        train = list(player.train.values())[0]
+        train_points = set(game.map.line[train.line_idx].point)
+        other_line = [l for l in game.map.line.values() if not train_points & set(l.point)][0]
+        layer_data = game.get_map_layer(player, 1)
+
+        train.cooldown = 1
+        with self.assertRaises(game_module.errors.BadCommand):
+            game.move_train(player, train.idx, 1, train.line_idx)
+        train.cooldown = 0
+        with self.assertRaises(game_module.errors.BadCommand):
+            game.move_train(player, train.idx, 1, other_line.idx)
+        self.assertIs(game.get_map_layer(player, 1), layer_data)
+
+        game.move_train(player, train.idx, 1, train.line_idx)
+        self.assertEqual(json.loads(game.get_map_layer(player, 1).decode('utf-8'))['train'][0]['speed'], 1)
+
+    def test_game_layers_encodings(self):
+        """ Test map layers encoded with different encodings contain the same data.
+        """
+        game, player = self.create_game('Test layers encodings')
+        player.town.event.append(Event(EventType.PARASITES_ASSAULT, game.current_tick, parasites_power=1))
+        decoders = {'json': json.loads, 'compact': json.loads}
+        if 'msgpack' in ENCODERS:
+            import msgpack
+            decoders['msgpack'] = msgpack.unpackb
+        for layer in (0, 1, 10):
+            expected = json.loads(game.get_map_layer(player, layer).decode('utf-8'))
+            for name, decode in decoders.items():
+                layer_data = decode(game.get_map_layer(player, layer, ENCODERS[name]))
+                self.assertEqual(json.loads(json.dumps(layer_data)), expected)
+        self.assertNotIn(b'\n', game.get_map_layer(player, 1, CompactJsonEncoder()))
+
+        game.tick()
+        expected = json.loads(game.get_map_delta(player, 0).decode('utf-8'))
+        for name, decode in decoders.items():
+            delta = decode(game.get_map_delta(player, 0, ENCODERS[name]))
+            self.assertEqual(json.loads(json.dumps(delta)), expected)
+
+    def test_game_map_delta(self):
+        """ Test map delta contains posts and trains changed since specified tick.
+        """
+        game, player = self.create_game('Test map delta')
+        train_1, train_2 = list(player.train.values())[:2]
+
+        delta = json.loads(game.get_map_delta(player, 0).decode('utf-8'))
+        self.assertFalse(delta['full'])
+        self.assertEqual(len(delta['train']), len(game.map.train))
+        self.assertEqual(delta['tick'], 0)
+
+        game.move_train(player, train_1.idx, 1, train_1.line_idx)
+        game.tick()
+        game.move_train(player, train_2.idx, 1, train_2.line_idx)
+        game.tick()
+        game.tick()
+        delta = json.loads(game.get_map_delta(player, 2).decode('utf-8'))
+        self.assertEqual(sorted(t['idx'] for t in delta['train']), sorted([train_1.idx, train_2.idx]))
+        self.assertEqual(delta['rating'], json.loads(json.dumps(game.get_rating())))
+        self.assertEqual(delta['tick'], 3)
+        train_data = [t for t in delta['train'] if t['idx'] == train_1.idx][0]
+        self.assertEqual(train_data['position'], train_1.position)
+
+        # Changes for old ticks are not kept:
+        for _ in range(CONFIG.MAP_DELTA_HISTORY):
+            game.tick()
+        delta = json.loads(game.get_map_delta(player, 1).decode('utf-8'))
+        self.assertTrue(delta['full'])
+        self.assertEqual(len(delta['train']), len(game.map.train))
+        delta = json.loads(game.get_map_delta(player, game.current_tick + 1).decode('utf-8'))
+        self.assertTrue(delta['full'])
+
+    def test_game_collision_pairs(self):
+        """ Test bucketed collision detection finds the same pairs as check of all pairs of trains.
+        """
+        game, player = self.create_game('Test collision pairs')
+        for _ in range(24):
+            train = Train(idx=len(game.trains) + 1, player_id=player.idx)
+            game.map.add_train(train)
+            game.trains[train.idx] = train
+        lines = list(game.map.line.values())[:4]
+        rand = random.Random(0)
+        collisions_count = 0
+        for _ in range(200):
+            for train in game.trains.values():
+                line = rand.choice(lines)
+                train.line_idx = line.idx
+                train.position = rand.randint(0, line.length)
+                train.speed = rand.choice((-1, 0, 1))
+            trains = list(game.trains.values())
+            expected = [
+                (train_1, train_2) for i, train_1 in enumerate(trains) for train_2 in trains[i + 1:]
+                if game.is_collision(
+                    train_1, train_2, game.is_train_at_point(train_1), game.is_train_at_point(train_2))
+            ]
+            self.assertEqual(game.get_collision_pairs(), expected)
+            collisions_count += len(expected)
+        self.assertGreater(collisions_count, 0)
+
+    def test_game_save_restore_state(self):
+        """ Test game restored from saved state plays the same as the original game.
+        """
+        game, player = self.create_game('Test save restore state', seed=1)
+        train_1, train_2 = list(player.train.values())[:2]
+
+        def play(ticks):
+            for _ in range(ticks):
+                game.tick()
+            return json.loads(game.get_map_layer(player, 1).decode('utf-8'))
+
+        game.move_train(player, train_1.idx, 1, train_1.line_idx)
+        play(2)
+        state = game.save_state()
+        game.move_train(player, train_2.idx, 1, train_2.line_idx)
+        expected = play(5)
+
+        game.restore_state(state)
+        self.assertEqual(game.current_tick, 2)
+        self.assertEqual(train_2.speed, 0)
+        self.assertIs(player.train[train_1.idx], game.map.train[train_1.idx])
+        delta = json.loads(game.get_map_delta(player, 0).decode('utf-8'))
+        self.assertTrue(delta['full'])
+        game.move_train(player, train_2.idx, 1, train_2.line_idx)
+        self.assertEqual(play(5), expected)
+
+        # Saved state is not changed by restored game:
+        game.restore_state(state)
+        game.move_train(player, train_2.idx, 1, train_2.line_idx)
+        self.assertEqual(play(5), expected)
+
+    def test_game_spectators(self):
+        """ Test layer is published for spectators without the game lock, stopped game notifies and removes
+        subscribers and spectators.
+        """
+        game, player = self.create_game('Test spectators')
+        spectated, notified = [], []
+        encode_snapshot = game.dynamic_layer.encode_snapshot
+
+        def encode_without_lock(snapshot):
+            self.assertFalse(game._lock.locked())
+            return encode_snapshot(snapshot)
+
+        with mock.patch.object(game.dynamic_layer, 'encode_snapshot', side_effect=encode_without_lock) as encode:
+            tick, layer = game.add_spectator(lambda *args, **kwargs: spectated.append((args, kwargs)))
+            game.subscribe(lambda *args, **kwargs: notified.append((args, kwargs)))
+            self.assertEqual(json.loads(layer.decode('utf-8'))['tick'], tick)
+            game.tick()
+            game.stop()
+        self.assertEqual(encode.call_count, 2)
+        self.assertEqual(notified, [((1, ), {'finished': True})])
+        (args, kwargs), = spectated
+        self.assertEqual((args[0], json.loads(args[1].decode('utf-8'))['tick'], kwargs), (1, 1, {'finished': True}))
+        full_delta = game.get_map_delta(player, -1)
+        self.assertEqual(json.loads(args[1].decode('utf-8')), json.loads(full_delta.decode('utf-8')))
+        self.assertEqual((game._subscribers, game._spectators), ([], []))
+
+    def test_game_stop_replay(self):
+        """ Test stopped game doesn't wait until its replay is written, server shutdown waits for all replays.
+        """
+        game = Game('Test stop replay', CONFIG.MAP_NAME, observed=True)
+        game.replay = mock.Mock()
+        Game.GAMES[game.name] = game
+        with mock.patch.object(game_module, 'REPLAY_WRITER') as writer:
+            Game.stop_all_games()
+        self.assertNotIn(game.name, Game.GAMES)
+        game.replay.set_game_state.assert_called_once_with(GameState.FINISHED)
+        game.replay.flush.assert_not_called()
+        writer.flush.assert_called_once_with()
+
     def test_player_init(self):
         """ Test create player entity.
         """
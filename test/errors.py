@@ -69,6 +69,16 @@ class TestErrors(unittest.TestCase):
         self.assertEqual(exp_result, result)
         return json.loads(message)
 
+    def test_too_large_frame(self):
+        """ Connection is closed after the frame which data length exceeds the limit.
+        """
+        header = Action.LOGIN.to_bytes(4, byteorder='little') + (2 ** 32 - 1).to_bytes(4, byteorder='little')
+        self.connection.send(header)
+        result, message = self.connection.read_response()
+        self.assertEqual(Result.BAD_COMMAND, result)
+        self.assertIn("The command is too large", json.loads(message)['error'])
+        self.assertEqual(self.connection.sock.recv(1), b'')
+
     def test_login(self):
         self.login()
         message = self.login(security_key='incorrect-key', exp_result=Result.ACCESS_DENIED)
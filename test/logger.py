@@ -0,0 +1,96 @@
+""" Test logger wrapper.
+"""
+import io
+import json
+import queue
+import unittest
+from threading import Thread
+from unittest import mock
+
+from server.defs import LOG_LEVEL
+from server.logger import DroppingQueueHandler, Logger
+
+
+class Unformattable(object):
+    """ Fails the test if it's formatted.
+    """
+    def __str__(self):
+        raise AssertionError("Argument of filtered message is formatted")
+
+
+class TestLogger(unittest.TestCase):
+    """ Test class.
+    """
+
+    def setUp(self):
+        self.log = Logger(level='INFO', payload_limit=10)
+
+    def tearDown(self):
+        self.log.set_level(LOG_LEVEL)
+        self.log.set_output()
+
+    def test_lazy_format(self):
+        """ Test arguments of messages of disabled level are not formatted.
+        """
+        with mock.patch.object(self.log._log, 'handle') as handle:
+            self.log(self.log.DEBUG, 'Message: %s', Unformattable())
+            self.assertFalse(self.log.is_enabled(self.log.DEBUG))
+            handle.assert_not_called()
+            self.log(self.log.INFO, 'Message: %s, %d', 'text', 1)
+            self.assertEqual(handle.call_args[0][0].getMessage(), 'Message: text, 1')
+            self.log.set_level('debug')
+            self.assertTrue(self.log.is_enabled(self.log.DEBUG))
+
+    def test_payload(self):
+        """ Test long payloads are truncated, binary payloads are replaced by size.
+        """
+        self.assertEqual(str(self.log.payload('short')), 'short')
+        self.assertEqual(str(self.log.payload('x' * 20)), 'xxxxxxxxxx... <20 chars>')
+        self.assertEqual(str(self.log.payload(b'x' * 20)), '<20 bytes>')
+
+    def test_queue_output(self):
+        """ Test records are written by background thread as JSON lines, message arguments are formatted on logging.
+        """
+        stream = io.StringIO()
+        self.log.set_output('json', queue_size=100, stream=stream)
+        data = {'value': 1}
+        self.log(self.log.INFO, 'Message: %s', data)
+        data['value'] = 2
+        try:
+            raise ValueError('Test error')
+        except ValueError:
+            self.log(self.log.EXCEPTION, 'Error')
+        self.log.stop()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([r['message'] for r in records], ["Message: {'value': 1}", 'Error'])
+        self.assertEqual(records[0]['level'], 'INFO')
+        self.assertIn('ValueError: Test error', records[1]['exception'])
+        self.assertEqual(self.log.dropped, 0)
+
+    def test_queue_drop_policy(self):
+        """ Test records are dropped if the queue is full.
+        """
+        for drop_policy, expected in (('newest', ['1', '2']), ('oldest', ['2', '3'])):
+            handler = DroppingQueueHandler(queue.Queue(2), drop_policy)
+            with mock.patch.object(self.log._log, 'handlers', [handler]):
+                for i in range(1, 4):
+                    self.log(self.log.INFO, '%s', i)
+            self.assertEqual([handler.queue.get_nowait().msg for _ in range(2)], expected)
+            self.assertEqual(handler.dropped, 1)
+        with self.assertRaises(ValueError):
+            DroppingQueueHandler(queue.Queue(2), 'random')
+
+    def test_queue_handler_lock(self):
+        """ Test records are queued without taking the handler's lock, which is kept for logging internals.
+        """
+        handler = DroppingQueueHandler(queue.Queue(2))
+        handler.addFilter(lambda record: record.msg != 'Filtered')
+        self.assertIsNotNone(handler.lock)
+        with mock.patch.object(self.log._log, 'handlers', [handler]):
+            thread = Thread(target=lambda: [self.log(self.log.INFO, message) for message in ('Filtered', 'Queued')])
+            with handler.lock:
+                thread.start()
+                thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(handler.queue.get_nowait().msg, 'Queued')
+        self.assertTrue(handler.queue.empty())
@@ -0,0 +1,51 @@
+""" Test metrics of client actions.
+"""
+import unittest
+from threading import Thread
+
+from server.defs import Action, Result
+from server.metrics import LATENCY_BUCKETS, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """ Test class.
+    """
+
+    def test_record(self):
+        """ Test statistics recorded by several threads are summed up.
+        """
+        metrics = Metrics()
+
+        def record():
+            for _ in range(100):
+                metrics.record(Action.MOVE, Result.OKEY, 0.002)
+            metrics.record(Action.MOVE, Result.BAD_COMMAND, 20)
+
+        threads = [Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.record(Action.TURN, Result.OKEY, 0)
+
+        stats = metrics.to_dict()['actions']
+        self.assertEqual(sorted(stats), ['MOVE', 'TURN'])
+        self.assertEqual(stats['MOVE']['count'], 404)
+        self.assertEqual(stats['MOVE']['errors'], {'BAD_COMMAND': 4})
+        self.assertAlmostEqual(stats['MOVE']['total_time'], 400 * 0.002 + 4 * 20)
+        latency = dict((str(bound), count) for bound, count in stats['MOVE']['latency'])
+        self.assertEqual(latency['0.001'], 0)
+        self.assertEqual(latency['0.0025'], 400)
+        self.assertEqual(latency[str(LATENCY_BUCKETS[-1])], 400)
+        self.assertEqual(latency['None'], 404)
+
+        # Shards of finished threads are merged:
+        self.assertEqual(len(metrics._shards), 1)
+        self.assertEqual(metrics.to_dict()['actions']['MOVE']['count'], 404)
+
+        text = metrics.to_prometheus()
+        self.assertIn('wg_forge_action_latency_seconds_bucket{action="MOVE",le="+Inf"} 404\n', text)
+        self.assertIn('wg_forge_action_results_total{action="MOVE",result="BAD_COMMAND"} 4\n', text)
+
+        metrics.reset()
+        self.assertEqual(metrics.to_dict()['actions'], {})
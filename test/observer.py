@@ -171,3 +171,70 @@ class TestObserver(unittest.TestCase):
         # Get last my game.
         game = my_games[-1]
         self.assertGreater(game['length'], 0)
+
+
+    def test_8_observer_filter_game_list(self):
+        """ Get filtered page of recorded games, verify list of games.
+        """
+        result, message = self.do_action(Action.GAMES, {'name': 'Test', 'map': CONFIG.MAP_NAME, 'limit': 1})
+        self.assertEqual(Result.OKEY, result)
+        games = json.loads(message)
+        self.assertEqual(len(games), 1)
+        self.assertEqual(games[0]['name'], 'Test')
+        self.assertGreater(games[0]['length'], 0)
+
+        result, message = self.do_action(Action.GAMES, {'name': 'Test', 'offset': 1, 'limit': 1})
+        self.assertEqual(Result.OKEY, result)
+        self.assertNotEqual(json.loads(message), games)
+
+        result, message = self.do_action(Action.GAMES, {'map': 'Unknown map'})
+        self.assertEqual(Result.OKEY, result)
+        self.assertEqual(json.loads(message), [])
+
+        result, _ = self.do_action(Action.GAMES, {'limit': -1})
+        self.assertEqual(Result.BAD_COMMAND, result)
+        result, _ = self.do_action(Action.GAMES, {'date_from': '2018-01-01'})
+        self.assertEqual(Result.BAD_COMMAND, result)
+
+    def test_9_observer_spectate_running_game(self):
+        """ Attach to running game, verify layer of the game is pushed after each tick.
+        """
+        player_name = self.PLAYER_NAME + ' spectated'
+        player_conn = ServerConnection()
+        observer_conn = ServerConnection()
+        try:
+            result, _ = player_conn.send_action(Action.LOGIN, {'name': player_name})
+            self.assertEqual(Result.OKEY, result)
+            result, _ = observer_conn.send_action(Action.OBSERVER, None)
+            self.assertEqual(Result.OKEY, result)
+            result, _ = observer_conn.send_action(Action.SPECTATE, {'game': 'Unknown game'})
+            self.assertEqual(Result.RESOURCE_NOT_FOUND, result)
+            result, message = observer_conn.send_action(Action.SPECTATE, {'game': 'Game of {}'.format(player_name)})
+            self.assertEqual(Result.OKEY, result)
+            layer = json.loads(message)
+            self.assertEqual(layer['tick'], 0)
+            self.assertEqual(len(layer['train']), CONFIG.TRAINS_COUNT)
+            result, _ = observer_conn.send_action(Action.TURN, {'idx': 1})
+            self.assertEqual(Result.BAD_COMMAND, result)
+
+            for tick in (1, 2):
+                result, _ = player_conn.send_action(Action.TURN, {})
+                self.assertEqual(Result.OKEY, result)
+                result, message = observer_conn.read_response()
+                self.assertEqual(Result.TICK_DONE, result)
+                self.assertEqual(json.loads(message)['tick'], tick)
+            result, message = observer_conn.send_action(Action.MAP, {'layer': 1})
+            self.assertEqual(Result.OKEY, result)
+            self.assertEqual(json.loads(message)['tick'], 2)
+            result, message = observer_conn.send_action(Action.MAP, {'layer': 0})
+            self.assertEqual(Result.OKEY, result)
+            self.assertIn('line', json.loads(message))
+
+            result, _ = player_conn.send_action(Action.LOGOUT, None)
+            self.assertEqual(Result.OKEY, result)
+            result, message = observer_conn.read_response()
+            self.assertEqual(Result.GAME_FINISHED, result)
+            self.assertEqual(json.loads(message)['tick'], 2)
+        finally:
+            player_conn.close()
+            observer_conn.close()
@@ -0,0 +1,297 @@
+""" Test client-server protocol helpers.
+"""
+import asyncio
+import json
+import socket
+import time
+import unittest
+from concurrent.futures import Future
+from threading import Thread
+
+from server import encoders, protocol
+from server.defs import Action, Result, MAX_FRAME_SIZE, RECEIVE_BUFFER_LIMIT, PUSH_QUEUE_SIZE
+from server.entity.observer import Observer
+from server.protocol import FrameDecoder, encode_response, send_buffers
+from server.server import AsyncGameServerProtocol, GameServerRequestHandler
+
+
+def make_frame(action, data=None):
+    """ Builds client action frame.
+    """
+    frame = action.to_bytes(4, byteorder='little')
+    if data is not None:
+        message = json.dumps(data).encode('utf-8')
+        frame += len(message).to_bytes(4, byteorder='little') + message
+    return frame
+
+
+class TestFrameDecoder(unittest.TestCase):
+
+    def test_single_frame(self):
+        decoder = FrameDecoder()
+        frames = decoder.frames(make_frame(Action.MAP, {'layer': 0}))
+        self.assertEqual(frames, [(Action.MAP, '{"layer": 0}')])
+        self.assertFalse(decoder.pending())
+
+    def test_fragmented_frame(self):
+        """ Feed the frame byte by byte.
+        """
+        decoder = FrameDecoder()
+        data = make_frame(Action.LOGIN, {'name': 'Boris'})
+        frames = []
+        for i in range(len(data)):
+            frames.extend(decoder.frames(data[i:i + 1]))
+            if i < len(data) - 1:
+                self.assertEqual(frames, [])
+        self.assertEqual(frames, [(Action.LOGIN, '{"name": "Boris"}')])
+
+    def test_coalesced_frames(self):
+        """ Feed pipelined batch of commands, the last one is not complete.
+        """
+        decoder = FrameDecoder()
+        data = b''.join([
+            make_frame(Action.MOVE, {'line_idx': 1, 'speed': 1, 'train_idx': 1}),
+            make_frame(Action.OBSERVER),
+            make_frame(Action.TURN, {}),
+            make_frame(Action.LOGOUT),
+        ])
+        tail = make_frame(Action.MAP, {'layer': 1})
+        frames = decoder.frames(data + tail[:5])
+        self.assertEqual([f[0] for f in frames], [Action.MOVE, Action.OBSERVER, Action.TURN, Action.LOGOUT])
+        self.assertEqual(frames[1][1], '{}')
+        self.assertTrue(decoder.pending())
+        self.assertEqual(decoder.frames(tail[5:]), [(Action.MAP, '{"layer": 1}')])
+        self.assertFalse(decoder.pending())
+
+    def test_utf8_message(self):
+        decoder = FrameDecoder()
+        message = '{"name": "Борис"}'.encode('utf-8')
+        data = Action.LOGIN.to_bytes(4, byteorder='little') + len(message).to_bytes(4, byteorder='little') + message
+        self.assertEqual(decoder.frames(data[:-1]), [])
+        self.assertEqual(decoder.frames(data[-1:]), [(Action.LOGIN, '{"name": "Борис"}')])
+
+    def test_invalid_frame_is_skipped(self):
+        decoder = FrameDecoder()
+        decoder.feed(make_frame(999, {'fake': 1}) + make_frame(Action.TURN, {}))
+        with self.assertRaises(protocol.errors.BadCommand):
+            decoder.next_frame()
+        self.assertEqual(decoder.next_frame(), (Action.TURN, '{}'))
+
+    def test_too_large_frame(self):
+        """ Data of too large frame is not waited for.
+        """
+        decoder = FrameDecoder()
+        decoder.feed(Action.LOGIN.to_bytes(4, byteorder='little') + (2 ** 32 - 1).to_bytes(4, byteorder='little'))
+        with self.assertRaises(protocol.errors.FrameTooLarge):
+            decoder.next_frame()
+        self.assertFalse(decoder.pending())
+        message = b'x' * MAX_FRAME_SIZE
+        data = Action.LOGIN.to_bytes(4, byteorder='little') + len(message).to_bytes(4, byteorder='little') + message
+        self.assertEqual(decoder.frames(data), [(Action.LOGIN, message.decode('utf-8'))])
+
+
+class TestEncoders(unittest.TestCase):
+
+    def test_get_encoder(self):
+        self.assertIs(encoders.get_encoder('json'), encoders.DEFAULT_ENCODER)
+        with self.assertRaises(encoders.errors.BadCommand):
+            encoders.get_encoder('xml')
+
+    def test_compact_json(self):
+        data = {'idx': 1, 'train': [{'idx': 1, 'speed': 0}]}
+        encoded = encoders.get_encoder('compact').encode(data)
+        self.assertEqual(encoded, b'{"idx":1,"train":[{"idx":1,"speed":0}]}')
+        self.assertEqual(json.loads(encoders.DEFAULT_ENCODER.encode(data).decode('utf-8')), data)
+
+
+class TestResponseWriter(unittest.TestCase):
+
+    def test_encode_response(self):
+        header, data = encode_response(Result.OKEY, '{"name": "Борис"}')
+        self.assertEqual(int.from_bytes(header[:4], byteorder='little'), Result.OKEY)
+        self.assertEqual(int.from_bytes(header[4:], byteorder='little'), len(data))
+        self.assertEqual(data.decode('utf-8'), '{"name": "Борис"}')
+        self.assertEqual(b''.join(encode_response(Result.BAD_COMMAND)), b'\x01\x00\x00\x00\x00\x00\x00\x00')
+
+    def test_send_coalesced_responses(self):
+        """ Send many responses with one call, read them on the other side.
+        """
+        sock_1, sock_2 = socket.socketpair()
+        with sock_1, sock_2:
+            buffers = []
+            for i in range(1000):
+                buffers.extend(encode_response(Result.OKEY, json.dumps({'idx': i})))
+            expected = b''.join(buffers)
+            send_buffers(sock_1, buffers)
+            received = b''
+            while len(received) < len(expected):
+                received += sock_2.recv(65536)
+            self.assertEqual(received, expected)
+
+
+class FakeTransport(asyncio.Transport):
+    """ Transport which records written data and state of reading.
+    """
+    def __init__(self):
+        super(FakeTransport, self).__init__()
+        self.written = []
+        self.reading = True
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def is_closing(self):
+        return False
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def writelines(self, buffers):
+        self.written.extend(buffers)
+
+
+class FakeExecutor(object):
+    """ Executor which doesn't run submitted jobs.
+    """
+    def submit(self, *_):
+        return Future()
+
+
+class TestAsyncFlowControl(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.transport = FakeTransport()
+        self.connection = AsyncGameServerProtocol(self.loop, FakeExecutor())
+        self.connection.connection_made(self.transport)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_loop(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_reading_paused_while_data_not_processed(self):
+        frame = make_frame(Action.METRICS, {'padding': 'x' * 4096})
+        count = RECEIVE_BUFFER_LIMIT // len(frame) + 1
+        for _ in range(count):
+            self.assertTrue(self.transport.reading)
+            self.connection.data_received(frame)
+        self.assertFalse(self.transport.reading)
+
+        self.connection._process_chunks()  # Runs commands as the worker does.
+        self.run_loop()
+        self.assertTrue(self.transport.reading)
+        self.assertEqual(len(self.transport.written), 2 * count)
+
+    def test_reading_paused_while_responses_not_sent(self):
+        self.connection.pause_writing()
+        self.assertFalse(self.transport.reading)
+        self.connection.resume_writing()
+        self.assertTrue(self.transport.reading)
+
+
+class TestPushedFrames(unittest.TestCase):
+
+    @staticmethod
+    def connect(buffer_size):
+        """ Returns pair of connected TCP sockets with small buffers.
+        """
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            client = socket.socket()
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+            client.connect(listener.getsockname())
+            server, _ = listener.accept()
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        return server, client
+
+    @staticmethod
+    def start_handler(sock):
+        """ Handles the connection on new thread.
+        returns: tuple (thread, handler)
+        """
+        handlers = []
+
+        class Handler(GameServerRequestHandler):
+            def setup(self):
+                super(Handler, self).setup()
+                handlers.append(self)
+
+        thread = Thread(target=Handler, args=(sock, 'test', None))
+        thread.start()
+        while not handlers:
+            time.sleep(0.01)
+        return thread, handlers[0]
+
+    @staticmethod
+    def recv_response(sock):
+        """ Reads response frame from the socket.
+        returns: tuple (result, message)
+        """
+        def recv(size):
+            data = b''
+            while len(data) < size:
+                chunk = sock.recv(size - len(data))
+                if not chunk:
+                    raise ConnectionError("Connection is closed")
+                data += chunk
+            return data
+
+        result = int.from_bytes(recv(4), byteorder='little')
+        return result, recv(int.from_bytes(recv(4), byteorder='little')).decode('utf-8')
+
+    def test_client_not_reading_pushed_frames(self):
+        """ Pushing of frames never waits for the client, the connection is closed if the client doesn't read them.
+        """
+        sock_1, sock_2 = self.connect(4096)
+        with sock_1, sock_2:
+            thread, handler = self.start_handler(sock_1)
+            message = 'x' * 65536
+            start = time.monotonic()
+            for _ in range(PUSH_QUEUE_SIZE * 2):
+                handler.push_response(Result.TICK_DONE, message)
+            self.assertLess(time.monotonic() - start, 1)
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertTrue(handler.closed)
+
+    def test_lagging_spectator(self):
+        """ Spectator which doesn't read pushed layers loses layers of previous ticks, its connection stays open.
+        """
+        sock_1, sock_2 = self.connect(4096)
+        with sock_1, sock_2:
+            thread, handler = self.start_handler(sock_1)
+            observer = Observer(push=handler.push_response)
+            ticks = PUSH_QUEUE_SIZE * 2
+            start = time.monotonic()
+            for tick in range(ticks):
+                observer.on_live_tick(None, json.dumps({'tick': tick, 'padding': 'x' * 65536}))
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertFalse(handler.closed)
+
+            sock_2.settimeout(5)
+            received = []
+            while not received or received[-1] != ticks - 1:
+                result, message = self.recv_response(sock_2)
+                self.assertEqual(result, Result.TICK_DONE)
+                received.append(json.loads(message)['tick'])
+            self.assertLess(len(received), ticks)
+            sock_2.shutdown(socket.SHUT_WR)
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_replaced_pushed_frames(self):
+        """ Frame pushed with 'replace' flag replaces frames which are not sent yet.
+        """
+        handler = AsyncGameServerProtocol(None, None)
+        handler.schedule_pushes = lambda: None
+        handler.closed = False
+        for tick in range(PUSH_QUEUE_SIZE * 2):
+            handler.push_response(Result.TICK_DONE, str(tick), replace=True)
+        self.assertEqual(handler.pop_pushes(), encode_response(Result.TICK_DONE, str(PUSH_QUEUE_SIZE * 2 - 1)))
+        self.assertFalse(handler.closed)
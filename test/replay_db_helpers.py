@@ -1,12 +1,18 @@
 """ Test replay DB helpers.
 """
+import time
 import unittest
 from datetime import datetime
+from threading import Event
+from unittest import mock
 
+from server.db import replay as replay_module
 from server.db.models import Game, Action
-from server.db.replay import DbReplay, TIME_FORMAT
-from server.db.session import ReplaySession
-from server.defs import Action as ActionCodes
+from server.db.replay import DbReplay, ReplayWriter, TIME_FORMAT
+from server.db.session import ReplaySession, replay_engine
+from server.defs import Action as ActionCodes, GameState
+from server.entity import replay_log as replay_log_module
+from server.entity.replay_log import ReplayCache
 
 
 class TestReplayDb(unittest.TestCase):
@@ -145,3 +151,261 @@ class TestReplayDb(unittest.TestCase):
         self.assertEqual(game['date'], date.strftime(TIME_FORMAT))
         self.assertEqual(game['map'], map_name)
         self.assertEqual(game['length'], length)
+
+    def test_replay_writer(self):
+        """ Test actions are written by the writer on flush.
+        """
+        db = DbReplay(writer=ReplayWriter())
+        game_id = db.add_game('TestGame', 'TestMap')
+        with mock.patch.object(replay_module.CONFIG, 'REPLAY_FLUSH_INTERVAL', 60):
+            db.add_action(ActionCodes.LOGIN, '{"test": 1}')
+            for _ in range(10):
+                db.add_action(ActionCodes.TURN, None)
+            db.flush()
+
+        actions = db.get_all_actions(game_id)
+        self.assertEqual([a['code'] for a in actions], [ActionCodes.LOGIN] + [ActionCodes.TURN] * 10)
+        self.assertEqual(actions[0]['message'], '{"test": 1}')
+        self.assertEqual(db.get_all_games()[0]['length'], 10)
+
+    def test_replay_writer_batches(self):
+        """ Test actions are written by the writer when the batch is full or flush interval is expired.
+        """
+        db = DbReplay(writer=ReplayWriter())
+        game_id = db.add_game('TestGame', 'TestMap')
+        with mock.patch.object(replay_module.CONFIG, 'REPLAY_BATCH_SIZE', 3), \
+                mock.patch.object(replay_module.CONFIG, 'REPLAY_FLUSH_INTERVAL', 60):
+            for _ in range(4):
+                db.add_action(ActionCodes.TURN, None)
+            time.sleep(0.5)
+            self.assertEqual(len(db.get_all_actions(game_id)), 3)
+            db.flush()
+            self.assertEqual(len(db.get_all_actions(game_id)), 4)
+        with mock.patch.object(replay_module.CONFIG, 'REPLAY_FLUSH_INTERVAL', 0.1):
+            db.add_action(ActionCodes.TURN, None)
+            time.sleep(0.5)
+            self.assertEqual(len(db.get_all_actions(game_id)), 5)
+
+    def test_replay_writer_failure(self):
+        """ Test actions are kept and written again if writing failed, flush reports the failure.
+        """
+        db = DbReplay(writer=ReplayWriter())
+        game_id = db.add_game('TestGame', 'TestMap')
+        with mock.patch.object(replay_module.CONFIG, 'REPLAY_RETRY_INTERVAL', 0.1):
+            with mock.patch.object(replay_module, 'update_games', side_effect=RuntimeError('DB is locked')), \
+                    self.assertLogs('tcpserver', 'ERROR'):
+                db.add_action(ActionCodes.TURN, None)
+                self.assertFalse(db.flush())
+            self.assertEqual(len(db.get_all_actions(game_id)), 0)
+            time.sleep(0.5)
+            self.assertEqual(len(db.get_all_actions(game_id)), 1)
+            self.assertEqual(db.get_all_games()[0]['length'], 1)
+            self.assertTrue(db.flush())
+
+    def test_replay_writer_retry_limit(self):
+        """ Test number of actions kept while DB is unavailable is bounded, kept actions are written by chunks.
+        """
+        db = DbReplay(writer=ReplayWriter())
+        game_id = db.add_game('TestGame', 'TestMap')
+        with mock.patch.object(replay_module.CONFIG, 'REPLAY_BATCH_SIZE', 2), \
+                mock.patch.object(replay_module.CONFIG, 'REPLAY_RETRY_BATCHES', 2), \
+                mock.patch.object(replay_module.CONFIG, 'REPLAY_RETRY_INTERVAL', 60):
+            with mock.patch.object(replay_module, 'update_games', side_effect=RuntimeError('DB is locked')), \
+                    self.assertLogs('tcpserver', 'ERROR') as logs:
+                for _ in range(6):
+                    db.add_action(ActionCodes.TURN, None)
+                self.assertFalse(db.flush())
+            self.assertIn('Replay actions are lost, actions: 2', '\n'.join(logs.output))
+            with mock.patch.object(ReplayWriter, '_write', side_effect=ReplayWriter._write) as write:
+                self.assertTrue(db.flush())
+            self.assertEqual([len(c[0][0]) for c in write.call_args_list], [2, 2])
+        self.assertEqual(len(db.get_all_actions(game_id)), 4)
+        self.assertEqual(db.get_all_games()[0]['length'], 4)
+
+    def test_replay_writer_flush_timeout(self):
+        """ Test flush doesn't wait for stuck writer longer than the timeout.
+        """
+        db = DbReplay(writer=ReplayWriter())
+        game_id = db.add_game('TestGame', 'TestMap')
+        released = Event()
+        update_games = replay_module.update_games
+
+        def stuck_update_games(*args, **kwargs):
+            released.wait()
+            update_games(*args, **kwargs)
+
+        with mock.patch.object(replay_module, 'update_games', side_effect=stuck_update_games), \
+                self.assertLogs('tcpserver', 'ERROR'):
+            db.add_action(ActionCodes.TURN, None)
+            start = time.monotonic()
+            self.assertFalse(db.writer.flush(timeout=0.2))
+            self.assertLess(time.monotonic() - start, 1)
+            released.set()
+            self.assertTrue(db.flush())
+        self.assertEqual(len(db.get_all_actions(game_id)), 1)
+
+    def test_storage_profile(self):
+        """ Test PRAGMAs of storage profile are applied to connections of replay DB.
+        """
+        with replay_engine.connect() as connection:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+
+    def test_migrate_db(self):
+        """ Test migration creates missing indexes and keeps data.
+        """
+        self.db.add_game('TestGame', 'TestMap')
+        self.db.add_action(ActionCodes.TURN, None)
+        with replay_engine.connect() as connection:
+            connection.execute('DROP INDEX ix_action_game_id_code')
+        self.db.migrate_db()
+        self.db.migrate_db()
+
+        self.assertEqual(self.db.get_all_games()[0]['length'], 1)
+        self.assertIn('USING INDEX ix_action_game_id_id', ' '.join(self.db.explain_queries()['actions']))
+        with replay_engine.connect() as connection:
+            indexes = [r[1] for r in connection.execute('PRAGMA index_list(action)')]
+        self.assertIn('ix_action_game_id_code', indexes)
+
+    def test_get_all_games_filters(self):
+        """ Test games are filtered by map, part of name and dates, and paginated.
+        """
+        dates = [datetime(2018, 1, day) for day in range(1, 6)]
+        for i, date in enumerate(dates):
+            self.db.add_game('TestGame{}'.format(i), 'FakeMap{}'.format(i % 2), date=date)
+        self.db.add_game('OtherGame', 'FakeMap0', date=dates[-1])
+
+        self.assertEqual(len(self.db.get_all_games()), 6)
+        self.assertEqual([g['name'] for g in self.db.get_all_games(map_name='FakeMap1')], ['TestGame1', 'TestGame3'])
+        self.assertEqual(len(self.db.get_all_games(name='TestGame')), 5)
+        games = self.db.get_all_games(date_from=dates[1], date_to=dates[2])
+        self.assertEqual([g['name'] for g in games], ['TestGame1', 'TestGame2'])
+        page = self.db.get_all_games(offset=2, limit=3)
+        self.assertEqual([g['name'] for g in page], ['TestGame2', 'TestGame3', 'TestGame4'])
+        self.assertEqual(self.db.get_all_games(name='TestGame', map_name='FakeMap0', offset=1, limit=1)[0]['name'],
+                         'TestGame2')
+
+    def test_game_state(self):
+        """ Test state of the game is stored and written by the writer after actions.
+        """
+        game_id = self.db.add_game('TestGame', 'TestMap')
+        self.assertEqual(self.db.get_game(game_id)['state'], GameState.INIT)
+        self.db.set_game_state(GameState.RUN)
+        self.assertEqual(self.db.get_game(game_id)['state'], GameState.RUN)
+        self.assertIsNone(self.db.get_game(game_id + 1))
+
+        db = DbReplay(writer=ReplayWriter())
+        game_id = db.add_game('TestGame', 'TestMap')
+        with mock.patch.object(replay_module.CONFIG, 'REPLAY_FLUSH_INTERVAL', 60):
+            for _ in range(3):
+                db.add_action(ActionCodes.TURN, None)
+            db.set_game_state(GameState.FINISHED)
+            db.flush()
+        game = db.get_game(game_id)
+        self.assertEqual(game['state'], GameState.FINISHED)
+        self.assertEqual(game['length'], 3)
+
+    def test_migrate_db_game_length(self):
+        """ Test migration adds length and state of the game to DB created by previous version and fills length.
+        """
+        with replay_engine.begin() as connection:
+            connection.execute('DROP TABLE game')
+            connection.execute(
+                'CREATE TABLE game (id INTEGER PRIMARY KEY, name VARCHAR, date DATETIME, map_name VARCHAR, '
+                'num_players INTEGER)')
+            connection.execute(
+                "INSERT INTO game (id, name, date, map_name, num_players) "
+                "VALUES (1, 'Old', '2018-01-01 00:00:00.000000', 'Map', 1)")
+            for code in (ActionCodes.LOGIN, ActionCodes.TURN, ActionCodes.TURN):
+                connection.execute("INSERT INTO action (game_id, code) VALUES (1, {})".format(int(code)))
+        self.db.migrate_db()
+
+        game = self.db.get_game(1)
+        self.assertEqual(game['length'], 2)
+        self.assertIsNone(game['state'])
+
+    def test_iter_actions(self):
+        """ Test actions are streamed by chunks in order, reading can be resumed after any action.
+        """
+        game_id = self.db.add_game('TestGame', 'TestMap')
+        self.db.add_action(ActionCodes.LOGIN, '{"name": "TestPlayer"}')
+        for i in range(6):
+            self.db.add_action(ActionCodes.MOVE, '{{"fake_message": {}}}'.format(i))
+            self.db.add_action(ActionCodes.TURN, None)
+        self.db.add_action(ActionCodes.TURN, None, game_id=game_id + 1)
+
+        actions = self.db.get_all_actions(game_id)
+        streamed = list(self.db.iter_actions(game_id, chunk_size=5))
+        self.assertEqual([(a['code'], a['message']) for a in streamed], [(a['code'], a['message']) for a in actions])
+        self.assertEqual(list(self.db.iter_actions(game_id, after_id=streamed[4]['idx'], chunk_size=5)),
+                         streamed[5:])
+        self.assertEqual([a['code'] for a in self.db.iter_actions(game_id, codes=[ActionCodes.LOGIN])],
+                         [ActionCodes.LOGIN])
+        self.assertEqual(list(self.db.iter_actions(game_id + 2)), [])
+
+
+    def test_replay_cache(self):
+        """ Test replay logs of games are shared by observers and cache size is bounded.
+        """
+        game_ids = []
+        for name in ('TestGame1', 'TestGame2'):
+            game_ids.append(self.db.add_game(name, 'TestMap'))
+            self.db.add_action(ActionCodes.LOGIN, '{"name": "TestPlayer"}')
+            for _ in range(3):
+                self.db.add_action(ActionCodes.MOVE, '{"train_idx": 1, "speed": 1, "line_idx": 1}')
+                self.db.add_action(ActionCodes.TURN, None)
+        game_1, game_2 = (self.db.get_game(game_id) for game_id in game_ids)
+        cache = ReplayCache()
+
+        replay_log = cache.get(self.db, game_1)
+        self.assertIs(cache.get(self.db, game_1), replay_log)
+        actions = list(replay_log.iter_actions())
+        self.assertEqual(actions[0][1:], (ActionCodes.LOGIN, {'name': 'TestPlayer'}))
+        self.assertEqual(list(replay_log.iter_actions(after_id=actions[3][0])), actions[4:])
+        self.assertEqual(list(replay_log.iter_actions(codes=[ActionCodes.TURN])),
+                         [a for a in actions if a[1] == ActionCodes.TURN])
+        replay_log.add_checkpoint(0, 0, {'tick': 0})
+        replay_log.add_checkpoint(2, actions[4][0], {'tick': 2})
+        turn, action_id, _ = replay_log.get_checkpoint(5)
+        self.assertEqual((turn, action_id), (2, actions[4][0]))
+        self.assertEqual(replay_log.get_checkpoint(1)[0], 0)
+
+        # Log of running game is extended by new actions when the game grows:
+        replay_log_2 = cache.get(self.db, game_2)
+        replay_log_2.add_checkpoint(0, 0, {'tick': 0})
+        size, last_id = replay_log_2.size, replay_log_2.last_id
+        self.db.add_action(ActionCodes.MOVE, '{"train_idx": 1, "speed": -1, "line_idx": 1}', game_id=game_ids[1])
+        self.db.add_action(ActionCodes.TURN, None, game_id=game_ids[1])
+        with mock.patch.object(self.db, 'iter_actions', wraps=self.db.iter_actions) as iter_actions:
+            self.assertIs(cache.get(self.db, self.db.get_game(game_ids[1])), replay_log_2)
+            iter_actions.assert_called_once_with(game_ids[1], after_id=last_id)
+        actions_2 = list(replay_log_2.iter_actions())
+        self.assertEqual([a[1] for a in actions_2[-2:]], [ActionCodes.MOVE, ActionCodes.TURN])
+        self.assertEqual(len(actions_2), 9)
+        self.assertGreater(replay_log_2.size, size)
+        self.assertIsNotNone(replay_log_2.get_checkpoint(0))
+        self.assertIs(cache.get(self.db, game_2), replay_log_2)
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+
+        # Least recently used log is evicted:
+        replay_log = cache.get(self.db, game_1)
+        replay_log.add_checkpoint(0, 0, {'tick': 0})
+        with mock.patch.object(replay_log_module.CONFIG, 'REPLAY_CACHE_SIZE', replay_log.size * 3 // 2):
+            replay_log_2 = cache.get(self.db, self.db.get_game(game_ids[1]))
+            self.assertIs(cache.get(self.db, self.db.get_game(game_ids[1])), replay_log_2)
+            self.assertEqual(len(cache), 1)
+            self.assertIsNot(cache.get(self.db, game_1), replay_log)
+        with mock.patch.object(replay_log_module.CONFIG, 'REPLAY_CACHE_SIZE', 0):
+            cache.clear()
+            self.assertIsNot(cache.get(self.db, game_1), cache.get(self.db, game_1))
+            self.assertEqual(len(cache), 0)
+
+        # Reading of too large log stops as soon as the size bound is exceeded:
+        max_size = replay_log_module.ACTION_OVERHEAD_SIZE
+        with mock.patch.object(replay_log_module.CONFIG, 'REPLAY_CACHE_SIZE', max_size), \
+                mock.patch.object(replay_log_module, 'decode_action', wraps=replay_log_module.decode_action) as decode:
+            replay_log = cache.get(self.db, game_1)
+            self.assertEqual(decode.call_count, 0)
+            self.assertEqual(len(list(replay_log.iter_actions())), 7)
+            self.assertEqual(len(cache), 0)
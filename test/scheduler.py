@@ -0,0 +1,78 @@
+""" Test scheduler of game ticks.
+"""
+import time
+import unittest
+from threading import Event, Lock
+
+from server.scheduler import GameScheduler
+
+
+class FakeGame(object):
+    """ Records ticks, ticks while the deadline is due like the Game does.
+    """
+    def __init__(self, name, scheduler, ticks=1, tick_time=0.01):
+        self.name = name
+        self.scheduler = scheduler
+        self.ticks = []
+        self.max_ticks = ticks
+        self.tick_time = tick_time
+        self.next_tick_time = None
+        self.done = Event()
+        self._lock = Lock()
+
+    def schedule(self, delay):
+        with self._lock:
+            self.next_tick_time = time.monotonic() + delay
+            self.scheduler.schedule(self, self.next_tick_time)
+
+    def run_tick(self):
+        with self._lock:
+            if time.monotonic() < self.next_tick_time:
+                return
+            self.ticks.append(time.monotonic())
+            if len(self.ticks) == self.max_ticks:
+                self.done.set()
+                return
+            self.next_tick_time = time.monotonic() + self.tick_time
+            self.scheduler.schedule(self, self.next_tick_time)
+
+
+class TestGameScheduler(unittest.TestCase):
+
+    def test_many_games(self):
+        """ Test all games make all ticks on the small pool of workers.
+        """
+        scheduler = GameScheduler(workers=4)
+        games = [FakeGame('game {}'.format(i), scheduler, ticks=5) for i in range(200)]
+        for game in games:
+            game.schedule(0.01)
+        for game in games:
+            self.assertTrue(game.done.wait(5))
+            self.assertEqual(len(game.ticks), 5)
+
+    def test_deadlines_order(self):
+        """ Test games tick in order of their deadlines.
+        """
+        scheduler = GameScheduler(workers=1)
+        games = [FakeGame('game {}'.format(i), scheduler) for i in range(3)]
+        for game, delay in zip(games, (0.3, 0.1, 0.2)):
+            game.schedule(delay)
+        for game in games:
+            self.assertTrue(game.done.wait(5))
+        self.assertLess(games[1].ticks[0], games[2].ticks[0])
+        self.assertLess(games[2].ticks[0], games[0].ticks[0])
+
+    def test_reschedule(self):
+        """ Test the tick can be moved to earlier time, previous entry doesn't produce extra tick.
+        """
+        scheduler = GameScheduler(workers=2)
+        game = FakeGame('game', scheduler, ticks=2, tick_time=10)
+        start = time.monotonic()
+        game.schedule(10)
+        game.schedule(0)
+        time.sleep(0.1)
+        self.assertEqual(len(game.ticks), 1)
+        self.assertLess(game.ticks[0] - start, 1)
+        game.schedule(0)
+        self.assertTrue(game.done.wait(5))
+        self.assertEqual(len(game.ticks), 2)
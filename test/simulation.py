@@ -0,0 +1,87 @@
+""" Test headless simulation.
+"""
+import unittest
+from unittest import mock
+
+from server.db.map import generate_map02, DbMap
+from server.db.session import map_session_ctx
+from server.simulation import CONFIG, play_game, play_games, load_bot
+
+
+def shuttle_bot(game, player):
+    """ Moves all trains of the player back and forth along the first line from home.
+    """
+    line = [l for l in game.map.line.values() if player.home.idx in l.point][0]
+    home_position = 0 if line.point[0] == player.home.idx else line.length
+    for train in player.train.values():
+        if train.speed != 0 or train.cooldown:
+            continue
+        if train.line_idx == line.idx and train.position != home_position:
+            speed = -1 if home_position == 0 else 1
+        else:
+            speed = 1 if home_position == 0 else -1
+        game.move_train(player, train.idx, speed, line.idx)
+
+
+class EventsRecorder(object):
+    """ Plays as shuttle bot, records events of player's town.
+    """
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, game, player):
+        self.events.extend((game.current_tick, e.type) for e in player.town.event)
+        shuttle_bot(game, player)
+
+
+class TestSimulation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        database = DbMap()
+        database.reset_db()
+        with map_session_ctx() as session:
+            generate_map02(database, session)
+
+    @classmethod
+    def tearDownClass(cls):
+        database = DbMap()
+        database.reset_db()
+
+    def test_play_game(self):
+        result = play_game([shuttle_bot, shuttle_bot], ticks=100, seed=1)
+        self.assertEqual(result['ticks'], 100)
+        self.assertEqual(sorted(result['rating']), ['shuttle_bot 1', 'shuttle_bot 2'])
+        self.assertEqual(result['errors'], {'shuttle_bot 1': 0, 'shuttle_bot 2': 0})
+
+    def test_play_game_logs_no_ticks(self):
+        """ Test messages of each tick and train aren't logged at INFO level.
+        """
+        with self.assertLogs('tcpserver', level='INFO') as logs:
+            play_game([shuttle_bot], ticks=20, seed=1)
+        self.assertTrue(any('Create game' in line for line in logs.output))
+        self.assertFalse(any('Game tick' in line or 'Train is in point' in line for line in logs.output))
+
+    def test_deterministic_game(self):
+        """ Test games with the same seed have the same random events.
+        """
+        with mock.patch.object(CONFIG, 'PARASITES_ASSAULT_PROBABILITY', 30), \
+                mock.patch.object(CONFIG, 'REFUGEES_ARRIVAL_PROBABILITY', 30):
+            recorders = [EventsRecorder() for _ in range(3)]
+            results = [play_game([recorder], ticks=200, seed=seed) for recorder, seed in zip(recorders, (7, 7, 8))]
+        self.assertGreater(len({e[1] for e in recorders[0].events}), 1)
+        self.assertEqual(recorders[0].events, recorders[1].events)
+        self.assertNotEqual(recorders[0].events, recorders[2].events)
+        self.assertEqual(results[0]['rating'], results[1]['rating'])
+
+    def test_play_games(self):
+        """ Test games played on the pool of processes have the same results as played one by one.
+        """
+        results = play_games([shuttle_bot], games=4, ticks=50, seed=10, processes=2)
+        self.assertEqual([r['seed'] for r in results], [10, 11, 12, 13])
+        self.assertEqual(results[2], play_game([shuttle_bot], ticks=50, seed=12))
+
+    def test_load_bot(self):
+        self.assertIs(load_bot('test.simulation:shuttle_bot'), shuttle_bot)
+        with self.assertRaises(Exception):
+            load_bot('test.simulation:unknown_bot')
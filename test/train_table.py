@@ -0,0 +1,104 @@
+""" Test trains stored in the train table.
+"""
+import json
+import random
+import unittest
+from unittest import mock
+
+from server.db.map import generate_map02, DbMap
+from server.db.session import map_session_ctx
+from server.entity.game import CONFIG, Game
+from server.entity.player import Player
+from server.entity.train_table import numpy
+
+
+class RandomBot(object):
+    """ Moves each stopped train to random line from its point.
+    """
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+
+    def __call__(self, game, player):
+        for train in player.train.values():
+            if train.speed != 0 or train.cooldown:
+                continue
+            line = game.map.line[train.line_idx]
+            if train.position not in (0, line.length):
+                game.move_train(player, train.idx, 1, line.idx)
+                continue
+            point = line.point[0] if train.position == 0 else line.point[1]
+            line = game.map.line[self.random.choice(game.map.point_lines[point])]
+            game.move_train(player, train.idx, 1 if line.point[0] == point else -1, line.idx)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestTrainTable(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        database = DbMap()
+        database.reset_db()
+        with map_session_ctx() as session:
+            generate_map02(database, session)
+
+    @classmethod
+    def tearDownClass(cls):
+        database = DbMap()
+        database.reset_db()
+
+    @staticmethod
+    def play_game(train_table, ticks):
+        """ Plays the game by random bots, trains have little fuel.
+        returns: tuple (game, list of states of trains after each tick)
+        """
+        with mock.patch.object(CONFIG, 'TRAIN_TABLE_ENABLED', train_table), \
+                mock.patch.object(CONFIG, 'FUEL_ENABLED', True):
+            game = Game('Test train table {}'.format(train_table), num_players=2, seed=1, headless=True)
+            players = [Player('Test train table player {}'.format(i)) for i in range(2)]
+            for player in players:
+                game.add_player(player)
+            for train in game.trains.values():
+                train.fuel = train.fuel_capacity = train.idx + 2
+            bots = [RandomBot(i) for i in range(len(players))]
+            states = []
+            for _ in range(ticks):
+                for bot, player in zip(bots, players):
+                    bot(game, player)
+                game.tick()
+                states.append({i: dict(t.__dict__, player_id=None, event=len(t.event)) for i, t in game.trains.items()})
+        return game, states
+
+    def test_game_with_train_table(self):
+        """ Test game with the train table plays the same way as the game with Train objects.
+        """
+        game, states = self.play_game(False, 50)
+        table_game, table_states = self.play_game(True, 50)
+        self.assertIsNotNone(table_game.train_table)
+        self.assertEqual(table_states, states)
+        self.assertTrue(any(t['fuel'] < t['fuel_capacity'] for s in states for t in s.values()))
+        self.assertTrue(any(t['goods'] > 0 for s in states for t in s.values()))
+        player = list(game.players.values())[0]
+        table_player = list(table_game.players.values())[0]
+        trains = [dict(t, player_id=None) for t in json.loads(game.get_map_layer(player, 1))['train']]
+        table_trains = [dict(t, player_id=None) for t in json.loads(table_game.get_map_layer(table_player, 1))['train']]
+        self.assertEqual(table_trains, trains)
+
+        state = table_game.save_state()
+        table_game.tick()
+        expected = table_game.get_map_layer(table_player, 1)
+        table_game.restore_state(state)
+        table_game.tick()
+        self.assertEqual(table_game.get_map_layer(table_player, 1), expected)
+
+    def test_train_view(self):
+        with mock.patch.object(CONFIG, 'TRAIN_TABLE_ENABLED', True):
+            game = Game('Test train view', num_players=1, headless=True)
+        view = game.train_table.add_train(100)
+        self.assertIsNone(view.line_idx)
+        view.set_level(2)
+        view.goods = 10
+        self.assertEqual(view.level, 2)
+        self.assertEqual(view.fuel_capacity, CONFIG.TRAIN_LEVELS[2]['fuel_capacity'])
+        self.assertEqual(game.train_table.column('goods')[-1], 10)
+        self.assertIs(type(view.__dict__['goods']), int)
+        self.assertEqual(json.loads(json.dumps(view.__dict__))['level'], 2)